@@ -1,25 +1,1118 @@
 import json
+import re
 import traceback
 import asyncio
 import os
 import datetime
 import platform
-from typing import List, Dict, Any, Optional
+import hashlib
+import functools
+import importlib.util
+import sys
+import queue
+import random
+import signal
+import anyio
+import contextvars
+import math
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager, asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable, TYPE_CHECKING
 from pathlib import Path
 from dataclasses import dataclass
-from contextlib import AsyncExitStack
 
-from openai import OpenAI
 from rich.console import Console
-from rich.panel import Panel
-from rich.markdown import Markdown
-from rich.live import Live
 
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+# openai, httpx, mcp and most of rich take about a second to import, so they
+# are imported where first used; preload_modules() warms them in the background
+if TYPE_CHECKING:
+    from mcp import ClientSession
+    from openai import AsyncOpenAI
+    from rich.live import Live
 
 console = Console()
 
+async def read_input(prompt: str) -> str:
+    """console.input() off the event loop, in a daemon thread.
+
+    Unlike asyncio.to_thread(), a read still blocked when the loop shuts down
+    (Ctrl-C at the prompt) does not keep the interpreter from exiting.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if not future.done():
+            future.set_exception(error) if error else future.set_result(result)
+
+    def read():
+        try:
+            loop.call_soon_threadsafe(resolve, console.input(prompt), None)
+        except BaseException as e: # EOFError, or KeyboardInterrupt raised in this thread
+            try:
+                loop.call_soon_threadsafe(resolve, None, EOFError() if isinstance(e, KeyboardInterrupt) else e)
+            except RuntimeError:
+                pass # The loop is already closed
+
+    threading.Thread(target=read, name="input", daemon=True).start()
+    return await future
+
+def preload_modules():
+    """Import the modules deferred at startup, e.g. in a thread while the user types."""
+    import openai
+    import mcp.client.stdio
+    import rich.live
+    import rich.markdown
+    import rich.panel
+
+# Tools that change files, repositories or remote state. Calls to these are
+# never overlapped with other tool calls from the same assistant turn.
+SIDE_EFFECT_TOOLS = {
+    "investigate_and_save_report", "edit_code_file", "apply_edit_blocks",
+    "create_file", "run_terminal_command",
+    "git_add", "git_commit", "git_branch", "git_checkout", "git_pull",
+    "git_push", "git_init", "git_clone", "git_remote",
+    "create_directories", "move_files", "move_files_by_regex",
+    "init_planning", "update_plan_status", "mark_step_complete", "add_finding", "erase_plans",
+    "ssh_connect", "ssh_run_command", "ssh_disconnect",
+    "run_pytest", "run_test_file", "get_test_coverage",
+    "delegate_task",
+}
+
+# Deadlines (seconds) for tools that legitimately run longer than the default tool_timeout
+TOOL_TIMEOUTS = {
+    "investigate_and_save_report": 300.0, "delegate_task": 300.0, "ssh_run_command": 300.0, "git_clone": 300.0,
+}
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count: ~4 ASCII characters per token, one per other character (CJK)."""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def _message_field(message: Any, key: str) -> Any:
+    """Read a field from a dict message or an SDK message object."""
+    if isinstance(message, dict):
+        return message.get(key)
+    return getattr(message, key, None)
+
+def _message_text(message: Any) -> str:
+    """Text of a chat message that counts towards the context size."""
+    parts = [str(_message_field(message, "content") or ""), str(_message_field(message, "reasoning_content") or "")]
+    for tc in _message_field(message, "tool_calls") or []:
+        function = tc["function"] if isinstance(tc, dict) else tc.function
+        arguments = function["arguments"] if isinstance(function, dict) else function.arguments
+        parts.append(arguments or "")
+    return "".join(parts)
+
+class MessageStore(list):
+    """Conversation history that keeps a running size.
+
+    Each message is measured once when it is added, so checking the context
+    size is O(1) no matter how long the session gets.
+    """
+
+    def __init__(self, messages=()):
+        super().__init__()
+        self.total_chars = 0
+        self.total_tokens = 0
+        self.extend(messages)
+
+    def _account(self, messages, sign: int):
+        for message in messages:
+            text = _message_text(message)
+            self.total_chars += sign * len(text)
+            self.total_tokens += sign * estimate_tokens(text)
+
+    def append(self, message):
+        super().append(message)
+        self._account([message], 1)
+
+    def extend(self, messages):
+        messages = list(messages)
+        super().extend(messages)
+        self._account(messages, 1)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index, message):
+        super().insert(index, message)
+        self._account([message], 1)
+
+    def __setitem__(self, index, value):
+        old = self[index] if isinstance(index, slice) else [self[index]]
+        value = list(value) if isinstance(index, slice) else value
+        super().__setitem__(index, value)
+        self._account(old, -1)
+        self._account(value if isinstance(index, slice) else [value], 1)
+
+    def __delitem__(self, index):
+        old = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        self._account(old, -1)
+
+    def pop(self, index=-1):
+        message = super().pop(index)
+        self._account([message], -1)
+        return message
+
+    def remove(self, message):
+        super().remove(message)
+        self._account([message], -1)
+
+    def clear(self):
+        super().clear()
+        self.total_chars = 0
+        self.total_tokens = 0
+
+# Read-only tools whose results are reused while the paths they read are unchanged
+IDEMPOTENT_TOOLS = {
+    "read_code_file", "search_in_files", "list_directory", "read_office_file",
+    "list_supported_formats", "git_status", "git_diff", "git_log",
+}
+
+# Path arguments the skill servers default when a call leaves them out (relative to the shared cwd)
+PATH_DEFAULTS = {
+    "git_status": {"repo_path": "."}, "git_diff": {"repo_path": "."}, "git_log": {"repo_path": "."},
+}
+
+# Idempotent tools that read no files, so their results are cached without a fingerprint
+PATHLESS_TOOLS = {"list_supported_formats"}
+
+# Idempotent tools whose results depend on every file under a directory argument
+TREE_TOOLS = {"search_in_files", "git_status", "git_diff"}
+
+# Most entries stat()ed to fingerprint one directory tree; results over larger trees are not cached
+TREE_FINGERPRINT_LIMIT = 2000
+
+# Tool arguments that name filesystem paths
+PATH_ARGUMENTS = ("file_path", "folder_path", "path", "paths", "repo_path", "sources", "source_dir", "destination")
+
+def _argument_paths(arguments: Dict[str, Any]) -> List[Path]:
+    """Resolved filesystem paths named by a tool call's arguments."""
+    paths = []
+    for key in PATH_ARGUMENTS:
+        values = arguments.get(key)
+        for value in values if isinstance(values, list) else [values]:
+            if isinstance(value, str) and value:
+                paths.append(Path(value).expanduser().resolve())
+    return paths
+
+def _paths_overlap(a: Path, b: Path) -> bool:
+    return a == b or a in b.parents or b in a.parents
+
+def _tree_signature(root: Path, limit: int = TREE_FINGERPRINT_LIMIT) -> Optional[str]:
+    """Digest of the mtimes and sizes of everything under root (minus .git), or None past `limit` entries."""
+    digest = hashlib.sha1()
+    count = 0
+    stack = [root]
+    while stack:
+        try:
+            entries = sorted(os.scandir(stack.pop()), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name == ".git":
+                continue
+            count += 1
+            if count > limit:
+                return None
+            try:
+                stat = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+            except OSError:
+                continue
+            digest.update(f"{entry.path}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode("utf-8", "surrogateescape"))
+    return digest.hexdigest()
+
+class ToolResultCache:
+    """LRU cache of read-only tool results.
+
+    Entries remember the mtimes of the paths their call named (plus the git
+    index for repositories) and are dropped when any of them changes, when
+    they outlive `max_age`, or when a mutating tool touches an overlapping path.
+    For TREE_TOOLS the whole tree under a directory argument is fingerprinted,
+    so editing a nested file in place is noticed too.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 4 * 1024 * 1024, max_age: float = 300.0,
+                 tree_limit: int = TREE_FINGERPRINT_LIMIT):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.tree_limit = tree_limit
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def _paths(tool_name: str, arguments: Dict[str, Any]) -> List[Path]:
+        return _argument_paths({**PATH_DEFAULTS.get(tool_name, {}), **arguments})
+
+    @staticmethod
+    def _key(tool_name: str, arguments: Dict[str, Any]) -> Tuple[str, str]:
+        return tool_name, json.dumps(arguments, sort_keys=True, ensure_ascii=False)
+
+    def _fingerprint(self, paths: List[Path], tree: bool = False) -> Optional[List[Tuple[Path, Any]]]:
+        """Mtimes of the watched paths, or None when a tree is too large to fingerprint."""
+        watched = []
+        for path in paths:
+            watched.append(path)
+            git_dir = path / ".git"
+            if git_dir.is_dir():
+                # A commit only rewrites the branch ref (or packed-refs), not HEAD itself
+                watched.extend([git_dir / "index", git_dir / "HEAD", git_dir / "packed-refs"])
+                try:
+                    head = (git_dir / "HEAD").read_text(encoding="utf-8").strip()
+                except OSError:
+                    head = ""
+                if head.startswith("ref: "):
+                    watched.append(git_dir / head[len("ref: "):])
+        fingerprint = []
+        for path in watched:
+            try:
+                fingerprint.append((path, path.stat().st_mtime))
+            except OSError:
+                fingerprint.append((path, None))
+        if tree:
+            for path in paths:
+                if path.is_dir():
+                    signature = _tree_signature(path, self.tree_limit)
+                    if signature is None:
+                        return None
+                    fingerprint.append((path, signature))
+        return fingerprint
+
+    def get(self, tool_name: str, arguments: Dict[str, Any]) -> Optional[str]:
+        key = self._key(tool_name, arguments)
+        entry = self._entries.get(key)
+        if entry is not None:
+            fresh = time.monotonic() - entry["created"] <= self.max_age
+            if fresh and self._fingerprint(entry["paths"], entry["tree"]) == entry["fingerprint"]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["result"]
+            self._drop(key)
+            self.invalidations += 1
+        self.misses += 1
+        return None
+
+    def put(self, tool_name: str, arguments: Dict[str, Any], result: str):
+        size = len(result)
+        if size > self.max_bytes:
+            return
+        key = self._key(tool_name, arguments)
+        if key in self._entries:
+            self._drop(key)
+        paths = self._paths(tool_name, arguments)
+        if not paths and tool_name not in PATHLESS_TOOLS:
+            return # Nothing to watch for changes
+        tree = tool_name in TREE_TOOLS
+        fingerprint = self._fingerprint(paths, tree)
+        if fingerprint is None:
+            return
+        self._entries[key] = {
+            "result": result,
+            "paths": paths,
+            "tree": tree,
+            "fingerprint": fingerprint,
+            "created": time.monotonic(),
+            "size": size,
+        }
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate(self, paths: Optional[List[Path]] = None):
+        """Drop entries touching any of `paths`, or everything when no paths are known."""
+        if not paths:
+            stale = list(self._entries)
+        else:
+            stale = [key for key, entry in self._entries.items()
+                     if any(_paths_overlap(p, q) for p in entry["paths"] for q in paths)
+                     or not entry["paths"]]
+        for key in stale:
+            self._drop(key)
+        self.invalidations += len(stale)
+
+    def _drop(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                "entries": len(self._entries), "bytes": self._bytes}
+
+def render_markdown_entry(entry: Dict[str, Any]) -> str:
+    """Markdown transcript text for one session log entry."""
+    role = entry.get("role")
+    content = entry.get("content", "")
+    if role == "system":
+        return f"## System Prompt\n\n{content}\n\n"
+    elif role == "user":
+        return f"## User\n\n{content}\n\n"
+    elif role == "assistant":
+        text = ""
+        reasoning = entry.get("reasoning_content", "")
+        if reasoning:
+            text += f"### Reasoning\n> {reasoning.replace(chr(10), chr(10)+'> ')}\n\n"
+        return text + f"## Assistant\n\n{content}\n\n"
+    elif role == "tool_call":
+        return f"### Tool Call: `{entry.get('tool_name')}`\n\nArguments:\n```json\n{entry.get('arguments')}\n```\n\n"
+    elif role == "tool_result":
+        return f"### Tool Output ({entry.get('tool_name')})\n\n```\n{content}\n```\n\n"
+    return ""
+
+def render_markdown(jsonl_file: Path, md_file: Optional[Path] = None) -> Path:
+    """Render the Markdown transcript of a JSONL session log."""
+    jsonl_file = Path(jsonl_file)
+    md_file = Path(md_file) if md_file else jsonl_file.with_suffix(".md")
+    with open(jsonl_file, encoding="utf-8") as src, open(md_file, "w", encoding="utf-8") as dst:
+        dst.write(f"# Conversation Log: {jsonl_file.stem}\n\n")
+        for line in src:
+            if line.strip():
+                dst.write(render_markdown_entry(json.loads(line)))
+    return md_file
+
+class SessionLogger:
+    """Writes session log entries from a background thread.
+
+    log() only enqueues; the writer thread drains the queue in batches into
+    the JSONL log and, unless disabled, the Markdown transcript, keeping both
+    files open for the whole session. close() drains and fsyncs everything.
+    """
+
+    def __init__(self, jsonl_file: Path, md_file: Optional[Path] = None, batch_size: int = 256):
+        self.jsonl_file = jsonl_file
+        self.md_file = md_file
+        self.batch_size = batch_size
+        self.error: Optional[Exception] = None
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._jsonl = open(jsonl_file, "a", encoding="utf-8")
+        self._md = None
+        if md_file:
+            self._md = open(md_file, "w", encoding="utf-8")
+            self._md.write(f"# Conversation Log: {jsonl_file.stem}\n\n")
+        self._thread = threading.Thread(target=self._run, name="session-logger", daemon=True)
+        self._thread.start()
+
+    def log(self, entry: Dict[str, Any]):
+        self._queue.put(entry)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = [entry for entry in batch if entry is not None]
+            try:
+                self._jsonl.write("".join(json.dumps(e, ensure_ascii=False, default=str) + "\n" for e in batch))
+                self._jsonl.flush()
+                if self._md:
+                    self._md.write("".join(render_markdown_entry(e) for e in batch))
+                    self._md.flush()
+            except Exception as e:
+                self.error = e
+
+        for handle in (self._jsonl, self._md):
+            if handle:
+                try:
+                    os.fsync(handle.fileno())
+                except OSError:
+                    pass
+                handle.close()
+
+    def close(self):
+        """Write out every queued entry and close both files."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    return sorted_values[max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)]
+
+class Span:
+    """One timed operation; nested spans share a trace_id and point at their parent."""
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.status = "ok"
+        self.started_at = datetime.datetime.now().isoformat()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+class Tracer:
+    """Records nested timing spans (turn, LLM request, tool call, MCP round trip, skill connect).
+
+    The current span is tracked in a context variable, so spans opened in
+    concurrently gathered tasks nest under the span that started them.
+    Finished spans go to `sink` (a SessionLogger writing the trace JSONL)
+    and their durations are kept for summary().
+    """
+
+    def __init__(self, sink: Optional[SessionLogger] = None):
+        self.sink = sink
+        self.durations: Dict[str, List[float]] = defaultdict(list) # Span name -> seconds
+        self.tool_durations: Dict[str, List[float]] = defaultdict(list) # Tool name -> seconds of tool.call
+
+    @staticmethod
+    def current() -> Optional[Span]:
+        return _current_span.get()
+
+    def annotate(self, **attributes):
+        """Set attributes on the innermost open span, if any."""
+        span = _current_span.get()
+        if span is not None:
+            span.set(**attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            _current_span.reset(token)
+            self.durations[name].append(span.duration)
+            if name == "tool.call" and "tool" in span.attributes:
+                self.tool_durations[span.attributes["tool"]].append(span.duration)
+            if self.sink is not None:
+                self.sink.log(span.to_dict())
+
+    @staticmethod
+    def _stats(durations: List[float]) -> Dict[str, Any]:
+        values = sorted(durations)
+        return {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50) * 1000, 1),
+            "p95_ms": round(_percentile(values, 95) * 1000, 1),
+            "max_ms": round(values[-1] * 1000, 1),
+            "total_ms": round(sum(values) * 1000, 1),
+        }
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """p50/p95 latency per span name and per tool."""
+        return {
+            "spans": {name: self._stats(d) for name, d in sorted(self.durations.items())},
+            "tools": {name: self._stats(d) for name, d in sorted(self.tool_durations.items())},
+        }
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+
+class StreamAccumulator:
+    """Collects streamed text pieces; the full text is joined only when read."""
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._text: Optional[str] = ""
+
+    def append(self, piece: str):
+        self._parts.append(piece)
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self._parts)
+            self._parts = [self._text]
+        return self._text
+
+    def __bool__(self) -> bool:
+        return any(self._parts)
+
+class StreamRenderer:
+    """Renders a streamed assistant reply to the console.
+
+    Modes:
+    - "live": Markdown in a rich Live region. Completed blocks are printed
+      once and only the trailing block is re-rendered, at most `fps` times
+      per second.
+    - "plain": raw text as it arrives, for terminals without rich rendering.
+    - "none": nothing, for headless use.
+    """
+
+    def __init__(self, mode: str = "live", fps: float = 8.0, out: Optional[Console] = None):
+        if mode not in ("live", "plain", "none"):
+            raise ValueError(f"Unknown render mode: {mode}")
+        self.mode = mode
+        self.interval = 1.0 / fps
+        self.console = out or console
+        self.reasoning = StreamAccumulator()
+        self.content = StreamAccumulator()
+        self._live: Optional["Live"] = None
+        self._committed = 0 # Length of content already printed as finished blocks
+        self._last_render = 0.0
+        self._in_reasoning = False
+
+    def start(self):
+        if self.mode != "none":
+            self.console.print("[yellow]Reasoning:[/yellow]")
+
+    def add_reasoning(self, piece: str):
+        self.reasoning.append(piece)
+        self._in_reasoning = True
+        if self.mode != "none":
+            self.console.print(piece, end="", style="italic dim", markup=False, highlight=False)
+
+    def add_content(self, piece: str):
+        self.content.append(piece)
+        if self.mode == "none":
+            return
+        if self._in_reasoning:
+            self.console.print("\n\n", end="") # Switch with newlines
+            self._in_reasoning = False
+        if self.mode == "plain":
+            self.console.out(piece, end="", highlight=False)
+            return
+
+        if self._live is None:
+            from rich.live import Live
+            from rich.markdown import Markdown
+            self._live = Live(Markdown(""), console=self.console, auto_refresh=False)
+            self._live.start()
+        now = time.monotonic()
+        if now - self._last_render >= self.interval:
+            self._last_render = now
+            self._render()
+
+    def _render(self):
+        """Print finished blocks once and redraw the trailing block."""
+        from rich.markdown import Markdown
+        text = self.content.text
+        pending = text[self._committed:]
+        cut = pending.rfind("\n\n")
+        while cut > 0 and pending[:cut].count("```") % 2: # Never split inside a code fence
+            cut = pending.rfind("\n\n", 0, cut)
+        if cut > 0:
+            self._live.console.print(Markdown(pending[:cut]))
+            self._committed += cut + 2
+            pending = text[self._committed:]
+        self._live.update(Markdown(pending), refresh=True)
+
+    def pause(self):
+        """Finish the live region, e.g. before tool call output."""
+        if self._live:
+            self._render()
+            self._live.stop()
+            self._live = None
+            self._committed = len(self.content.text)
+
+    def finish(self):
+        self.pause()
+        if self.mode != "none":
+            self.console.print() # Newline
+
+_WORD_RE = re.compile(r"[a-z0-9]+|[^\x00-\x7f]")
+# Words too common in prompts and SKILL.md files to tell skills or tools apart
+STOPWORDS = {
+    "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "how", "if", "in", "is", "it",
+    "me", "my", "of", "on", "or", "please", "that", "the", "this", "to", "use", "what", "when", "with", "you",
+}
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase words for ranking; snake_case and camelCase are split, CJK characters count as words."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text).replace("_", " ").lower()
+    return [word for word in _WORD_RE.findall(text)
+            if not word.isspace() and word not in STOPWORDS and (len(word) > 1 or not word.isascii())]
+
+class BM25Index:
+    """Okapi BM25 over a small set of documents, e.g. tool or skill descriptions."""
+
+    def __init__(self, documents: Dict[str, str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = {key: Counter(tokenize(text)) for key, text in documents.items()}
+        self.lengths = {key: sum(terms.values()) for key, terms in self.terms.items()}
+        self.avg_length = (sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0) or 1.0
+        frequency = Counter(term for terms in self.terms.values() for term in terms)
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in frequency.items()}
+
+    def scores(self, query: str) -> Dict[str, float]:
+        """BM25 score of every document for the query; 0.0 when no query word occurs."""
+        words = [word for word in set(tokenize(query)) if word in self.idf]
+        scores = {}
+        for key, terms in self.terms.items():
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[key] / self.avg_length)
+            scores[key] = sum((
+                self.idf[word] * terms[word] * (self.k1 + 1) / (terms[word] + norm)
+                for word in words if word in terms
+            ), 0.0)
+        return scores
+
+def _allowed_tools(instructions: str) -> List[str]:
+    """Tool names listed under allowed-tools in a SKILL.md frontmatter."""
+    if not instructions.startswith("---"):
+        return []
+    tools, listing = [], False
+    for line in instructions.split("---", 2)[1].splitlines():
+        if line.strip().startswith("allowed-tools:"):
+            listing = True
+        elif listing and line.strip().startswith("- "):
+            tools.append(line.strip()[2:].strip())
+        elif line.strip():
+            listing = False
+    return tools
+
+class SkillPredictor:
+    """Guesses which skills a prompt needs before the model asks for them.
+
+    A skill's score is the BM25 match of the prompt against its SKILL.md
+    plus up to `history_weight` for the votes of similar past prompts (BM25
+    over the prompts in the session logs) whose turn used the skill.
+    Skills scoring at least `min_score` are predicted, best first.
+    """
+
+    def __init__(self, skill_docs: Dict[str, str], history: List[Tuple[str, List[str]]],
+                 min_score: float = 3.0, history_weight: float = 4.0, limit: int = 2):
+        self.min_score = min_score
+        self.history_weight = history_weight
+        self.limit = limit
+        self.docs = BM25Index(skill_docs)
+        self.history = history
+        self.prompts = BM25Index({str(i): prompt for i, (prompt, _) in enumerate(history)})
+
+    @staticmethod
+    def history_from_logs(log_files: List[Path], tool_skills: Dict[str, str]) -> List[Tuple[str, List[str]]]:
+        """(prompt, skills used in that turn) for every turn in the logs.
+
+        A turn uses a skill if it called the skill's loader or any of its
+        tools; `tool_skills` maps tool names to skills.
+        """
+        history = []
+        for log_file in log_files:
+            try:
+                with open(log_file, encoding="utf-8") as f:
+                    for line in f:
+                        if '"user"' not in line and '"tool_call"' not in line:
+                            continue
+                        entry = json.loads(line)
+                        if entry.get("role") == "user":
+                            history.append((entry.get("content") or "", []))
+                        elif entry.get("role") == "tool_call" and history:
+                            tool_name = entry.get("tool_name") or ""
+                            skill = tool_name[len("skill_"):] if tool_name.startswith("skill_") else tool_skills.get(tool_name)
+                            if skill and skill not in history[-1][1]:
+                                history[-1][1].append(skill)
+            except (OSError, json.JSONDecodeError):
+                continue
+        return [(prompt, skills) for prompt, skills in history if skills]
+
+    def scores(self, prompt: str) -> Dict[str, float]:
+        scores = self.docs.scores(prompt)
+        # How much of the prompt's weight a past prompt matches, about 1.0 for the same words
+        unseen = math.log(1 + (len(self.history) + 0.5) / 0.5)
+        ideal = sum(self.prompts.idf.get(word, unseen) for word in set(tokenize(prompt))) or 1.0
+        similar = [(min(1.0, score / ideal), self.history[int(i)][1])
+                   for i, score in self.prompts.scores(prompt).items() if score > 0]
+        similar = sorted(similar, key=lambda item: item[0], reverse=True)[:10]
+        total = sum(match for match, _ in similar)
+        for match, skills in similar:
+            for skill in skills:
+                if skill in scores:
+                    # The skill's share of the votes, scaled by the closest match
+                    scores[skill] += self.history_weight * match / total * similar[0][0]
+        return scores
+
+    def predict(self, prompt: str) -> List[str]:
+        scores = self.scores(prompt)
+        ranked = sorted((name for name, score in scores.items() if score >= self.min_score),
+                        key=lambda name: scores[name], reverse=True)
+        return ranked[:self.limit]
+
+class ArtifactStore:
+    """Content-addressed store for large tool results.
+
+    Each result is written once to `<root>/<sha256>.txt`; its handle is the
+    first 16 hex digits of the hash.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def put(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        path = self.root / f"{digest}.txt"
+        if not path.exists():
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(text, encoding="utf-8")
+            tmp.replace(path)
+        return digest[:16]
+
+    def path(self, handle: str) -> Optional[Path]:
+        if len(handle) < 8 or not all(c in "0123456789abcdef" for c in handle):
+            return None
+        matches = list(self.root.glob(f"{handle}*.txt"))
+        return matches[0] if len(matches) == 1 else None
+
+    def read(self, handle: str) -> Optional[str]:
+        path = self.path(handle)
+        return path.read_text(encoding="utf-8") if path else None
+
+# Built-in tool for paging through results stored in the ArtifactStore
+READ_TOOL_RESULT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "read_tool_result",
+        "description": "Read part of a large tool result that was stored out of line. "
+                       "Use the handle and offsets given in the result preview.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle of the stored result."},
+                "offset": {"type": "integer", "description": "Character offset to start reading at. Default 0."},
+                "length": {"type": "integer", "description": "Number of characters to read. Default 8000."}
+            },
+            "required": ["handle"]
+        }
+    }
+}
+
+@dataclass
+class TransportConfig:
+    """Connection pooling, timeouts, retries and hedging for LLM requests."""
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 60.0 # Seconds an idle pooled connection is kept open
+    connect_timeout: float = 10.0
+    ttft_timeout: Optional[float] = 60.0 # Seconds until the first streamed chunk
+    idle_timeout: Optional[float] = 30.0 # Max seconds between streamed chunks
+    max_retries: int = 3
+    backoff_base: float = 0.5 # Seconds; full jitter over base * 2**attempt
+    backoff_max: float = 8.0
+    hedge_after: Optional[float] = None # Start a second, racing request if no first chunk by then
+
+class LLMTimeout(Exception):
+    """No first chunk, or no next chunk, within the configured timeout."""
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+class LLMTransport:
+    """Streams chat completions with timeouts, jittered retries and optional hedging.
+
+    Completions have no side effects, so a failed attempt is simply started
+    again until one streams to the end; `consume` receives a fresh chunk
+    iterator each time and must not keep state between attempts. Every
+    attempt is reported to `on_attempt` for the session log.
+    """
+
+    def __init__(self, client: Optional["AsyncOpenAI"], config: TransportConfig, tracer: Optional["Tracer"] = None,
+                 on_attempt: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 client_factory: Optional[Callable[[], "AsyncOpenAI"]] = None):
+        self._client = client
+        self._client_factory = client_factory # Builds the client on first use if none is given
+        self.config = config
+        self.tracer = tracer or Tracer()
+        self.on_attempt = on_attempt
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+    @staticmethod
+    def build_client(api_key: str, base_url: str, config: TransportConfig) -> "AsyncOpenAI":
+        """AsyncOpenAI client on an explicitly pooled keep-alive connection pool, without SDK retries."""
+        import httpx
+        from openai import AsyncOpenAI
+
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            # Stream timeouts are enforced by LLMTransport; this only catches dead sockets
+            timeout=httpx.Timeout(
+                None if config.ttft_timeout is None or config.idle_timeout is None
+                else max(config.ttft_timeout, config.idle_timeout),
+                connect=config.connect_timeout,
+            ),
+        )
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+    @staticmethod
+    def is_retriable(error: Exception) -> bool:
+        import httpx
+        from openai import APIConnectionError, APIStatusError
+
+        if isinstance(error, (LLMTimeout, APIConnectionError, httpx.TransportError)):
+            return True
+        return isinstance(error, APIStatusError) and (
+            error.status_code in RETRY_STATUS_CODES or error.status_code >= 500
+        )
+
+    def backoff(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """Seconds to wait before the next attempt, honouring Retry-After."""
+        from openai import APIStatusError
+
+        if isinstance(error, APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                return min(self.config.backoff_max, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return random.uniform(0, min(self.config.backoff_max, self.config.backoff_base * 2 ** attempt))
+
+    async def _start(self, request: Dict[str, Any]):
+        """Open a stream and wait for its first chunk."""
+        stream = await self.client.chat.completions.create(**request)
+        chunks = stream.__aiter__()
+        try:
+            first = await chunks.__anext__()
+        except BaseException:
+            await stream.close()
+            raise
+        return stream, chunks, first
+
+    async def _start_with_timeout(self, request: Dict[str, Any]):
+        try:
+            return await asyncio.wait_for(self._start(request), self.config.ttft_timeout)
+        except asyncio.TimeoutError:
+            raise LLMTimeout(f"no response within {self.config.ttft_timeout}s") from None
+
+    async def _open(self, request: Dict[str, Any], record: Dict[str, Any]):
+        """Start the request, racing a hedged duplicate if the first chunk is slow."""
+        primary = asyncio.create_task(self._start_with_timeout(request))
+        tasks = [primary]
+        winner = None
+        try:
+            if self.config.hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=self.config.hedge_after)
+                if not done:
+                    tasks.append(asyncio.create_task(self._start_with_timeout(request)))
+                    record["hedged"] = True
+                    self.hedges += 1
+
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        record["winner"] = "primary" if task is primary else "hedge"
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await result[0].close() # The other request got through as well
+
+    async def _iterate(self, chunks, first):
+        yield first
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), self.config.idle_timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise LLMTimeout(f"stream stalled for {self.config.idle_timeout}s") from None
+            yield chunk
+
+    async def run(self, request: Dict[str, Any], consume: Callable[[Any, float], Awaitable[Any]]) -> Any:
+        """Stream `request` and return consume(chunks, started), retrying failed attempts."""
+        for attempt in range(self.config.max_retries + 1):
+            record = {"attempt": attempt + 1, "model": request.get("model")}
+            started = time.perf_counter()
+            self.attempts += 1
+            try:
+                with self.tracer.span("llm.attempt", attempt=attempt + 1) as span:
+                    stream, chunks, first = await self._open(request, record)
+                    span.set(hedged=record.get("hedged", False))
+                    try:
+                        result = await consume(self._iterate(chunks, first), started)
+                    finally:
+                        await stream.close()
+                self._report(record, "ok", started)
+                return result
+            except Exception as e:
+                retry = attempt < self.config.max_retries and self.is_retriable(e)
+                self._report(record, "retry" if retry else "error", started, e)
+                if not retry:
+                    raise
+                delay = self.backoff(attempt, e)
+                console.print(f"[yellow]LLM request failed ({type(e).__name__}: {e}); retrying in {delay:.1f}s[/]")
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    def _report(self, record: Dict[str, Any], outcome: str, started: float, error: Optional[Exception] = None):
+        record.update(outcome=outcome, elapsed_s=round(time.perf_counter() - started, 3))
+        if error is not None:
+            from openai import APIStatusError
+            record["error"] = f"{type(error).__name__}: {error}"
+            if isinstance(error, APIStatusError):
+                record["status_code"] = error.status_code
+        if self.on_attempt:
+            self.on_attempt(record)
+
+    def stats(self) -> Dict[str, int]:
+        return {"attempts": self.attempts, "retries": self.retries, "hedges": self.hedges}
+
+# USD per million tokens (DeepSeek list prices); override via BudgetGovernor(prices=...)
+MODEL_PRICES = {
+    "deepseek-chat": {"cache_hit": 0.028, "cache_miss": 0.28, "output": 0.42},
+    "deepseek-reasoner": {"cache_hit": 0.028, "cache_miss": 0.28, "output": 0.42},
+}
+
+@dataclass
+class BudgetConfig:
+    """Token and cost limits; None means unlimited.
+
+    Past a soft limit requests go to `fallback_model`, which skips the long
+    reasoning output; past a hard limit the turn stops. Token limits count
+    prompt plus completion tokens.
+    """
+    soft_tokens: Optional[int] = None # Per session
+    hard_tokens: Optional[int] = None
+    soft_cost: Optional[float] = None # USD per session
+    hard_cost: Optional[float] = None
+    turn_soft_tokens: Optional[int] = None # Per user turn
+    turn_hard_tokens: Optional[int] = None
+    fallback_model: str = "deepseek-chat"
+
+class BudgetGovernor:
+    """Accounts token usage and cost per turn and per session, and applies a BudgetConfig."""
+
+    def __init__(self, config: Optional[BudgetConfig] = None, prices: Optional[Dict[str, Dict[str, float]]] = None):
+        self.config = config or BudgetConfig()
+        self.prices = prices or MODEL_PRICES
+        self.session: Counter = Counter()
+        self.turn: Counter = Counter()
+        self.by_model: Dict[str, Counter] = defaultdict(Counter)
+        self.downgraded_requests = 0
+        self.stopped: Optional[str] = None # Why the last turn was stopped, if it was
+
+    def cost(self, model: str, usage: Dict[str, Any]) -> float:
+        """USD for one response; without a cache breakdown every prompt token counts as a miss."""
+        price = self.prices.get(model) or next(iter(self.prices.values()))
+        hits = usage.get("prompt_cache_hit_tokens") or 0
+        misses = usage.get("prompt_cache_miss_tokens")
+        if misses is None:
+            misses = (usage.get("prompt_tokens") or 0) - hits
+        return (hits * price["cache_hit"] + misses * price["cache_miss"]
+                + (usage.get("completion_tokens") or 0) * price["output"]) / 1_000_000
+
+    def start_turn(self):
+        self.turn = Counter()
+        self.stopped = None
+
+    def record(self, model: str, usage: Dict[str, Any]) -> float:
+        entry = Counter({
+            "requests": 1,
+            "prompt_tokens": usage.get("prompt_tokens") or 0,
+            "completion_tokens": usage.get("completion_tokens") or 0,
+            "total_tokens": usage.get("total_tokens") or 0,
+        })
+        cost = self.cost(model, usage)
+        for totals in (self.session, self.turn, self.by_model[model]):
+            totals.update(entry)
+            totals["cost_usd"] += cost
+        return cost
+
+    @staticmethod
+    def _over(totals: Counter, tokens: Optional[int], cost: Optional[float]) -> Optional[str]:
+        if tokens is not None and totals["total_tokens"] >= tokens:
+            return f"{totals['total_tokens']} of {tokens} tokens"
+        if cost is not None and totals["cost_usd"] >= cost:
+            return f"${totals['cost_usd']:.4f} of ${cost:.4f}"
+        return None
+
+    def hard_limit(self) -> Optional[str]:
+        """Description of the exhausted hard limit, if any."""
+        c = self.config
+        session = self._over(self.session, c.hard_tokens, c.hard_cost)
+        if session:
+            return f"session budget exhausted ({session})"
+        turn = self._over(self.turn, c.turn_hard_tokens, None)
+        return f"turn budget exhausted ({turn})" if turn else None
+
+    def soft_limit(self) -> Optional[str]:
+        c = self.config
+        session = self._over(self.session, c.soft_tokens, c.soft_cost)
+        if session:
+            return f"session soft budget reached ({session})"
+        turn = self._over(self.turn, c.turn_soft_tokens, None)
+        return f"turn soft budget reached ({turn})" if turn else None
+
+    def model_for(self, model: str) -> str:
+        """The model to use for the next request instead of `model`."""
+        if model != self.config.fallback_model and self.soft_limit():
+            self.downgraded_requests += 1
+            return self.config.fallback_model
+        return model
+
+    @staticmethod
+    def _rounded(totals: Counter) -> Dict[str, Any]:
+        return {key: round(value, 6) if key == "cost_usd" else value for key, value in totals.items()}
+
+    def turn_report(self) -> Dict[str, Any]:
+        return {**self._rounded(self.turn), "stopped": self.stopped}
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "session": self._rounded(self.session),
+            "by_model": {model: self._rounded(totals) for model, totals in self.by_model.items()},
+            "downgraded_requests": self.downgraded_requests,
+            "limits": {key: value for key, value in vars(self.config).items() if value is not None},
+        }
+
+# Longest message excerpt sent to the summarizer
+SUMMARY_MESSAGE_CHARS = 4000
+
 @dataclass
 class MCPSkillConfig:
     name: str # e.g. "os_manipulation"
@@ -27,15 +1120,168 @@ class MCPSkillConfig:
     args: List[str]
     skill_md_path: Path
     env: Dict[str, str] = None
+    max_concurrency: int = 4 # Max in-flight tool calls against this server
+    side_effect_tools: List[str] = None # Extra tools to run serially
+    idempotent_tools: List[str] = None # Extra read-only tools whose results may be cached
+    shareable: bool = False # Server keeps no per-session state and may serve several agents
+    transport: str = "stdio" # "stdio" subprocess, or "inprocess" for trusted skills (env is ignored)
+    tool_timeout: Optional[float] = None # Deadline for this skill's tools, instead of the agent's
+    tool_timeouts: Dict[str, float] = None # Deadlines for single tools
+
+# Ids of the JSON-RPC requests sent by the current task, recorded by RequestIdRecorder
+_sent_request_ids: contextvars.ContextVar[Optional[List[Any]]] = contextvars.ContextVar("sent_request_ids", default=None)
+
+class RequestIdRecorder:
+    """Client write stream that records the ids of outgoing requests for the sending task.
+
+    ClientSession.call_tool() does not expose the id of its request, which is
+    needed to cancel it; the request is written from the caller's task, so
+    the id can be read off the outgoing message.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def send(self, message):
+        sent = _sent_request_ids.get()
+        request = message.message.root
+        if sent is not None and getattr(request, "method", None) is not None and hasattr(request, "id"):
+            sent.append(request.id)
+        await self._stream.send(message)
+
+    async def __aenter__(self):
+        await self._stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self._stream.__aexit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+class ToolTimeout(Exception):
+    """A tool call missed its deadline and was cancelled."""
+
+def load_inprocess_server(script: Path):
+    """Import a fresh copy of a skill's server.py and serve its FastMCP instance from a low-level server.
+
+    Each call imports the module again, so module state (e.g. the planner's)
+    belongs to one agent. Tools run in a worker thread on their own event
+    loop, so synchronous tools cannot block the agent's loop.
+    """
+    from mcp.server.fastmcp import FastMCP
+    from mcp.server.lowlevel import Server
+
+    script = script.resolve()
+    spec = importlib.util.spec_from_file_location(f"skill_server_{script.parent.name}", script)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, str(script.parent))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(script.parent))
+    app = next((value for value in vars(module).values() if isinstance(value, FastMCP)), None)
+    if app is None:
+        raise RuntimeError(f"{script} defines no FastMCP server")
+
+    server = Server(app.name)
+
+    @server.list_tools()
+    async def list_tools():
+        return await app.list_tools()
+
+    @server.call_tool(validate_input=False) # FastMCP validates the arguments itself
+    async def call_tool(name: str, arguments: Dict[str, Any]):
+        # A cancelled call returns at once; the thread finishes the tool on its own
+        return await anyio.to_thread.run_sync(asyncio.run, app.call_tool(name, arguments), abandon_on_cancel=True)
+
+    return server
+
+class SkillManifest:
+    """Parsed SKILL.md metadata cached on disk between runs.
+
+    Entries are keyed by SKILL.md path and reused while the file's mtime and
+    size are unchanged, so startup only reads the skills that were edited.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        try:
+            self.entries: Dict[str, Dict[str, Any]] = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def _stamp(skill_md_path: Path) -> Optional[List[int]]:
+        try:
+            stat = skill_md_path.stat()
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def get(self, name: str, skill_md_path: Path) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(str(skill_md_path))
+        stamp = self._stamp(skill_md_path)
+        if entry is None or stamp is None or entry["stamp"] != stamp or entry["name"] != name:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, name: str, skill_md_path: Path, **metadata):
+        stamp = self._stamp(skill_md_path)
+        if stamp is not None:
+            self.entries[str(skill_md_path)] = {"name": name, "stamp": stamp, **metadata}
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(self.entries, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.path)
+        self._dirty = False
 
 class MCPSkillWrapper:
-    def __init__(self, config: MCPSkillConfig):
+    def __init__(self, config: MCPSkillConfig, manifest: Optional[SkillManifest] = None):
         self.config = config
         self.loaded = False
-        self.session: Optional[ClientSession] = None
+        self.session: Optional["ClientSession"] = None
+        self.session_task: Optional[asyncio.Task] = None
+        self.ready: Optional[asyncio.Future] = None
+        self.closing: Optional[asyncio.Event] = None
+        self.connect_time: Optional[float] = None # Seconds spent spawning + initializing
+        self.shared_from: Optional["MCPSkillWrapper"] = None # Pooled wrapper whose session we use
+        self.inprocess_server = None # Server of an "inprocess" skill, kept across reconnects
+        # Lifecycle bookkeeping, see DeepSeekMCPAgent.skill_health()
+        self.last_used = 0.0 # time.monotonic() of the last connect or call
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.restart_count = 0
+        self.evictions = 0
+        self.crashed = False
+        self.last_error: Optional[str] = None
         self.tools_cache: List[Dict[str, Any]] = []
+        self.side_effect_tools = set(SIDE_EFFECT_TOOLS) | set(config.side_effect_tools or [])
+        self.idempotent_tools = set(IDEMPOTENT_TOOLS) | set(config.idempotent_tools or [])
+        self.semaphore = asyncio.Semaphore(max(1, config.max_concurrency))
         self._description: str = ""
-        self._load_metadata()
+        cached = manifest.get(config.name, config.skill_md_path) if manifest else None
+        if cached:
+            self._description = cached["description"]
+            self._full_instructions = cached["instructions"]
+            self._loader_tool_def = cached["loader_tool_def"]
+        else:
+            self._load_metadata()
+            self._loader_tool_def = self._build_loader_tool_def()
+            if manifest:
+                manifest.put(config.name, config.skill_md_path, description=self._description,
+                             instructions=self._full_instructions, loader_tool_def=self._loader_tool_def)
 
     def _load_metadata(self):
         """Parse description and prepare context from SKILL.md"""
@@ -60,7 +1306,126 @@ class MCPSkillWrapper:
     def description(self) -> str:
         return self._description
 
+    async def open(self):
+        """Start the MCP server and wait until its session is ready.
+
+        Concurrent callers share one in-flight connection attempt.
+        """
+        if self.session: return
+        if self.session_task is None or self.session_task.done():
+            self.closing = asyncio.Event()
+            self.ready = asyncio.get_running_loop().create_future()
+            self.session_task = asyncio.create_task(self._serve(self.ready))
+        await asyncio.shield(self.ready)
+
+    async def close(self):
+        """Stop the MCP server, or detach from a shared one."""
+        if self.shared_from is not None:
+            self.session = None
+            self.shared_from = None
+            return
+        if self.session_task is None:
+            return
+        self.closing.set()
+        await self.session_task
+        self.session_task = None
+
+    def attach(self, shared: "MCPSkillWrapper"):
+        """Use the session of another, already connected wrapper for the same skill."""
+        self.session = shared.session
+        self.tools_cache = shared.tools_cache
+        self.side_effect_tools |= shared.side_effect_tools
+        self.idempotent_tools |= shared.idempotent_tools
+        self.connect_time = 0.0
+        self.shared_from = shared
+
+    @asynccontextmanager
+    async def _connect(self):
+        """Open the read/write streams to the skill's server.
+
+        "inprocess" skills are imported and served over in-memory streams;
+        if the import fails the skill falls back to a stdio subprocess.
+        """
+        from mcp import StdioServerParameters
+        from mcp.client.stdio import stdio_client
+        from mcp.shared.memory import create_client_server_memory_streams
+
+        if self.config.transport == "inprocess":
+            try:
+                if self.inprocess_server is None:
+                    self.inprocess_server = await asyncio.to_thread(load_inprocess_server, Path(self.config.args[0]))
+                server = self.inprocess_server
+            except Exception as e:
+                console.print(f"[yellow]Cannot load skill {self.config.name} in-process ({e}); using stdio.[/]")
+            else:
+                async with create_client_server_memory_streams() as (client_streams, server_streams):
+                    async with anyio.create_task_group() as tg:
+                        tg.start_soon(lambda: server.run(*server_streams, server.create_initialization_options()))
+                        try:
+                            yield client_streams
+                        finally:
+                            tg.cancel_scope.cancel()
+                return
+
+        params = StdioServerParameters(
+            command=self.config.command,
+            args=self.config.args,
+            env=self.config.env
+        )
+        async with stdio_client(params) as (read, write):
+            yield read, write
+
+    async def _serve(self, ready: asyncio.Future):
+        """Own the MCP connection for its whole lifetime.
+
+        The transport has to be opened and closed by the same task, so the
+        connection lives here until close() sets `closing`.
+        """
+        from mcp import ClientSession
+
+        start = time.perf_counter()
+        try:
+            async with self._connect() as (read, write):
+                async with ClientSession(read, RequestIdRecorder(write)) as session:
+                    await session.initialize()
+
+                    # Cache tools immediately
+                    mcp_tools = await session.list_tools()
+                    self.tools_cache = []
+                    for tool in mcp_tools.tools:
+                        if tool.annotations and tool.annotations.destructiveHint:
+                            self.side_effect_tools.add(tool.name)
+                        if tool.annotations and tool.annotations.readOnlyHint and tool.annotations.idempotentHint:
+                            self.idempotent_tools.add(tool.name)
+                        self.tools_cache.append({
+                            "type": "function",
+                            "function": {
+                                "name": tool.name,
+                                "description": tool.description,
+                                "parameters": tool.inputSchema
+                            }
+                        })
+
+                    self.session = session
+                    self.connect_time = time.perf_counter() - start
+                    ready.set_result(None)
+
+                    await self.closing.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                self.crashed = True
+                self.last_error = str(e)
+                console.print(f"[red]Lost connection to skill {self.config.name}: {e}[/]")
+        finally:
+            self.session = None
+
     def get_loader_tool_def(self) -> Dict[str, Any]:
+        """The synthetic loader tool definition, computed once from SKILL.md"""
+        return self._loader_tool_def
+
+    def _build_loader_tool_def(self) -> Dict[str, Any]:
         """Generate the synthetic loader tool definition"""
         # Loading context logic (simplified)
         context = []
@@ -83,159 +1448,699 @@ class MCPSkillWrapper:
             }
         }
 
+class SkillServerPool:
+    """MCP server processes shared by several agent sessions in one event loop.
+
+    Only skills marked `shareable` (no per-session server state) are pooled;
+    each agent keeps its own loaded state and tool routing.
+    """
+
+    def __init__(self):
+        self.wrappers: Dict[str, MCPSkillWrapper] = {}
+
+    async def acquire(self, config: MCPSkillConfig) -> MCPSkillWrapper:
+        """Connected pool wrapper for a skill, starting its server on first use."""
+        wrapper = self.wrappers.get(config.name)
+        if wrapper is None:
+            wrapper = self.wrappers[config.name] = MCPSkillWrapper(config)
+        await wrapper.open()
+        return wrapper
+
+    async def close(self):
+        await asyncio.gather(*(wrapper.close() for wrapper in self.wrappers.values()))
+
+DEFAULT_LOG_DIR = Path(__file__).parent / "artifacts" / "logs"
+DEFAULT_TRACE_DIR = Path(__file__).parent / "artifacts" / "traces"
+
 class DeepSeekMCPAgent:
-    def __init__(self, api_key: str):
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url="https://api.deepseek.com",
-        )
+    def __init__(self, api_key: str, parallel_tool_calls: bool = True, max_context_tokens: int = 25000,
+                 tool_cache_size: int = 256, markdown_log: bool = True, render_mode: str = "live",
+                 server_pool: Optional[SkillServerPool] = None, idle_ttl: Optional[float] = 900.0,
+                 max_reconnects: int = 2, base_url: str = "https://api.deepseek.com",
+                 transport: Optional[TransportConfig] = None, skill_manifest: Optional[SkillManifest] = None,
+                 tool_top_k: Optional[int] = 12, preload_skills: bool = True,
+                 budget: Optional[BudgetConfig] = None, tool_timeout: Optional[float] = 120.0):
+        transport = transport or TransportConfig()
+        self.tracer = Tracer()
+        # The OpenAI client (and the SDK import) is created on the first request
+        self.transport = LLMTransport(None, transport, self.tracer,
+                                      on_attempt=lambda record: self._log("llm_attempt", "", **record),
+                                      client_factory=functools.partial(LLMTransport.build_client,
+                                                                       api_key, base_url, transport))
         self.messages = []
+        self.max_context_tokens = max_context_tokens # Condense history beyond this estimate
+        # Rolling summarization of old history
+        self.keep_last_messages = 10 # Never summarize the most recent messages (approx 5 turns)
+        self.summary_start_ratio = 0.6 # Start summarizing in the background at this share of the budget
+        self.summary_chunk_tokens = 4000 # Size of each summarized chunk
+        self.summary_fanout = 4 # Merge this many same-level summaries into one
+        self._summaries: List[Tuple[int, str]] = [] # (merge level, summary), oldest first
+        self._summary_msg: Optional[Dict[str, Any]] = None
+        self._summary_cache: Dict[str, str] = {}
+        self._summary_task: Optional[asyncio.Task] = None
+        self._pending_chunk: List[Any] = []
         self.skills: List[MCPSkillWrapper] = []
-        self.exit_stack = AsyncExitStack()
+        self.parallel_tool_calls = parallel_tool_calls
+        self.render_mode = render_mode # "live", "plain" or "none"; see StreamRenderer
+        # Receives {"type": ..., ...} events for streamed text and tool activity (service mode)
+        self.event_handler: Optional[Callable[[Dict[str, Any]], None]] = None
+        self.server_pool = server_pool # Shared servers for skills marked shareable
+        self.skill_manifest = skill_manifest # Cached SKILL.md metadata, see register_servers()
+        self.max_tool_iterations = 100
+        self.tool_timeout = tool_timeout # Default deadline per tool call, see _tool_deadline()
+        self._background_tasks: set = set()
+        # Session statistics
+        self.usage: Counter = Counter() # Token usage summed over all LLM requests
+        self.budget = BudgetGovernor(budget) # Per-turn and session cost accounting and limits
+        self.llm_metrics: List[Dict[str, Any]] = [] # Per-request TTFT, duration and prompt cache hits
+        self.tool_call_count = 0
+        self.skill_index: Dict[str, MCPSkillWrapper] = {}
+        # Tool name -> (owning skill, tool schema) for every connected skill
+        self.tool_index: Dict[str, Tuple[MCPSkillWrapper, Dict[str, Any]]] = {}
+        self.tool_conflicts: Dict[str, List[str]] = {}
+        self.prewarm_tasks: List[asyncio.Task] = []
+        self.load_order: List[str] = [] # Skill names in the order they were loaded
+        # Session lifecycle: idle servers are stopped after idle_ttl seconds and
+        # restarted on next use; broken connections are retried max_reconnects times
+        self.idle_ttl = idle_ttl
+        self.max_reconnects = max_reconnects
+        self._reaper_task: Optional[asyncio.Task] = None
+        # Bumped whenever the exposed tools may change; list_tools() rebuilds only then
+        self.tools_version = 0
+        self._tool_list: List[Dict[str, Any]] = []
+        self._tool_list_version = -1
+        # Relevance-ranked tool exposure: with more than tool_top_k loaded tools, only the
+        # best-ranked ones are sent each turn (see _select_tools); None sends them all
+        self.tool_top_k = tool_top_k
+        self.hidden_tools: set = set() # Loaded tools left out of requests this turn
+        self.tool_fallbacks = 0 # Times the model asked for a hidden or unknown tool
+        self.turn_number = 0
+        self._tool_last_used: Dict[str, int] = {} # Tool name -> turn_number of its last call
+        self._tool_ranker: Optional[BM25Index] = None
+        self._tool_ranker_names: Tuple[str, ...] = ()
+        # Skills predicted from the prompt are loaded before the first request of a turn
+        self.preload_skills = preload_skills
+        self.preload_min_score = 3.0 # See SkillPredictor; scores grow with the number of registered skills
+        self._skill_predictor: Optional[SkillPredictor] = None
+        self.tool_cache = ToolResultCache(max_entries=tool_cache_size) if tool_cache_size else None
+        # Tool results longer than this are stored out of line and previewed in the history
+        self.artifact_store = ArtifactStore(Path(__file__).parent / "artifacts" / "tool_results")
+        self.spill_threshold_chars = 8000
+        self.spill_preview_chars = (2000, 1000) # Head and tail kept in the message
         # Logging setup
-        self.log_dir = Path(__file__).parent / "artifacts" / "logs"
+        self.log_dir = DEFAULT_LOG_DIR
         self.log_dir.mkdir(parents=True, exist_ok=True)
         self.session_id = None
         self.jsonl_file = None
         self.md_file = None
-        self.jsonl_handle = None
+        self.markdown_log = markdown_log
+        self.logger: Optional[SessionLogger] = None
+        # Timing spans, written to <trace_dir>/<session>.jsonl once the session starts
+        self._trace_dir: Optional[Path] = None
+        self.trace_file = None
 
-    def _start_logging(self):
+    @property
+    def trace_dir(self) -> Path:
+        """artifacts/traces beside the default logs; <log_dir>/traces when log_dir is redirected."""
+        if self._trace_dir is not None:
+            return self._trace_dir
+        return DEFAULT_TRACE_DIR if self.log_dir == DEFAULT_LOG_DIR else self.log_dir / "traces"
+
+    @trace_dir.setter
+    def trace_dir(self, path: Path):
+        self._trace_dir = path
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        return self.transport.client
+
+    @property
+    def messages(self) -> MessageStore:
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages: List[Dict[str, Any]]):
+        self._messages = messages if isinstance(messages, MessageStore) else MessageStore(messages)
+
+    def _start_logging(self, session_id: Optional[str] = None):
         """Initialize logging for the session"""
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.session_id = f"session_{timestamp}"
+        self.session_id = session_id or f"session_{timestamp}"
         self.jsonl_file = self.log_dir / f"{self.session_id}.jsonl"
-        self.md_file = self.log_dir / f"{self.session_id}.md"
-        
-        self.jsonl_handle = open(self.jsonl_file, "a", encoding="utf-8")
-        
-        # Initialize MD file
-        with open(self.md_file, "w", encoding="utf-8") as f:
-            f.write(f"# Conversation Log: {self.session_id}\n\n")
+        # With markdown_log off, render the transcript later via render_markdown()
+        self.md_file = self.log_dir / f"{self.session_id}.md" if self.markdown_log else None
+        self.logger = SessionLogger(self.jsonl_file, self.md_file)
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        self.trace_file = self.trace_dir / f"{self.session_id}.jsonl"
+        self.tracer.sink = SessionLogger(self.trace_file)
 
     def _log(self, role: str, content: str, **kwargs):
-        """Log a message to both JSONL and Markdown"""
-        entry = {
+        """Queue a log entry for the JSONL log and Markdown transcript"""
+        if self.logger is None:
+            return # Logging starts with the chat loop
+
+        self.logger.log({
             "timestamp": datetime.datetime.now().isoformat(),
             "role": role,
             "content": content,
             **kwargs
-        }
-        
-        # JSONL
-        if self.jsonl_handle:
-            self.jsonl_handle.write(json.dumps(entry, ensure_ascii=False) + "\n")
-            self.jsonl_handle.flush()
-            
-        # Markdown
-        with open(self.md_file, "a", encoding="utf-8") as f:
-            if role == "system":
-                f.write(f"## System Prompt\n\n{content}\n\n")
-            elif role == "user":
-                f.write(f"## User\n\n{content}\n\n")
-            elif role == "assistant":
-                reasoning = kwargs.get("reasoning_content", "")
-                if reasoning:
-                     f.write(f"### Reasoning\n> {reasoning.replace(chr(10), chr(10)+'> ')}\n\n")
-                f.write(f"## Assistant\n\n{content}\n\n")
-            elif role == "tool_call":
-                tool_name = kwargs.get("tool_name")
-                args = kwargs.get("arguments")
-                f.write(f"### Tool Call: `{tool_name}`\n\nArguments:\n```json\n{args}\n```\n\n")
-            elif role == "tool_result":
-                tool_name = kwargs.get("tool_name")
-                f.write(f"### Tool Output ({tool_name})\n\n```\n{content}\n```\n\n")
-
-    def add_server(self, name: str, skill_md_path: Path, command: str, args: List[str], env: Dict[str, str] = None):
+        })
+
+    def _emit(self, event_type: str, **data):
+        if self.event_handler is not None:
+            self.event_handler({"type": event_type, **data})
+
+    def add_server(self, name: str, skill_md_path: Path, command: str, args: List[str], env: Dict[str, str] = None,
+                   shareable: bool = False, transport: str = "stdio", tool_timeout: Optional[float] = None,
+                   tool_timeouts: Dict[str, float] = None):
         """Register a server/skill."""
-        config = MCPSkillConfig(name, command, args, skill_md_path, env)
-        wrapper = MCPSkillWrapper(config)
+        config = MCPSkillConfig(name, command, args, skill_md_path, env, shareable=shareable, transport=transport,
+                                tool_timeout=tool_timeout, tool_timeouts=tool_timeouts)
+        wrapper = MCPSkillWrapper(config, self.skill_manifest)
         self.skills.append(wrapper)
+        self.skill_index[name] = wrapper
+        self.tools_version += 1
 
     async def connect_server(self, wrapper: MCPSkillWrapper):
         """Connect to a specific skill's MCP server."""
         if wrapper.session: return # Already connected
 
-        params = StdioServerParameters(
-            command=wrapper.config.command,
-            args=wrapper.config.args,
-            env=wrapper.config.env
-        )
-        
-        try:
-            read, write = await self.exit_stack.enter_async_context(stdio_client(params))
-            session = await self.exit_stack.enter_async_context(ClientSession(read, write))
-            await session.initialize()
-            wrapper.session = session
-            console.print(f"[green]Connected to MCP skill: {wrapper.config.name}[/]")
-            
-            # Cache tools immediately
-            mcp_tools = await session.list_tools()
-            for tool in mcp_tools.tools:
-                 tool_def = {
-                    "type": "function",
-                    "function": {
-                        "name": tool.name,
-                        "description": tool.description,
-                        "parameters": tool.inputSchema
-                    }
-                }
-                 wrapper.tools_cache.append(tool_def)
-                 
-        except Exception as e:
-            console.print(f"[red]Failed to connect to skill {wrapper.config.name}: {e}[/]")
+        with self.tracer.span("skill.connect", skill=wrapper.config.name) as span:
+            try:
+                if self.server_pool is not None and wrapper.config.shareable:
+                    wrapper.attach(await self.server_pool.acquire(wrapper.config))
+                else:
+                    await wrapper.open()
+            except Exception as e:
+                span.status = "error"
+                span.set(error=str(e))
+                console.print(f"[red]Failed to connect to skill {wrapper.config.name}: {e}[/]")
+                return
+            span.set(shared=bool(wrapper.shared_from), spawn_s=round(wrapper.connect_time, 3))
 
-    async def list_tools(self) -> List[Dict[str, Any]]:
-        """Query tools based on loading state."""
-        combined_tools = []
-        
+        if wrapper.session is None:
+            return # Closed again while we were waiting
+        if wrapper.crashed:
+            wrapper.crashed = False
+            wrapper.restart_count += 1
+        wrapper.last_used = time.monotonic()
+        if self.idle_ttl and self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._evict_idle_servers())
+        self._register_tools(wrapper)
+        shared = " (shared)" if wrapper.shared_from else ""
+        console.print(f"[green]Connected to MCP skill: {wrapper.config.name}{shared} ({wrapper.connect_time:.2f}s)[/]")
+        self._log("skill_connect", "", skill=wrapper.config.name, seconds=round(wrapper.connect_time, 3),
+                  shared=bool(wrapper.shared_from))
+
+    async def disconnect_server(self, wrapper: MCPSkillWrapper):
+        """Shut down a skill's MCP server and drop its tools from the routing table."""
+        await wrapper.close()
+        self._unregister_tools(wrapper)
+
+    async def _evict_idle_servers(self):
+        """Stop servers unused for idle_ttl seconds; their tools stay routable and reconnect on demand."""
+        interval = max(0.1, min(self.idle_ttl / 2, 30.0))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for skill in self.skills:
+                if (skill.session and skill.shared_from is None and skill.in_flight == 0
+                        and now - skill.last_used > self.idle_ttl):
+                    console.print(f"[dim]Stopping idle skill server: {skill.config.name}[/]")
+                    skill.evictions += 1
+                    await skill.close()
+                    self._log("skill_evict", "", skill=skill.config.name, idle_s=round(now - skill.last_used, 1))
+
+    @staticmethod
+    def _is_connection_error(skill: MCPSkillWrapper, error: Exception) -> bool:
+        """Whether a failed call means the server connection is gone (vs. a tool error)."""
+        from mcp.shared.exceptions import McpError
+        from mcp.types import CONNECTION_CLOSED
+
+        if isinstance(error, (anyio.ClosedResourceError, anyio.BrokenResourceError, BrokenPipeError,
+                              ConnectionError, EOFError)):
+            return True
+        if isinstance(error, McpError) and error.error.code == CONNECTION_CLOSED:
+            return True
+        owner = skill.shared_from or skill
+        return skill.session is None or (owner.session_task is not None and owner.session_task.done())
+
+    def _tool_deadline(self, skill: MCPSkillWrapper, tool_name: str) -> Optional[float]:
+        """Seconds a call may take: the skill's per-tool setting, TOOL_TIMEOUTS, the skill's, then the agent's."""
+        for deadline in ((skill.config.tool_timeouts or {}).get(tool_name), TOOL_TIMEOUTS.get(tool_name),
+                         skill.config.tool_timeout):
+            if deadline is not None:
+                return deadline
+        return self.tool_timeout
+
+    def _cancel_mcp_request(self, session: "ClientSession", request_id: int, reason: str):
+        """Tell the server to stop working on a request nobody waits for any more."""
+        from mcp import types
+
+        notification = types.ClientNotification(types.CancelledNotification(
+            params=types.CancelledNotificationParams(requestId=request_id, reason=reason)))
+
+        async def send():
+            try:
+                await session.send_notification(notification)
+            except Exception:
+                pass # The connection is gone, and the request with it
+
+        # A task of its own, so it is sent even while the caller is being cancelled
+        task = asyncio.create_task(send())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _call_mcp_tool(self, skill: MCPSkillWrapper, tool_name: str, arguments: Dict[str, Any]):
+        """Call a tool on the skill's server, reconnecting after an eviction or crash.
+
+        Side-effect tools are not retried after a lost connection, since the
+        first attempt may already have taken effect. A call that misses its
+        deadline, or whose caller is cancelled, is cancelled on the server too.
+        """
+        from mcp.shared.exceptions import McpError
+
+        deadline = self._tool_deadline(skill, tool_name)
+        for attempt in range(self.max_reconnects + 1):
+            if not skill.session:
+                await self.connect_server(skill)
+                if not skill.session:
+                    raise ConnectionError(f"skill {skill.config.name} is not connected")
+
+            session = skill.session
+            sent = []
+            sent_token = _sent_request_ids.set(sent)
+            skill.in_flight += 1
+            skill.calls += 1
+            try:
+                with self.tracer.span("mcp.round_trip", skill=skill.config.name, tool=tool_name, attempt=attempt):
+                    return await session.call_tool(
+                        tool_name, arguments,
+                        read_timeout_seconds=datetime.timedelta(seconds=deadline) if deadline else None,
+                    )
+            except asyncio.CancelledError:
+                if sent:
+                    self._cancel_mcp_request(session, sent[0], "cancelled by the client")
+                raise
+            except Exception as e:
+                skill.errors += 1
+                skill.last_error = str(e)
+                if isinstance(e, McpError) and e.error.code == 408 and sent: # Request timeout
+                    self._cancel_mcp_request(session, sent[0], f"no result within {deadline}s")
+                    raise ToolTimeout(f"{tool_name} did not finish within {deadline:g}s and was cancelled") from e
+                if not self._is_connection_error(skill, e):
+                    raise
+                skill.crashed = True
+                console.print(f"[yellow]Connection to skill {skill.config.name} lost ({e!r}); restarting.[/]")
+                await skill.close()
+                if tool_name in skill.side_effect_tools:
+                    raise ConnectionError(f"skill server restarted; {tool_name} may or may not have completed") from e
+                if attempt == self.max_reconnects:
+                    raise
+            finally:
+                _sent_request_ids.reset(sent_token)
+                skill.in_flight -= 1
+                skill.last_used = time.monotonic()
+
+    def skill_health(self) -> Dict[str, Dict[str, Any]]:
+        """Per-skill connection state, usage and restart counts."""
+        now = time.monotonic()
+        health = {}
         for skill in self.skills:
-            if not skill.loaded:
-                # 1. Not loaded: Show Loader Tool only
-                combined_tools.append(skill.get_loader_tool_def())
+            if skill.session:
+                status = "connected"
+            elif skill.crashed:
+                status = "crashed"
+            elif skill.evictions and skill.loaded:
+                status = "evicted"
             else:
-                # 2. Loaded: Show actual tools
-                # Ensure connected
-                if not skill.session:
-                    await self.connect_server(skill)
-                combined_tools.extend(skill.tools_cache)
-                
+                status = "disconnected"
+            health[skill.config.name] = {
+                "status": status,
+                "loaded": skill.loaded,
+                "shared": bool(skill.shared_from),
+                "idle_s": round(now - skill.last_used, 1) if skill.last_used else None,
+                "calls": skill.calls,
+                "errors": skill.errors,
+                "restarts": skill.restart_count,
+                "evictions": skill.evictions,
+                "connect_time_s": skill.connect_time,
+                "last_error": skill.last_error,
+            }
+        return health
+
+    def frequent_skills(self, limit: int = 3, max_sessions: int = 50) -> List[str]:
+        """Skills most often loaded in recent session logs, most frequent first."""
+        counts = Counter()
+        for log_file in sorted(self.log_dir.glob("session_*.jsonl"))[-max_sessions:]:
+            try:
+                with open(log_file, encoding="utf-8") as f:
+                    for line in f:
+                        if '"tool_call"' not in line:
+                            continue
+                        entry = json.loads(line)
+                        tool_name = entry.get("tool_name") or ""
+                        if entry.get("role") == "tool_call" and tool_name.startswith("skill_"):
+                            counts[tool_name[len("skill_"):]] += 1
+            except (OSError, json.JSONDecodeError):
+                continue
+        return [name for name, _ in counts.most_common() if name in self.skill_index][:limit]
+
+    def prewarm(self, skill_names: Optional[List[str]] = None, limit: int = 3) -> List[str]:
+        """Start skill servers concurrently in the background.
+
+        Servers are connected but not loaded: their tools stay hidden until the
+        model calls the loader, which then returns without waiting for a spawn.
+        Without explicit names, the skills most used in past sessions are warmed.
+        Must be called from a running event loop.
+        """
+        if skill_names is None:
+            skill_names = self.frequent_skills(limit)
+        names = [name for name in skill_names if name in self.skill_index]
+        for name in names:
+            self.prewarm_tasks.append(asyncio.create_task(self.connect_server(self.skill_index[name])))
+        return names
+
+    @property
+    def connect_metrics(self) -> Dict[str, float]:
+        """Seconds each connected skill spent spawning and initializing."""
+        return {skill.config.name: skill.connect_time for skill in self.skills if skill.connect_time is not None}
+
+    def _register_tools(self, wrapper: MCPSkillWrapper):
+        """Add a connected skill's tools to the routing table, reporting name collisions."""
+        self.tools_version += 1
+        for tool_def in wrapper.tools_cache:
+            name = tool_def["function"]["name"]
+            owner = self.tool_index.get(name)
+            if owner and owner[0] is not wrapper:
+                providers = self.tool_conflicts.setdefault(name, [owner[0].config.name])
+                if wrapper.config.name not in providers:
+                    providers.append(wrapper.config.name)
+                console.print(f"[yellow]Tool '{name}' is provided by several skills ({', '.join(providers)}); routing to {owner[0].config.name}[/]")
+                continue
+            self.tool_index[name] = (wrapper, tool_def)
+
+    def _unregister_tools(self, wrapper: MCPSkillWrapper):
+        """Remove a skill's tools from the routing table."""
+        self.tools_version += 1
+        removed = [name for name, (owner, _) in self.tool_index.items() if owner is wrapper]
+        for name in removed:
+            del self.tool_index[name]
+
+        # Hand colliding names over to another connected provider
+        for name in removed:
+            for skill in self.skills:
+                if skill is wrapper or not skill.session or name in self.tool_index:
+                    continue
+                for tool_def in skill.tools_cache:
+                    if tool_def["function"]["name"] == name:
+                        self.tool_index[name] = (skill, tool_def)
+                        break
+
+    async def list_tools(self) -> List[Dict[str, Any]]:
+        """Query tools based on loading state.
+
+        The list only ever grows within a session so that the serialized
+        request prefix stays byte-stable for server-side prompt caching:
+        every loader tool comes first (sorted by skill name, and kept after
+        loading), followed by each loaded skill's tools in load order.
+        """
+        if self._tool_list_version == self.tools_version:
+            return self._tool_list
+
+        # 1. Built-in and Loader Tools, always present
+        combined_tools = [READ_TOOL_RESULT_TOOL]
+        combined_tools += [skill.get_loader_tool_def() for skill in sorted(self.skills, key=lambda s: s.config.name)]
+
+        # 2. Loaded: Show actual tools, minus those deselected for this turn
+        loaded = [self.skill_index[name] for name in self.load_order if self.skill_index[name].loaded]
+        loaded += sorted((s for s in self.skills if s.loaded and s not in loaded), key=lambda s: s.config.name)
+        for skill in loaded:
+            for tool_def in sorted(skill.tools_cache, key=lambda t: t["function"]["name"]):
+                owner = self.tool_index.get(tool_def["function"]["name"])
+                if owner and owner[0] is skill and tool_def["function"]["name"] not in self.hidden_tools:
+                    combined_tools.append(tool_def)
+
+        self._tool_list = combined_tools
+        self._tool_list_version = self.tools_version
         return combined_tools
 
+    def _recent_tool_calls(self) -> set:
+        """Names of the tools called during the previous turn."""
+        names = set()
+        for message in reversed(self.messages[:-1]): # Skip the new user message
+            if message.get("role") == "user":
+                break
+            for tc in message.get("tool_calls") or []:
+                names.add(tc["function"]["name"])
+        return names
+
+    def _select_tools(self, user_input: str, pinned: List[MCPSkillWrapper] = ()):
+        """Choose which loaded tools to send with this turn's requests.
+
+        Tools are ranked by BM25 of their name, description and parameters
+        against the recent conversation, plus a bonus that halves with every
+        turn since their last use. The top `tool_top_k` are exposed together
+        with the tools called in the previous turn and any named in the prompt.
+        The selection holds for the whole turn, and carries over while it
+        still covers the new ranking, so the request prefix stays cacheable.
+        """
+        loaded = [name for name, (skill, _) in self.tool_index.items() if skill.loaded]
+        hidden = set()
+        if self.tool_top_k and len(loaded) > self.tool_top_k:
+            names = tuple(self.tool_index)
+            if self._tool_ranker is None or self._tool_ranker_names != names:
+                self._tool_ranker = BM25Index({
+                    name: " ".join([name, name, tool_def["function"].get("description") or "",
+                                    " ".join((tool_def["function"].get("parameters") or {}).get("properties", {}))])
+                    for name, (_, tool_def) in self.tool_index.items()
+                })
+                self._tool_ranker_names = names
+            recent = [m for m in self.messages[-6:] if m.get("role") in ("user", "assistant")]
+            query = " ".join(str(m.get("content") or "")[:2000] for m in recent)
+            scores = self._tool_ranker.scores(query + " " + user_input)
+            best = max(scores.values(), default=0.0) or 1.0
+
+            def score(name: str) -> float:
+                last_used = self._tool_last_used.get(name)
+                recency = 0.5 ** (self.turn_number - last_used) if last_used is not None else 0.0
+                return scores.get(name, 0.0) / best + recency
+
+            keep = set(sorted(loaded, key=score, reverse=True)[:self.tool_top_k])
+            keep |= self._recent_tool_calls() | {name for name in loaded if name in user_input}
+            keep |= {name for name, (skill, _) in self.tool_index.items() if skill in pinned}
+            visible = set(loaded) - self.hidden_tools
+            if keep <= visible and len(visible) <= 2 * self.tool_top_k:
+                keep = visible
+            hidden = set(loaded) - keep
+        if hidden != self.hidden_tools:
+            self.hidden_tools = hidden
+            self.tools_version += 1
+        if loaded:
+            self._log("tool_selection", "", loaded=len(loaded), exposed=len(loaded) - len(hidden))
+
+    def _predict_skills(self, user_input: str) -> List[str]:
+        """Names of the skills the prompt likely needs, see SkillPredictor."""
+        if self._skill_predictor is None:
+            tool_skills = {tool: skill.config.name for skill in self.skills
+                           for tool in _allowed_tools(skill._full_instructions)}
+            tool_skills.update({name: skill.config.name for name, (skill, _) in self.tool_index.items()})
+            history = SkillPredictor.history_from_logs(sorted(self.log_dir.glob("session_*.jsonl"))[-50:], tool_skills)
+            self._skill_predictor = SkillPredictor(
+                {skill.config.name: skill._full_instructions for skill in self.skills}, history,
+                min_score=self.preload_min_score)
+        return self._skill_predictor.predict(user_input)
+
+    async def _preload_skills(self, user_input: str) -> List[MCPSkillWrapper]:
+        """Load the skills predicted for this prompt, saving the model a loader round trip each."""
+        names = self._predict_skills(user_input) if self.preload_skills and self.skills else []
+        skills = [self.skill_index[name] for name in names if name in self.skill_index]
+        skills = [skill for skill in skills if not skill.loaded]
+        if not skills:
+            return []
+        with self.tracer.span("skill.preload", skills=[skill.config.name for skill in skills]):
+            await asyncio.gather(*(self.connect_server(skill) for skill in skills))
+        skills = [skill for skill in skills if skill.session]
+        for skill in skills:
+            self._mark_loaded(skill)
+        return skills
+
+    def _show_tools(self, requested: str, names: Optional[set] = None):
+        """Fallback: expose hidden tools (all of them by default) for the rest of the turn."""
+        names = self.hidden_tools if names is None else names & self.hidden_tools
+        if not names:
+            return
+        self.hidden_tools = self.hidden_tools - names
+        self.tools_version += 1
+        self.tool_fallbacks += 1
+        self._log("tool_fallback", "", tool_name=requested, restored=sorted(names))
+
+    def _mark_loaded(self, skill: MCPSkillWrapper):
+        """Expose a skill's tools from the next request on."""
+        if not skill.loaded:
+            self.tools_version += 1
+        skill.loaded = True
+        if skill.config.name not in self.load_order:
+            self.load_order.append(skill.config.name)
+
+    def _find_tool_owner(self, tool_name: str) -> Optional[MCPSkillWrapper]:
+        """Return the loaded skill that provides an MCP tool."""
+        entry = self.tool_index.get(tool_name)
+        if entry and entry[0].loaded:
+            return entry[0]
+        return None
+
+    def _has_side_effects(self, tool_name: str) -> bool:
+        """Whether a tool call must run on its own instead of alongside others."""
+        if tool_name.startswith("skill_"):
+            return False
+        skill = self._find_tool_owner(tool_name)
+        if skill is None:
+            return tool_name in SIDE_EFFECT_TOOLS
+        return tool_name in skill.side_effect_tools
+
+    async def _run_tool_call(self, tc: Dict[str, Any]) -> str:
+        """Execute a single streamed tool call, honouring the owning skill's concurrency limit."""
+        fn_name = tc["function"]["name"]
+        try:
+            fn_args = json.loads(tc["function"]["arguments"] or "{}")
+            skill = None if fn_name.startswith("skill_") else self._find_tool_owner(fn_name)
+            if skill is None:
+                return await self.call_tool(fn_name, fn_args)
+            async with skill.semaphore:
+                return await self.call_tool(fn_name, fn_args)
+        except Exception as e:
+            return f"Error: {str(e)}"
+
+    async def execute_tool_calls(self, tool_calls: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], str]]:
+        """Execute the tool calls of one assistant message.
+
+        Skill loaders run first, since the other calls may use the tools they
+        register. Independent calls then run concurrently; a call to a tool
+        with side effects waits for everything before it and runs alone.
+        Results are returned in the order of the original tool calls.
+        """
+        results: Dict[str, str] = {}
+
+        async def run(tc):
+            results[tc["id"]] = await self._run_tool_call(tc)
+
+        loaders = [tc for tc in tool_calls if tc["function"]["name"].startswith("skill_")]
+        await asyncio.gather(*(run(tc) for tc in loaders))
+
+        batch = []
+        for tc in tool_calls:
+            if tc["id"] in results:
+                continue
+            if self.parallel_tool_calls and not self._has_side_effects(tc["function"]["name"]):
+                batch.append(run(tc))
+                continue
+            if batch:
+                await asyncio.gather(*batch)
+                batch = []
+            await run(tc)
+        if batch:
+            await asyncio.gather(*batch)
+
+        return [(tc, results[tc["id"]]) for tc in tool_calls]
+
     async def call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> str:
-        """Execute tool (Loader or MCP)."""
+        """Execute tool (Built-in, Loader or MCP)."""
+        self._tool_last_used[tool_name] = self.turn_number
+        with self.tracer.span("tool.call", tool=tool_name) as span:
+            result = await self._call_tool(tool_name, arguments)
+            if result.startswith("Error"):
+                span.status = "error"
+            span.set(result_chars=len(result))
+            return result
+
+    async def _call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> str:
+        if tool_name == "read_tool_result":
+            return self._read_tool_result(**arguments)
         
         # 1. Check for Loader Tools
         if tool_name.startswith("skill_"):
-            skill_name = tool_name.replace("skill_", "")
-            for skill in self.skills:
-                if skill.config.name == skill_name:
-                    # Execute Loading Logic
-                    skill.loaded = True
-                    await self.connect_server(skill) # Connect eagerly
-                    return skill._full_instructions
-            return f"Error: Skill '{skill_name}' not found."
+            skill_name = tool_name[len("skill_"):]
+            skill = self.skill_index.get(skill_name)
+            if skill is None:
+                return f"Error: Skill '{skill_name}' not found."
+            # Execute Loading Logic; reloading a skill brings back its deselected tools
+            if skill.loaded:
+                self._show_tools(tool_name, {name for name, (owner, _) in self.tool_index.items() if owner is skill})
+            self._mark_loaded(skill)
+            await self.connect_server(skill) # Connect eagerly
+            return skill._full_instructions
 
         # 2. Check for MCP Tools
-        for skill in self.skills:
-            if skill.loaded and skill.session:
-                # Check if this skill owns the tool
-                # Simple check: name match
-                for t in skill.tools_cache:
-                    if t["function"]["name"] == tool_name:
-                         try:
-                            console.print(f"[cyan]{skill.config.name}::{tool_name}({arguments})[/]")
-                            call_result = await skill.session.call_tool(tool_name, arguments)
-                            text_content = []
-                            for content in call_result.content:
-                                if content.type == "text":
-                                    text_content.append(content.text)
-                            return "\n".join(text_content)
-                         except Exception as e:
-                            return f"Error executing {tool_name}: {e}"
+        if tool_name in self.hidden_tools:
+            self._show_tools(tool_name)
+        entry = self.tool_index.get(tool_name)
+        if entry:
+            skill, _ = entry
+            if skill.loaded:
+                cacheable = self.tool_cache is not None and tool_name in skill.idempotent_tools
+                if cacheable:
+                    cached = self.tool_cache.get(tool_name, arguments)
+                    self.tracer.annotate(skill=skill.config.name, cached=cached is not None)
+                    if cached is not None:
+                        console.print(f"[cyan]{skill.config.name}::{tool_name}({arguments}) (cached)[/]")
+                        return cached
+                self.tracer.annotate(skill=skill.config.name)
+                try:
+                    console.print(f"[cyan]{skill.config.name}::{tool_name}({arguments})[/]")
+                    call_result = await self._call_mcp_tool(skill, tool_name, arguments)
+                    text_content = []
+                    for content in call_result.content:
+                        if content.type == "text":
+                            text_content.append(content.text)
+                    result = "\n".join(text_content)
+                except Exception as e:
+                    return f"Error executing {tool_name}: {e}"
+                finally:
+                    if self.tool_cache is not None and tool_name in skill.side_effect_tools:
+                        self.tool_cache.invalidate(_argument_paths(arguments))
+
+                if cacheable and not call_result.isError and not result.startswith("Error"):
+                    self.tool_cache.put(tool_name, arguments, result)
+                return result
         
+        if self.hidden_tools:
+            self._show_tools(tool_name)
+            return f"Error: Tool '{tool_name}' not found. Every loaded tool is now available; check the tool list."
         return f"Error: Tool '{tool_name}' not found or skill not loaded."
 
+    def _spill_large_result(self, tool_name: str, result: str) -> Tuple[str, Optional[str]]:
+        """Store a large tool result out of line.
+
+        Returns the message content (the result itself, or a head/tail preview
+        with a handle for read_tool_result) and the handle, if stored.
+        """
+        if len(result) <= self.spill_threshold_chars or tool_name == "read_tool_result":
+            return result, None
+        handle = self.artifact_store.put(result)
+        head, tail = self.spill_preview_chars
+        preview = (
+            f"[Large result from {tool_name}: {len(result)} chars stored as handle \"{handle}\". "
+            f"Showing the first {head} and last {tail} chars; call read_tool_result(handle=\"{handle}\", "
+            f"offset={head}) to read the rest.]\n"
+            f"{result[:head]}\n"
+            f"[... {len(result) - head - tail} chars omitted ...]\n"
+            f"{result[-tail:]}"
+        )
+        return preview, handle
+
+    def _read_tool_result(self, handle: str, offset: int = 0, length: int = 8000) -> str:
+        """Built-in tool: one page of a stored tool result."""
+        text = self.artifact_store.read(str(handle))
+        if text is None:
+            return f"Error: No stored result with handle '{handle}'."
+        offset = max(0, int(offset))
+        length = max(1, min(int(length), self.spill_threshold_chars))
+        end = min(offset + length, len(text))
+        footer = f"\n[chars {offset}-{end} of {len(text)}"
+        footer += f"; next offset={end}]" if end < len(text) else "; end of result]"
+        return text[offset:end] + footer
+
     async def send_llm_request(
         self,
         prompt: str,
@@ -260,88 +2165,173 @@ class DeepSeekMCPAgent:
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": prompt})
         
-        reasoning_storage = ""
-        full_content = ""
-        
-        stream = self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=tools if tools else None,
-            stream=True
-        )
-        
-        for chunk in stream:
-            # Handle reasoning
-            if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'reasoning_content'):
-                reasoning = chunk.choices[0].delta.reasoning_content
-                if reasoning:
-                    reasoning_storage += reasoning
-            # Handle content
-            if chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_content += content_chunk
-        
+        request = {"model": model, "messages": messages, "tools": tools if tools else None, "stream": True,
+                   "stream_options": {"include_usage": True}}
+
+        async def consume(chunks, request_start):
+            reasoning_storage = ""
+            full_content = ""
+            usage = None
+            async for chunk in chunks:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue # The usage chunk
+                # Handle reasoning
+                if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'reasoning_content'):
+                    reasoning = chunk.choices[0].delta.reasoning_content
+                    if reasoning:
+                        reasoning_storage += reasoning
+                # Handle content
+                if chunk.choices[0].delta.content:
+                    content_chunk = chunk.choices[0].delta.content
+                    full_content += content_chunk
+            return full_content, usage
+
+        full_content, usage = await self.transport.run(request, consume)
+        if usage:
+            self._record_usage(usage, model)
+
         # If there's reasoning content, we could optionally log it, but ignore for now.
         return full_content
 
+    def _history_start(self) -> Tuple[int, bool]:
+        """Index of the first summarizable message, and whether the running summary precedes it."""
+        start = 1 if self.messages and _message_field(self.messages[0], "role") == "system" else 0
+        if self._summary_msg is not None and len(self.messages) > start and self.messages[start] is self._summary_msg:
+            return start + 1, True
+        return start, False
+
+    def _next_summary_chunk(self) -> List[Any]:
+        """Oldest messages worth about `summary_chunk_tokens`, ending right before an assistant message.
+
+        The summary is injected as a user message, so the first kept message
+        must answer it: cutting before a tool result or another user message
+        would leave the history invalid for the API.
+        """
+        start, _ = self._history_start()
+        chunk_end = None
+        tokens = 0
+        for i in range(start, len(self.messages) - self.keep_last_messages):
+            tokens += estimate_tokens(_message_text(self.messages[i]))
+            if _message_field(self.messages[i + 1], "role") != "assistant":
+                continue
+            chunk_end = i + 1
+            if tokens >= self.summary_chunk_tokens:
+                break
+        return list(self.messages[start:chunk_end]) if chunk_end else []
+
+    async def _cached_summary(self, prompt: str) -> str:
+        """Summarize with deepseek-chat; identical prompts are only ever sent once."""
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if key not in self._summary_cache:
+            self._summary_cache[key] = await self.send_llm_request(prompt, model="deepseek-chat")
+        return self._summary_cache[key]
+
+    async def _summarize_chunk(self, chunk: List[Any], summaries: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+        """Summarize one chunk and fold it into the hierarchy of (level, summary) entries."""
+        lines = []
+        for msg in chunk:
+            content = str(_message_field(msg, "content") or "")
+            if len(content) > SUMMARY_MESSAGE_CHARS:
+                content = content[:SUMMARY_MESSAGE_CHARS] + " ...[truncated]"
+            tool_names = [tc["function"]["name"] if isinstance(tc, dict) else tc.function.name
+                          for tc in _message_field(msg, "tool_calls") or []]
+            if tool_names:
+                content += f" [called: {', '.join(tool_names)}]"
+            lines.append(f"{_message_field(msg, 'role')}: {content}")
+
+        summary = await self._cached_summary(
+            "Summarize the following interaction history concisely, focusing on completed actions, "
+            "key findings, and current state. Ignore minor details.\n\n" + "\n".join(lines)
+        )
+        summaries = summaries + [(0, summary)]
+
+        # Merge the newest `summary_fanout` summaries whenever they share a level
+        fanout = self.summary_fanout
+        while len(summaries) >= fanout and len({level for level, _ in summaries[-fanout:]}) == 1:
+            level = summaries[-1][0]
+            merged = await self._cached_summary(
+                "Merge the following summaries of consecutive parts of one conversation into a single "
+                "concise summary, keeping completed actions, key findings, and current state.\n\n"
+                + "\n\n".join(text for _, text in summaries[-fanout:])
+            )
+            summaries = summaries[:-fanout] + [(level + 1, merged)]
+        return summaries
+
+    def _schedule_summary(self) -> bool:
+        """Start summarizing the oldest chunk in the background."""
+        chunk = self._next_summary_chunk()
+        if not chunk:
+            return False
+        self._pending_chunk = chunk
+        self._summary_task = asyncio.create_task(self._summarize_chunk(chunk, list(self._summaries)))
+        return True
+
+    def _apply_summary(self) -> bool:
+        """Replace the summarized chunk with the updated running summary."""
+        task, chunk = self._summary_task, self._pending_chunk
+        self._summary_task, self._pending_chunk = None, []
+        try:
+            summaries = task.result()
+        except Exception as e:
+            console.print(f"[red]Condensing failed: {e}[/]")
+            return False
+
+        start, has_summary = self._history_start()
+        current = self.messages[start:start + len(chunk)]
+        if len(current) != len(chunk) or any(a is not b for a, b in zip(current, chunk)):
+            return False # History was rewritten meanwhile; the chunk is stale
+
+        self._summaries = summaries
+        self._summary_msg = {
+            "role": "user", # Using user role for summary injection to avoid confusion
+            "content": "## Previous Conversation Summary\n"
+                       + "\n\n".join(text for _, text in summaries)
+                       + "\n\n(Resume task based on this summary)"
+        }
+        self.messages[start - 1 if has_summary else start:start + len(chunk)] = [self._summary_msg]
+        console.print(f"[green]Context condensed: {len(chunk)} messages folded into the summary.[/]")
+        return True
+
     async def _condense_context(self):
-        """Condense message history if it exceeds limit."""
-        LIMIT = 100000
-        KEEP_LAST = 10 # Keep last 10 messages (approx 5 turns)
-        
-        total_chars = sum(len(str(m.get("content", ""))) + len(str(m.get("reasoning_content", ""))) for m in self.messages)
-        
-        if total_chars > LIMIT and len(self.messages) > KEEP_LAST + 2:
-            console.print(f"[yellow]Context length ({total_chars}) exceeds limit. Condensing...[/]")
-            
-            # Keep system prompt (index 0)
-            system_prompt = self.messages[0]
-            
-            # Messages to summarize
-            to_summarize = self.messages[1:-KEEP_LAST]
-            to_keep = self.messages[-KEEP_LAST:]
-            
-            # Create summarization text
-            text_block = ""
-            for msg in to_summarize:
-                role = msg.get("role")
-                content = msg.get("content", "")
-                text_block += f"{role}: {content}\n"
-                
-            summary_prompt = f"Summarize the following interaction history concisely, focusing on completed actions, key findings, and current state. Ignore minor details.\n\n{text_block}"
-            
-            try:
-                # Use a lightweight request for summarization
-                summary = await self.send_llm_request(summary_prompt, model="deepseek-chat") 
-            except Exception as e:
-                console.print(f"[red]Condensing failed: {e}[/]")
-                return
+        """Keep message history within the token budget.
 
-            summary_msg = {
-                "role": "user", # Using user role for summary injection to avoid confusion
-                "content": f"## Previous Conversation Summary\n{summary}\n\n(Resume task based on this summary)"
-            }
-            
-            self.messages = [system_prompt, summary_msg] + to_keep
-            console.print("[green]Context condensed successfully.[/]")
+        Past `summary_start_ratio` of the budget, the oldest messages are
+        summarized chunk by chunk in the background and swapped for a running
+        summary once ready. Only when the hard budget is exceeded does the
+        turn wait, and then only for bounded chunk summaries.
+        """
+        if self._summary_task and self._summary_task.done():
+            self._apply_summary()
 
-    async def chat_loop(self):
-        self._start_logging()
-        # Initial System Prompt Construction
+        budget = self.max_context_tokens
+        if self._summary_task is None and self.messages.total_tokens > budget * self.summary_start_ratio:
+            self._schedule_summary()
+
+        while self.messages.total_tokens > budget:
+            if self._summary_task is None and not self._schedule_summary():
+                break
+            console.print(f"[yellow]Context length (~{self.messages.total_tokens} tokens) exceeds limit. Condensing...[/]")
+            await asyncio.wait([self._summary_task])
+            if not self._apply_summary():
+                break
+
+    def build_system_prompt(self) -> str:
+        """System prompt with all volatile details (time, cwd) at the very end.
+
+        Everything before the Session section is identical across sessions on
+        the same machine, so DeepSeek's prefix cache can reuse it.
+        """
         skill_summaries = []
-        for skill in self.skills:
+        for skill in sorted(self.skills, key=lambda s: s.config.name):
              skill_summaries.append(f"- {skill.config.name}: {skill.description}")
         
         current_os = platform.system()
         if current_os == "Darwin":
             current_os = "macOS"
              
-        system_prompt = f"""You are an efficient autonomous agent capable of using tools and skills to solve complex tasks.
-
-## Environment
-- Operating System: {current_os}
-- Current working directory: {os.getcwd()}
-- Current date and time: {datetime.datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S %Z')}
+        return f"""You are an efficient autonomous agent capable of using tools and skills to solve complex tasks.
 
 ## Skill System
 You have access to a dynamic skill system via MCP.
@@ -359,29 +2349,215 @@ Keep reasoning chain-of-thought light and concise, avoid overthinking. Focus on
 
 ## Available Skills
 {chr(10).join(skill_summaries)}
+
+## Environment
+- Operating System: {current_os}
+- Current working directory: {os.getcwd()}
+- Current date and time: {datetime.datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S %Z')}
 """
+
+    def start_session(self, session_id: Optional[str] = None) -> str:
+        """Start logging and seed the history with the system prompt."""
+        self._start_logging(session_id)
+        system_prompt = self.build_system_prompt()
         self.messages.append({"role": "system", "content": system_prompt})
         self._log("system", system_prompt)
+        return system_prompt
+
+    def _record_usage(self, usage: Any, model: str):
+        """Add one response's token usage to the session totals and the budget."""
+        usage = usage.model_dump()
+        for key, value in usage.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.usage[key] += value
+        self.budget.record(model, usage)
+
+    def _stop_for_budget(self, reason: str):
+        self.budget.stopped = reason
+        console.print(f"[red]Stopping: {reason}.[/]")
+        self._log("budget_stop", "", reason=reason)
+        self._emit("budget_stop", reason=reason)
+
+    def _record_llm_metrics(self, model: str, usage: Any, ttft: Optional[float], duration: float):
+        """Log TTFT and DeepSeek prompt cache hits for one response."""
+        usage = usage.model_dump() if usage else {}
+        metrics = {
+            "model": model,
+            "ttft_s": round(ttft, 3) if ttft is not None else None,
+            "duration_s": round(duration, 3),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "prompt_cache_hit_tokens": usage.get("prompt_cache_hit_tokens", 0),
+            "prompt_cache_miss_tokens": usage.get("prompt_cache_miss_tokens", 0),
+        }
+        self.llm_metrics.append(metrics)
+        self._log("llm_metrics", "", **metrics)
+
+    def prompt_cache_summary(self) -> Dict[str, Any]:
+        """Session-wide prompt cache hit rate and TTFT."""
+        hits = sum(m["prompt_cache_hit_tokens"] for m in self.llm_metrics)
+        misses = sum(m["prompt_cache_miss_tokens"] for m in self.llm_metrics)
+        ttfts = sorted(m["ttft_s"] for m in self.llm_metrics if m["ttft_s"] is not None)
+        return {
+            "requests": len(self.llm_metrics),
+            "prompt_cache_hit_tokens": hits,
+            "prompt_cache_miss_tokens": misses,
+            "prompt_cache_hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+            "ttft_avg_s": round(sum(ttfts) / len(ttfts), 3) if ttfts else None,
+            "ttft_p50_s": ttfts[len(ttfts) // 2] if ttfts else None,
+        }
+
+    async def _stream_completion(self, tools: List[Dict[str, Any]], model: str = "deepseek-reasoner") -> Dict[str, Any]:
+        """Stream one completion over the current history and return the assistant message."""
+        with self.tracer.span("llm.request", model=model, messages=len(self.messages), tools=len(tools)) as span:
+            request = {
+                "model": model,
+                "messages": self.messages,
+                "tools": tools if tools else None,
+                "stream": True,
+                "stream_options": {"include_usage": True},
+            }
+
+            partial_shown = False
+
+            async def consume(chunks, request_start):
+                nonlocal partial_shown
+                if partial_shown and self.render_mode != "none":
+                    console.rule("[yellow]Retrying; the partial reply above is discarded[/]", style="yellow")
+                # Capture reasoning_content for API compliance
+                renderer = StreamRenderer(self.render_mode)
+                tool_calls = []
+                current_tool_call = None
+                usage = None
+                ttft = None
+
+                renderer.start()
+                self._emit("stream_start") # Clients drop partial text from a failed attempt
+
+                try:
+                    async for chunk in chunks:
+                        if chunk.usage:
+                            usage = chunk.usage
+                        if not chunk.choices:
+                            continue # The usage chunk
+                        if ttft is None:
+                            ttft = time.perf_counter() - request_start
+
+                        # 1. Handle Reasoning
+                        if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'reasoning_content'):
+                            reasoning = chunk.choices[0].delta.reasoning_content
+                            if reasoning:
+                                renderer.add_reasoning(reasoning)
+                                self._emit("reasoning", text=reasoning)
+
+                        # 2. Handle Content
+                        if chunk.choices[0].delta.content:
+                            renderer.add_content(chunk.choices[0].delta.content)
+                            self._emit("content", text=chunk.choices[0].delta.content)
+
+                        # 3. Handle Tool Calls
+                        if chunk.choices[0].delta.tool_calls:
+                            renderer.pause()
+
+                            for tc in chunk.choices[0].delta.tool_calls:
+                                if tc.id:
+                                    if current_tool_call:
+                                        tool_calls.append(current_tool_call)
+                                    current_tool_call = {
+                                        "id": tc.id,
+                                        "type": "function",
+                                        "function": {"name": tc.function.name, "arguments": ""}
+                                    }
+                                if tc.function.arguments:
+                                    current_tool_call["function"]["arguments"] += tc.function.arguments
+                finally:
+                    renderer.finish()
+                    partial_shown = bool(renderer.content.text or renderer.reasoning.text or tool_calls or current_tool_call)
+
+                if current_tool_call:
+                    tool_calls.append(current_tool_call)
+                return renderer, tool_calls, usage, ttft, time.perf_counter() - request_start
+
+            # Each retry streams the reply again from the start
+            renderer, tool_calls, usage, ttft, duration = await self.transport.run(request, consume)
+            full_content = renderer.content.text
+            reasoning_storage = renderer.reasoning.text
+            if usage:
+                self._record_usage(usage, model)
+            self._record_llm_metrics(model, usage, ttft, duration)
+            span.set(
+                ttft_s=round(ttft, 3) if ttft is not None else None,
+                stream_s=round(duration - ttft, 3) if ttft is not None else None,
+                prompt_tokens=usage.prompt_tokens if usage else None,
+                completion_tokens=usage.completion_tokens if usage else None,
+                tool_calls=len(tool_calls),
+            )
         
-        console.print(Panel(system_prompt, title="System Prompt", border_style="yellow"))
-        console.rule("[bold green]DeepSeek Agent (MCP Mode with Dynamic Loading)[/]")
+            # Store assistant message
+            # Important: For DeepSeek API, if we consumed reasoning, we must include it in history to avoid 400 error
+            assistant_msg = {
+                "role": "assistant", 
+                "content": full_content
+            }
+            if reasoning_storage:
+                 assistant_msg["reasoning_content"] = reasoning_storage
+
+            self._log("assistant", full_content, reasoning_content=reasoning_storage,
+                      usage=usage.model_dump() if usage else None)
         
-        while True:
+            if tool_calls:
+                 # Reconstruct tool_calls object for history
+                assistant_msg["tool_calls"] = [
+                     {
+                         "id": tc["id"],
+                         "type": "function",
+                         "function": tc["function"]
+                     } for tc in tool_calls
+                ]
+                for tc in tool_calls:
+                    self._log("tool_call", "", tool_name=tc["function"]["name"], arguments=tc["function"]["arguments"],
+                              tool_call_id=tc["id"])
+            return assistant_msg
+
+    async def run_turn(self, user_input: str) -> str:
+        """Answer one user message, calling tools until the model stops asking for them.
+
+        Returns the content of the final assistant message.
+        """
+        with self.tracer.span("turn", session=self.session_id) as span:
+            self.budget.start_turn()
+            stop = self.budget.hard_limit()
+            if stop:
+                self._stop_for_budget(stop) # Before the history gets a message nobody answers
+                return ""
+            self.turn_number += 1
+            preloaded = await self._preload_skills(user_input)
+            content = user_input
+            if preloaded:
+                # The same instructions the loader tools would have returned
+                content += (f"\n\n[Skills loaded in advance for this request: "
+                            f"{', '.join(skill.config.name for skill in preloaded)}. Their tools are available now.]")
+                for skill in preloaded:
+                    content += f"\n\n## Skill: {skill.config.name}\n{skill._full_instructions}"
+            self.messages.append({"role": "user", "content": content})
+            self._log("user", user_input)
+            if preloaded:
+                self._log("skill_preload", "", skills=[skill.config.name for skill in preloaded])
+                self._emit("skill_preload", skills=[skill.config.name for skill in preloaded])
+            self._select_tools(user_input, preloaded)
+        
+            tool_iterations = 0
+            span.set(iterations=0, tool_calls=0)
+            downgraded = False
+
             try:
-                user_input = console.input("[bold blue]You:[/bold blue] ")
-                if user_input.lower() in ["exit", "quit"]:
-                    break
-                
-                self.messages.append({"role": "user", "content": user_input})
-                self._log("user", user_input)
-                
-                tool_iterations = 0
-                MAX_TOOL_ITERATIONS = 100
-                
                 while True:
-                    if tool_iterations >= MAX_TOOL_ITERATIONS:
-                        console.print(f"[red]Max tool iterations ({MAX_TOOL_ITERATIONS}) reached. Stopping execution.[/]")
-                        break
+                    if tool_iterations >= self.max_tool_iterations:
+                        console.print(f"[red]Max tool iterations ({self.max_tool_iterations}) reached. Stopping execution.[/]")
+                        return ""
+                    stop = self.budget.hard_limit()
+                    if stop:
+                        self._stop_for_budget(stop)
+                        return ""
 
                     # Check context length
                     await self._condense_context()
@@ -389,126 +2565,142 @@ Keep reasoning chain-of-thought light and concise, avoid overthinking. Focus on
                     # Construct tools list dynamically based on loaded skills
                     tools = await self.list_tools()
 
-                    # Capture reasoning_content for API compliance
-                    reasoning_storage = ""
-                    
-                    stream = self.client.chat.completions.create(
-                        model="deepseek-reasoner",
-                        messages=self.messages,
-                        tools=tools if tools else None,
-                        stream=True
-                    )
-                    
-                    full_content = ""
-                    tool_calls = []
-                    current_tool_call = None
-                    
-                    console.print("[yellow]Reasoning:[/yellow]")
-                    
-                    reasoning_mode = True
-                    live_display = None
+                    model = self.budget.model_for("deepseek-reasoner")
+                    if model != "deepseek-reasoner" and not downgraded:
+                        downgraded = True
+                        reason = self.budget.soft_limit()
+                        console.print(f"[yellow]{reason}; switching to {model}.[/]")
+                        self._log("budget_soft", "", reason=reason, model=model)
 
-                    try:
-                        for chunk in stream:
-                            # 1. Handle Reasoning
-                            if hasattr(chunk.choices[0], 'delta') and hasattr(chunk.choices[0].delta, 'reasoning_content'):
-                                reasoning = chunk.choices[0].delta.reasoning_content
-                                if reasoning:
-                                    console.print(reasoning, end="", style="italic dim")
-                                    reasoning_storage += reasoning
-                            
-                            # 2. Handle Content
-                            if chunk.choices[0].delta.content:
-                                if reasoning_mode and reasoning_storage:
-                                    console.print("\n\n", end="") # Switch with newlines
-                                    reasoning_mode = False
-                                
-                                if live_display is None:
-                                    live_display = Live(Markdown(""), console=console, refresh_per_second=4)
-                                    live_display.start()
-
-                                content_chunk = chunk.choices[0].delta.content
-                                full_content += content_chunk
-                                live_display.update(Markdown(full_content))
-
-                            # 3. Handle Tool Calls
-                            if chunk.choices[0].delta.tool_calls:
-                                if live_display:
-                                    live_display.stop()
-                                    live_display = None
-                                    
-                                for tc in chunk.choices[0].delta.tool_calls:
-                                    if tc.id:
-                                        if current_tool_call:
-                                            tool_calls.append(current_tool_call)
-                                        current_tool_call = {
-                                            "id": tc.id,
-                                            "type": "function",
-                                            "function": {"name": tc.function.name, "arguments": ""}
-                                        }
-                                    if tc.function.arguments:
-                                        current_tool_call["function"]["arguments"] += tc.function.arguments
-                    finally:
-                        if live_display:
-                            live_display.stop()
-                    
-                    if current_tool_call:
-                        tool_calls.append(current_tool_call)
-                        
-                    console.print() # Newline
-                    
-                    # Store assistant message
-                    # Important: For DeepSeek API, if we consumed reasoning, we must include it in history to avoid 400 error
-                    assistant_msg = {
-                        "role": "assistant", 
-                        "content": full_content
-                    }
-                    if reasoning_storage:
-                         assistant_msg["reasoning_content"] = reasoning_storage
-
-                    self._log("assistant", full_content, reasoning_content=reasoning_storage)
-                    
-                    if tool_calls:
-                         # Reconstruct tool_calls object for history
-                        assistant_msg["tool_calls"] = [
-                             {
-                                 "id": tc["id"],
-                                 "type": "function",
-                                 "function": tc["function"]
-                             } for tc in tool_calls
-                        ]
-                        for tc in tool_calls:
-                            self._log("tool_call", "", tool_name=tc["function"]["name"], arguments=tc["function"]["arguments"])
-                    
+                    assistant_msg = await self._stream_completion(tools, model)
                     self.messages.append(assistant_msg)
-                    
+
+                    tool_calls = assistant_msg.get("tool_calls")
                     if not tool_calls:
-                        break
-                        
+                        return assistant_msg["content"]
+
                     # Execute tools
+                    self.tool_call_count += len(tool_calls)
                     for tc in tool_calls:
+                        self._emit("tool_call", id=tc["id"], name=tc["function"]["name"],
+                                   arguments=tc["function"]["arguments"])
+                    for tc, result in await self.execute_tool_calls(tool_calls):
                         fn_name = tc["function"]["name"]
-                        fn_args_str = tc["function"]["arguments"]
-                        try:
-                            fn_args = json.loads(fn_args_str)
-                            result = await self.call_tool(fn_name, fn_args)
-                        except Exception as e:
-                            result = f"Error: {str(e)}"
-                            
-                        console.print(Panel(result, title=fn_name, border_style="cyan", height=5))
-                        
+                        if self.render_mode != "none":
+                            from rich.panel import Panel
+                            console.print(Panel(result, title=fn_name, border_style="cyan", height=5))
+
+                        content, handle = self._spill_large_result(fn_name, result)
                         self.messages.append({
                             "role": "tool",
                             "tool_call_id": tc["id"],
-                            "content": result
+                            "content": content
                         })
-                        self._log("tool_result", result, tool_name=fn_name)
-                    
+                        self._log("tool_result", result, tool_name=fn_name, tool_call_id=tc["id"], artifact=handle)
+                        self._emit("tool_result", id=tc["id"], name=fn_name, content=content)
+
                     tool_iterations += 1
+                    span.set(iterations=tool_iterations, tool_calls=span.attributes["tool_calls"] + len(tool_calls))
+            except asyncio.CancelledError:
+                self._close_interrupted_turn()
+                raise
+            finally:
+                self._log("turn_usage", "", **self.budget.turn_report())
+
+    def _close_interrupted_turn(self):
+        """Answer the user message or tool calls an interrupted turn left open, so the history stays valid."""
+        last = self.messages[-1] if self.messages else None
+        if last is not None and last.get("role") == "user":
+            # Stopped while streaming the reply; without an answer the next turn would send two user messages
+            note = "(Interrupted by the user before replying.)"
+            self.messages.append({"role": "assistant", "content": note})
+            self._log("assistant", note)
+            self._log("turn_cancelled", "")
+            return
+        if last is None or last.get("role") != "assistant" or not last.get("tool_calls"):
+            self._log("turn_cancelled", "")
+            return
+        note = "Interrupted by the user; this call may or may not have completed."
+        for tc in last["tool_calls"]:
+            self.messages.append({"role": "tool", "tool_call_id": tc["id"], "content": note})
+            self._log("tool_result", note, tool_name=tc["function"]["name"], tool_call_id=tc["id"], artifact=None)
+        self._log("turn_cancelled", "", tool_calls=[tc["id"] for tc in last["tool_calls"]])
+
+    @contextmanager
+    def _cancel_on_interrupt(self, task: asyncio.Task):
+        """Make Ctrl-C cancel the task instead of raising KeyboardInterrupt, while it runs."""
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        previous = signal.signal(signal.SIGINT, lambda *_: loop.call_soon_threadsafe(task.cancel))
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, previous)
+
+    async def chat_loop(self):
+        system_prompt = self.start_session()
+        threading.Thread(target=preload_modules, name="preload", daemon=True).start()
+        
+        from rich.panel import Panel
+        console.print(Panel(system_prompt, title="System Prompt", border_style="yellow"))
+        console.rule("[bold green]DeepSeek Agent (MCP Mode with Dynamic Loading)[/]")
+        
+        while True:
+            try:
+                # Read input off the loop so pre-warming continues while the user types
+                try:
+                    user_input = await read_input("[bold blue]You:[/bold blue] ")
+                except EOFError:
+                    break
+                if user_input.lower() in ["exit", "quit"]:
+                    break
+
+                # Ctrl-C stops the reply and any running tools, but keeps the session
+                turn = asyncio.create_task(self.run_turn(user_input))
+                with self._cancel_on_interrupt(turn):
+                    try:
+                        await turn
+                    except asyncio.CancelledError:
+                        if asyncio.current_task().cancelling():
+                            raise
+                        console.print("[yellow]Turn interrupted.[/]")
             except Exception as e:
                 console.print(f"[red]Error: {traceback.format_exc()}[/]")
 
+    def print_tool_latency(self):
+        """Show p50/p95 latency per tool for this session."""
+        tools = self.tracer.summary()["tools"]
+        if not tools:
+            return
+        from rich.table import Table
+        table = Table(title="Tool latency", title_justify="left")
+        for column in ("tool", "calls", "p50 ms", "p95 ms", "max ms"):
+            table.add_column(column, justify="left" if column == "tool" else "right")
+        for name, stats in tools.items():
+            table.add_row(name, str(stats["count"]), str(stats["p50_ms"]), str(stats["p95_ms"]), str(stats["max_ms"]))
+        console.print(table)
+
     async def cleanup(self):
-        if self.jsonl_handle:
-            self.jsonl_handle.close()
-        await self.exit_stack.aclose()
+        if self._reaper_task:
+            self._reaper_task.cancel()
+        if self._summary_task:
+            self._summary_task.cancel()
+        if self.tool_cache is not None:
+            self._log("tool_cache", "", **self.tool_cache.stats())
+        await asyncio.gather(*self.prewarm_tasks)
+        await asyncio.gather(*(self.disconnect_server(skill) for skill in self.skills))
+        self._log("session_stats", "", usage=dict(self.usage), tool_calls=self.tool_call_count,
+                  prompt_cache=self.prompt_cache_summary(), skill_health=self.skill_health(),
+                  trace=self.tracer.summary(), transport=self.transport.stats(), tool_fallbacks=self.tool_fallbacks)
+        self._log("budget_report", "", **self.budget.report())
+        if self.render_mode != "none":
+            self.print_tool_latency()
+            if self.budget.session["requests"]:
+                console.print(f"[dim]Session usage: {self.budget.session['total_tokens']} tokens, "
+                              f"${self.budget.session['cost_usd']:.4f}[/]")
+        await self.transport.close()
+        self.tracer.close()
+        if self.logger:
+            self.logger.close()
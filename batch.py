@@ -0,0 +1,148 @@
+"""
+Headless batch runner.
+
+Runs every prompt of a JSONL file through its own DeepSeekMCPAgent session,
+a few at a time, and appends one result line per prompt to an output JSONL:
+
+    python batch.py requests.jsonl -o results.jsonl --concurrency 4
+
+Each input line is an object with a "prompt" (or "title"/"body") and an
+optional "request_id"/"id". Skills in SHAREABLE_SKILLS share one server
+process across all sessions; the others are spawned per session.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import agent as agent_module
+from agent import DeepSeekMCPAgent, SkillManifest, SkillServerPool
+from main import SKILL_MANIFEST, register_servers
+
+ROOT_DIR = Path(__file__).parent
+
+def load_requests(path: Path) -> List[Dict[str, Any]]:
+    """Read prompts from a JSONL file as {"request_id", "prompt"} records."""
+    requests = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            prompt = record.get("prompt")
+            if prompt is None:
+                prompt = "\n\n".join(part for part in (record.get("title"), record.get("body")) if part)
+            if not prompt:
+                raise ValueError(f"{path}:{line_no}: no prompt, title or body")
+            request_id = str(record.get("request_id") or record.get("id") or f"line-{line_no}")
+            requests.append({"request_id": request_id, "prompt": prompt})
+    return requests
+
+def get_api_key() -> str:
+    """API key from DEEPSEEK_API_KEY or api_key.txt; batch runs never prompt."""
+    key = os.environ.get("DEEPSEEK_API_KEY", "").strip()
+    key_path = ROOT_DIR / "api_key.txt"
+    if not key and key_path.exists():
+        key = key_path.read_text(encoding="utf-8").strip()
+    if not key:
+        sys.exit("Error: set DEEPSEEK_API_KEY or create api_key.txt")
+    return key
+
+async def run_request(request: Dict[str, Any], make_agent: Callable[[], DeepSeekMCPAgent]) -> Dict[str, Any]:
+    """Run one prompt in a fresh agent session and describe the outcome."""
+    agent = make_agent()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in request["request_id"])
+    result = {
+        "request_id": request["request_id"],
+        "started_at": datetime.datetime.now().isoformat(),
+    }
+    start = time.perf_counter()
+    try:
+        agent.start_session(f"session_{timestamp}_{safe_id}")
+        result["response"] = await agent.run_turn(request["prompt"])
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    finally:
+        result["duration_s"] = round(time.perf_counter() - start, 3)
+        try:
+            await agent.cleanup()
+        except Exception as e:
+            result.setdefault("error", f"cleanup failed: {e}")
+    result["session_id"] = agent.session_id
+    result["usage"] = dict(agent.usage)
+    result["tool_calls"] = agent.tool_call_count
+    result["skills_loaded"] = [skill.config.name for skill in agent.skills if skill.loaded]
+    return result
+
+async def run_batch(
+    requests: List[Dict[str, Any]],
+    output_path: Path,
+    make_agent: Callable[[], DeepSeekMCPAgent],
+    concurrency: int = 4,
+) -> List[Dict[str, Any]]:
+    """Run requests with at most `concurrency` sessions in flight.
+
+    Results are appended to `output_path` as they complete.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        async def worker(request):
+            async with semaphore:
+                result = await run_request(request, make_agent)
+            out.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+            out.flush()
+            results.append(result)
+            print(f"[{len(results)}/{len(requests)}] {result['request_id']}: {result['status']} ({result['duration_s']}s)")
+
+        await asyncio.gather(*(worker(request) for request in requests))
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through headless agent sessions.")
+    parser.add_argument("input", type=Path, help="JSONL file of prompts")
+    parser.add_argument("-o", "--output", type=Path, default=Path("batch_results.jsonl"), help="Results JSONL (appended)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Sessions running at the same time")
+    parser.add_argument("--no-shared-servers", action="store_true", help="Spawn every skill server per session")
+    parser.add_argument("--max-tool-iterations", type=int, default=100)
+    parser.add_argument("--verbose", action="store_true", help="Show agent console output")
+    return parser.parse_args()
+
+async def main():
+    args = parse_args()
+    requests = load_requests(args.input)
+    api_key = get_api_key()
+    agent_module.console.quiet = not args.verbose
+
+    pool = None if args.no_shared_servers else SkillServerPool()
+
+    manifest = SkillManifest(SKILL_MANIFEST)
+
+    def make_agent() -> DeepSeekMCPAgent:
+        agent = DeepSeekMCPAgent(api_key=api_key, render_mode="none", server_pool=pool, skill_manifest=manifest)
+        agent.max_tool_iterations = args.max_tool_iterations
+        register_servers(agent, ROOT_DIR / "servers", verbose=False)
+        return agent
+
+    start = time.perf_counter()
+    try:
+        results = await run_batch(requests, args.output, make_agent, args.concurrency)
+    finally:
+        if pool is not None:
+            await pool.close()
+    failed = sum(1 for r in results if r["status"] != "ok")
+    print(f"Processed {len(results)} requests in {time.perf_counter() - start:.1f}s ({failed} failed) -> {args.output}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
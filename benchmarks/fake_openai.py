@@ -0,0 +1,210 @@
+"""
+Local stand-in for an OpenAI-compatible /chat/completions endpoint.
+
+Replies are scripted per conversation: the last user message selects a
+script, and the number of assistant messages after it selects the step,
+so a multi-step tool-calling turn replays the same way every time:
+
+    server = FakeOpenAIServer(scripts={
+        "list files": [
+            {"reasoning": "Need the skill.", "tool_calls": [{"name": "skill_stub", "arguments": {}}]},
+            {"content": "Done."},
+        ],
+    })
+    server.start()
+    agent = DeepSeekMCPAgent("fake", base_url=server.base_url)
+
+A `responder` callable can replace the script lookup entirely (see
+replay.py). A reply may carry its own "ttft" and "chunk_delay", an error
+"status" to answer with instead, or "stall_after" to stop sending after
+that many chunks without closing the stream.
+
+Streaming follows the DeepSeek wire format (reasoning_content deltas,
+incremental tool call arguments, a final usage chunk when requested).
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from agent import estimate_tokens
+
+DEFAULT_SCRIPT = [{"content": "OK."}]
+
+def _split(text: str, size: int) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def _arguments(tool_call: Dict[str, Any]) -> str:
+    """Tool call arguments as sent on the wire; recorded calls already hold the JSON string."""
+    arguments = tool_call.get("arguments", {})
+    return arguments if isinstance(arguments, str) else json.dumps(arguments)
+
+class FakeOpenAIServer:
+    """Scripted chat completions server running on its own thread and event loop."""
+
+    def __init__(
+        self,
+        scripts: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+        default_script: Optional[List[Dict[str, Any]]] = None,
+        ttft: float = 0.0,
+        chunk_delay: float = 0.0,
+        chunk_chars: int = 8,
+        host: str = "127.0.0.1",
+        responder: Optional[Callable[[List[Dict[str, Any]]], Dict[str, Any]]] = None,
+    ):
+        self.scripts = scripts or {}
+        self.responder = responder # messages -> reply, instead of the scripts
+        self.default_script = default_script or DEFAULT_SCRIPT
+        self.ttft = ttft # Seconds before the first chunk
+        self.chunk_delay = chunk_delay # Seconds between chunks
+        self.chunk_chars = chunk_chars # Characters of text per chunk
+        self.host = host
+        self.port: Optional[int] = None
+        self.requests = 0
+        self._previous_messages: List[Any] = []
+        self._server: Optional[uvicorn.Server] = None
+        self._thread: Optional[threading.Thread] = None
+        self._app = Starlette(routes=[Route("/chat/completions", self._chat, methods=["POST"])])
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, 0))
+        self.port = sock.getsockname()[1]
+        config = uvicorn.Config(self._app, log_level="error", access_log=False, lifespan="off",
+                                timeout_graceful_shutdown=1)
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(
+            target=lambda: asyncio.run(self._server.serve(sockets=[sock])), name="fake-openai", daemon=True
+        )
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("fake OpenAI server failed to start")
+            time.sleep(0.01)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _pick(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """The scripted reply for the current step of the current user turn."""
+        if self.responder is not None:
+            return self.responder(messages)
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+        prompt = messages[last_user].get("content") if last_user >= 0 else None
+        script = self.scripts.get(prompt, self.default_script)
+        step = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+        return script[min(step, len(script) - 1)]
+
+    def _usage(self, messages: List[Dict[str, Any]], reply: Dict[str, Any]) -> Dict[str, int]:
+        """Token usage, counting the longest message prefix shared with the previous request as cached."""
+        prompt_tokens = sum(estimate_tokens(json.dumps(m, ensure_ascii=False)) for m in messages)
+        cached = 0
+        for old, new in zip(self._previous_messages, messages):
+            if old != new:
+                break
+            cached += estimate_tokens(json.dumps(new, ensure_ascii=False))
+        self._previous_messages = messages
+        completion_tokens = estimate_tokens(reply.get("reasoning", "") + reply.get("content", "")) + sum(
+            estimate_tokens(_arguments(tc)) for tc in reply.get("tool_calls", [])
+        )
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_cache_hit_tokens": cached,
+            "prompt_cache_miss_tokens": prompt_tokens - cached,
+        }
+
+    def _deltas(self, reply: Dict[str, Any]):
+        yield {"role": "assistant", "content": ""}
+        for piece in _split(reply.get("reasoning", ""), self.chunk_chars):
+            yield {"content": None, "reasoning_content": piece}
+        for piece in _split(reply.get("content", ""), self.chunk_chars):
+            yield {"content": piece}
+        for index, tc in enumerate(reply.get("tool_calls", [])):
+            call_id = tc.get("id") or f"call_{self.requests}_{index}"
+            yield {"tool_calls": [{"index": index, "id": call_id, "type": "function",
+                                   "function": {"name": tc["name"], "arguments": ""}}]}
+            for piece in _split(_arguments(tc), self.chunk_chars):
+                yield {"tool_calls": [{"index": index, "function": {"arguments": piece}}]}
+
+    async def _chat(self, request: Request):
+        body = await request.json()
+        self.requests += 1
+        messages = body.get("messages", [])
+        reply = self._pick(messages)
+        usage = self._usage(messages, reply)
+        model = body.get("model", "deepseek-chat")
+        completion_id = f"chatcmpl-fake-{self.requests}"
+        finish_reason = "tool_calls" if reply.get("tool_calls") else "stop"
+
+        if reply.get("status"):
+            await asyncio.sleep(reply.get("ttft", self.ttft))
+            return JSONResponse(
+                {"error": {"message": f"scripted {reply['status']} error", "type": "server_error", "code": None}},
+                status_code=reply["status"], headers=reply.get("headers"),
+            )
+
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": reply.get("content", "")}
+            if reply.get("reasoning"):
+                message["reasoning_content"] = reply["reasoning"]
+            if reply.get("tool_calls"):
+                message["tool_calls"] = [
+                    {"id": tc.get("id") or f"call_{self.requests}_{i}", "type": "function",
+                     "function": {"name": tc["name"], "arguments": _arguments(tc)}}
+                    for i, tc in enumerate(reply["tool_calls"])
+                ]
+            await asyncio.sleep(reply.get("ttft", self.ttft))
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(choices, **extra):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(payload)}\n\n"
+
+        chunk_delay = reply.get("chunk_delay", self.chunk_delay)
+
+        async def events():
+            await asyncio.sleep(reply.get("ttft", self.ttft))
+            for sent, delta in enumerate(self._deltas(reply)):
+                if sent == reply.get("stall_after"):
+                    await asyncio.sleep(3600)
+                yield chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+                if chunk_delay:
+                    await asyncio.sleep(chunk_delay)
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+            if include_usage:
+                yield chunk([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,263 @@
+"""
+Offline end-to-end benchmarks for the agent loop.
+
+Runs headless turns against FakeOpenAIServer and the stub skill server, so
+results depend only on this machine and this checkout:
+
+    python -m benchmarks.run -o before.json
+    python -m benchmarks.run -o after.json --compare before.json
+
+Scenarios:
+    plain_turn      streamed reply without tools (turn latency, TTFT)
+    tool_turn       skill load plus a batch of parallel tool calls (dispatch overhead)
+    condense        summarizing a history three times over the budget
+    memory_growth   allocations retained per turn with large tool results
+    skill_transport connect time and per-call latency, stdio vs. in-process skills
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import agent as agent_module
+from agent import ArtifactStore, DeepSeekMCPAgent
+from benchmarks.fake_openai import FakeOpenAIServer
+
+ROOT_DIR = Path(__file__).parent.parent
+STUB_SKILL = Path(__file__).parent / "stub_skill"
+
+REASONING = "Let me think about what the user is asking for before answering. " * 6
+ANSWER = "Here is a short answer with a little **Markdown**:\n\n- one\n- two\n\n```python\nprint('hi')\n```\n" * 3
+
+def _tool_step(*calls) -> Dict[str, Any]:
+    return {"reasoning": "Calling tools.", "tool_calls": [{"name": name, "arguments": args} for name, args in calls]}
+
+SCRIPTS = {
+    "plain": [{"reasoning": REASONING, "content": ANSWER}],
+    "tools": [
+        _tool_step(("skill_stub", {})),
+        _tool_step(*[("echo", {"text": f"message {i}"}) for i in range(8)]),
+        {"content": "All echoes returned."},
+    ],
+    "grow": [
+        _tool_step(("skill_stub", {})),
+        _tool_step(("blob", {"size": 20000})),
+        {"content": "Read the blob."},
+    ],
+}
+
+def _stats(seconds: List[float]) -> Dict[str, Any]:
+    values = sorted(seconds)
+    return {
+        "n": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2),
+        "p50_ms": round(values[len(values) // 2] * 1000, 2),
+        "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+def make_agent(server: FakeOpenAIServer, workdir: Path, **kwargs) -> DeepSeekMCPAgent:
+    """Headless agent talking to the fake server, logging into workdir, with the stub skill registered."""
+    agent = DeepSeekMCPAgent("bench-key", base_url=server.base_url, render_mode="none", markdown_log=False, **kwargs)
+    agent.log_dir = workdir / "logs"
+    agent.log_dir.mkdir(parents=True, exist_ok=True)
+    agent.trace_dir = workdir / "traces"
+    agent.artifact_store = ArtifactStore(workdir / "tool_results")
+    agent.add_server("stub", STUB_SKILL / "SKILL.md", sys.executable, [str(STUB_SKILL / "server.py")])
+    agent.start_session()
+    return agent
+
+async def _timed_turns(agent: DeepSeekMCPAgent, prompt: str, turns: int) -> List[float]:
+    durations = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        await agent.run_turn(prompt)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+async def bench_plain_turn(server: FakeOpenAIServer, workdir: Path, repeat: int) -> Dict[str, Any]:
+    agent = make_agent(server, workdir)
+    try:
+        durations = await _timed_turns(agent, "plain", repeat)
+        ttfts = [m["ttft_s"] for m in agent.llm_metrics if m["ttft_s"] is not None]
+    finally:
+        await agent.cleanup()
+    return {"turn": _stats(durations), "ttft": _stats(ttfts)}
+
+async def bench_tool_turn(server: FakeOpenAIServer, workdir: Path, repeat: int) -> Dict[str, Any]:
+    agent = make_agent(server, workdir)
+    try:
+        durations = await _timed_turns(agent, "tools", repeat + 1)
+        spans = agent.tracer.durations
+        echo = agent.tracer.tool_durations["echo"]
+        round_trips = spans["mcp.round_trip"]
+        llm = sum(spans["llm.request"]) / len(durations)
+    finally:
+        await agent.cleanup()
+    return {
+        "first_turn_ms": round(durations[0] * 1000, 2), # Includes spawning the stub server
+        "warm_turn": _stats(durations[1:]),
+        "tool_call": _stats(echo),
+        "mcp_round_trip": _stats(round_trips),
+        "dispatch_overhead_ms": round((statistics.fmean(echo) - statistics.fmean(round_trips)) * 1000, 3),
+        "non_llm_per_turn_ms": round((statistics.fmean(durations[1:]) - llm) * 1000, 2),
+    }
+
+async def bench_condense(server: FakeOpenAIServer, workdir: Path, repeat: int) -> Dict[str, Any]:
+    durations, requests, tokens_before, tokens_after = [], [], 0, 0
+    for _ in range(max(1, repeat // 4)):
+        agent = make_agent(server, workdir, max_context_tokens=4000)
+        try:
+            for i in range(60):
+                agent.messages.append({"role": "user", "content": f"Question {i}: " + "details " * 25})
+                agent.messages.append({"role": "assistant", "content": f"Answer {i}: " + "explanation " * 25})
+            tokens_before = agent.messages.total_tokens
+            requests_before = server.requests
+            start = time.perf_counter()
+            await agent._condense_context()
+            durations.append(time.perf_counter() - start)
+            requests.append(server.requests - requests_before)
+            tokens_after = agent.messages.total_tokens
+        finally:
+            await agent.cleanup()
+    return {
+        "condense": _stats(durations),
+        "summary_requests": statistics.fmean(requests),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+    }
+
+async def bench_memory_growth(server: FakeOpenAIServer, workdir: Path, repeat: int) -> Dict[str, Any]:
+    agent = make_agent(server, workdir)
+    try:
+        await agent.run_turn("grow") # Warm up: spawn the server, fill caches
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        await _timed_turns(agent, "grow", repeat)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        history_chars = agent.messages.total_chars
+    finally:
+        await agent.cleanup()
+    return {
+        "turns": repeat,
+        "retained_kb_per_turn": round((current - baseline) / repeat / 1024, 2),
+        "peak_kb": round((peak - baseline) / 1024, 2),
+        "history_chars": history_chars,
+    }
+
+async def bench_skill_transport(server: FakeOpenAIServer, workdir: Path, repeat: int) -> Dict[str, Any]:
+    results = {}
+    for transport in ("stdio", "inprocess"):
+        agent = DeepSeekMCPAgent("bench-key", base_url=server.base_url, render_mode="none", tool_cache_size=0)
+        agent.add_server("stub", STUB_SKILL / "SKILL.md", sys.executable, [str(STUB_SKILL / "server.py")],
+                         transport=transport)
+        try:
+            start = time.perf_counter()
+            await agent.call_tool("skill_stub", {})
+            connect = time.perf_counter() - start
+            calls = {}
+            for tool, arguments in (("echo", {"text": "ping"}), ("sleep_ms", {"ms": 0}), ("blob", {"size": 100000})):
+                durations = []
+                for _ in range(repeat * 5):
+                    start = time.perf_counter()
+                    await agent.call_tool(tool, arguments)
+                    durations.append(time.perf_counter() - start)
+                calls[tool] = _stats(durations)
+        finally:
+            await agent.cleanup()
+        results[transport] = {"connect_ms": round(connect * 1000, 2), "calls": calls}
+    return results
+
+SCENARIOS: Dict[str, Callable] = {
+    "plain_turn": bench_plain_turn,
+    "tool_turn": bench_tool_turn,
+    "condense": bench_condense,
+    "memory_growth": bench_memory_growth,
+    "skill_transport": bench_skill_transport,
+}
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+async def run_benchmarks(names: List[str], repeat: int = 20, ttft: float = 0.0, chunk_delay: float = 0.0) -> Dict[str, Any]:
+    """Run the named scenarios and return the report."""
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "config": {"repeat": repeat, "ttft_s": ttft, "chunk_delay_s": chunk_delay},
+        "scenarios": {},
+    }
+    with FakeOpenAIServer(SCRIPTS, ttft=ttft, chunk_delay=chunk_delay) as server, \
+            tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            start = time.perf_counter()
+            report["scenarios"][name] = await SCENARIOS[name](server, Path(workdir) / name, repeat)
+            print(f"{name}: done in {time.perf_counter() - start:.1f}s")
+    return report
+
+def _flatten(scenarios: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in scenarios.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(baseline: Dict[str, Any], report: Dict[str, Any]) -> List[str]:
+    """One line per metric present in both reports, with the relative change."""
+    old, new = _flatten(baseline["scenarios"]), _flatten(report["scenarios"])
+    lines = []
+    for key in sorted(old.keys() & new.keys()):
+        if key.endswith(".n"):
+            continue
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+        lines.append(f"{key:45} {old[key]:>12} -> {new[key]:>12}  {change}")
+    return lines
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline agent loop benchmarks.")
+    parser.add_argument("-o", "--output", type=Path, help="Report JSON (default artifacts/benchmarks/<time>.json)")
+    parser.add_argument("--compare", type=Path, help="Earlier report to diff against")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Run only these (repeatable)")
+    parser.add_argument("--repeat", type=int, default=20, help="Turns per scenario")
+    parser.add_argument("--ttft", type=float, default=0.0, help="Simulated seconds to first token")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Simulated seconds between streamed chunks")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    agent_module.console.quiet = True
+    report = asyncio.run(run_benchmarks(args.scenario or list(SCENARIOS), args.repeat, args.ttft, args.chunk_delay))
+
+    output = args.output
+    if output is None:
+        output = ROOT_DIR / "artifacts" / "benchmarks" / f"{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(json.dumps(report["scenarios"], indent=2))
+    print(f"Report written to {output}")
+
+    if args.compare:
+        print("\n".join(compare(json.loads(args.compare.read_text(encoding="utf-8")), report)))
+
+if __name__ == "__main__":
+    main()
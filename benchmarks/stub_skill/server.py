@@ -0,0 +1,24 @@
+from mcp.server.fastmcp import FastMCP
+import asyncio
+
+mcp = FastMCP("stub", log_level="ERROR")
+
+@mcp.tool()
+def echo(text: str) -> str:
+    """Return the text unchanged."""
+    return text
+
+@mcp.tool()
+def blob(size: int) -> str:
+    """Return a string of `size` characters."""
+    line = "0123456789abcdef" * 4 + "\n"
+    return (line * (size // len(line) + 1))[:size]
+
+@mcp.tool()
+async def sleep_ms(ms: int) -> str:
+    """Wait `ms` milliseconds."""
+    await asyncio.sleep(ms / 1000)
+    return f"slept {ms}ms"
+
+if __name__ == "__main__":
+    mcp.run()
@@ -1,9 +1,26 @@
+import time
+_STARTED = time.perf_counter() # For --profile-startup
+import argparse
 import asyncio
+import json
+import subprocess
 import sys
+import tempfile
+from collections import Counter
 from pathlib import Path
-from dotenv import load_dotenv
+from typing import Any, Dict, List, Tuple
 
-from agent import DeepSeekMCPAgent
+from agent import BudgetConfig, DeepSeekMCPAgent, SkillManifest, TransportConfig, render_markdown
+
+IMPORT_SECONDS = time.perf_counter() - _STARTED
+ROOT_DIR = Path(__file__).parent
+SKILL_MANIFEST = ROOT_DIR / "artifacts" / "skill_manifest.json"
+
+# Skills whose servers keep no per-session state; headless runs share one process per skill
+SHAREABLE_SKILLS = {"coder", "git", "os_manipulation", "office_reader", "web_fetch", "testing"}
+# Trusted skills that may be imported into the agent process with --inprocess instead of
+# spawning a Python subprocess each; their tools then share our cwd, environment and crashes
+INPROCESS_SKILLS = {"coder", "git", "os_manipulation", "office_reader", "web_fetch", "testing", "planner"}
 
 def get_api_key() -> str:
     key_path = Path(__file__).parent / "api_key.txt"
@@ -20,38 +37,235 @@ def get_api_key() -> str:
     print(f"API Key saved to {key_path}")
     return key
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="DeepSeek MCP agent")
+    parser.add_argument(
+        "--prewarm", nargs="*", metavar="SKILL",
+        help="Start skill servers in the background at startup. "
+             "Without names, the skills most used in past sessions are warmed."
+    )
+    parser.add_argument(
+        "--jsonl-only", action="store_true",
+        help="Only write the JSONL session log; render the Markdown transcript later with --render-log."
+    )
+    parser.add_argument(
+        "--render", choices=["live", "plain", "none"], default="live",
+        help="How streamed replies are shown: rich Markdown, raw text, or not at all."
+    )
+    parser.add_argument(
+        "--render-log", metavar="JSONL",
+        help="Render the Markdown transcript of a JSONL session log and exit."
+    )
+    parser.add_argument(
+        "--idle-ttl", type=float, default=900.0, metavar="SECONDS",
+        help="Stop skill servers idle for this long; they restart on next use (0 keeps them running)."
+    )
+    parser.add_argument(
+        "--tool-timeout", type=float, default=120.0, metavar="SECONDS",
+        help="Cancel tool calls that run longer than this (0 waits forever); see TOOL_TIMEOUTS for exceptions."
+    )
+    parser.add_argument(
+        "--inprocess", nargs="*", metavar="SKILL",
+        help="Run skills inside the agent process instead of as subprocesses "
+             "(default: the trusted skills in INPROCESS_SKILLS)."
+    )
+    parser.add_argument(
+        "--llm-retries", type=int, default=3, metavar="N",
+        help="Retry failed or stalled LLM requests up to N times with jittered backoff."
+    )
+    parser.add_argument(
+        "--tool-top-k", type=int, default=12, metavar="K",
+        help="Send only the K loaded tools most relevant to the conversation with each turn (0 sends all)."
+    )
+    parser.add_argument(
+        "--no-preload", action="store_true",
+        help="Do not load skills predicted from the prompt before the first LLM request of a turn."
+    )
+    parser.add_argument(
+        "--soft-budget", type=int, metavar="TOKENS",
+        help="Past this many session tokens, answer with the cheaper deepseek-chat instead of the reasoner."
+    )
+    parser.add_argument(
+        "--hard-budget", type=int, metavar="TOKENS",
+        help="Stop once the session has used this many tokens."
+    )
+    parser.add_argument(
+        "--soft-cost", type=float, metavar="USD", help="Like --soft-budget, in estimated USD."
+    )
+    parser.add_argument(
+        "--hard-cost", type=float, metavar="USD", help="Like --hard-budget, in estimated USD."
+    )
+    parser.add_argument(
+        "--turn-budget", type=int, metavar="TOKENS",
+        help="Stop a single turn (e.g. a runaway tool loop) once it has used this many tokens."
+    )
+    parser.add_argument(
+        "--profile-startup", action="store_true",
+        help="Time a cold and a warm startup, show where the time goes, and exit."
+    )
+    parser.add_argument("--startup-probe", metavar="MANIFEST", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--hedge-after", type=float, metavar="SECONDS",
+        help="Send a second, racing LLM request if the first has not started streaming by then."
+    )
+    return parser.parse_args()
+
+def register_servers(agent: DeepSeekMCPAgent, servers_dir: Path, verbose: bool = True, inprocess=()):
+    """Register every servers/<name> directory that has a SKILL.md and server.py.
+
+    Skills named in `inprocess` use the in-process transport.
+    """
+    if not servers_dir.exists():
+        return
+    for item in servers_dir.iterdir():
+        if item.is_dir():
+            skill_path = item / "SKILL.md"
+            server_path = item / "server.py"
+            
+            if skill_path.exists() and server_path.exists():
+                if verbose:
+                    print(f"Loading server: {item.name}")
+                agent.add_server(
+                    name=item.name,
+                    skill_md_path=skill_path,
+                    command=sys.executable,
+                    args=[str(server_path)],
+                    shareable=item.name in SHAREABLE_SKILLS,
+                    transport="inprocess" if item.name in inprocess else "stdio"
+                )
+    if agent.skill_manifest is not None:
+        agent.skill_manifest.save()
+
+def startup_probe(manifest_path: Path) -> Dict[str, Any]:
+    """Run the startup path up to the first prompt and time each phase (for --profile-startup)."""
+    phases = {"imports": IMPORT_SECONDS}
+    start = time.perf_counter()
+    manifest = SkillManifest(manifest_path)
+    agent = DeepSeekMCPAgent(api_key="startup-probe", render_mode="none", skill_manifest=manifest)
+    phases["agent_init"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    register_servers(agent, ROOT_DIR / "servers", verbose=False)
+    phases["register_skills"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    agent.build_system_prompt()
+    phases["system_prompt"] = time.perf_counter() - start
+
+    # Paid later: on the first request, or in the background while the user types
+    start = time.perf_counter()
+    agent.client
+    deferred = {"openai_client": time.perf_counter() - start}
+    start = time.perf_counter()
+    import mcp.client.stdio
+    deferred["mcp_import"] = time.perf_counter() - start
+    return {
+        "phases": {name: round(seconds, 4) for name, seconds in phases.items()},
+        "deferred": {name: round(seconds, 4) for name, seconds in deferred.items()},
+        "to_first_prompt": round(time.perf_counter() - _STARTED - sum(deferred.values()), 4),
+        "skills": len(agent.skills),
+        "manifest_hits": manifest.hits,
+    }
+
+def summarize_importtime(stderr: str, top: int = 12) -> List[Tuple[str, int, int]]:
+    """(package, self µs, modules) for the packages that took longest to import, from -X importtime output."""
+    self_us, modules = Counter(), Counter()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, _, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        package = name.split(".")[0]
+        self_us[package] += int(own)
+        modules[package] += 1
+    return [(package, us, modules[package]) for package, us in self_us.most_common(top)]
+
+def _run_probe(manifest_path: Path, importtime: bool = False) -> Tuple[Dict[str, Any], float, str]:
+    """Start a fresh interpreter on --startup-probe; returns its report, wall time and stderr."""
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []),
+               str(Path(__file__).resolve()), "--startup-probe", str(manifest_path)]
+    start = time.perf_counter()
+    proc = subprocess.run(command, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    return json.loads(proc.stdout.strip().splitlines()[-1]), wall, proc.stderr
+
+def profile_startup():
+    """Compare a cold start (no skill manifest cache) with a warm one and summarize import costs."""
+    from rich.table import Table
+    from agent import console
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest_path = Path(tmp) / "skill_manifest.json"
+        cold, cold_wall, _ = _run_probe(manifest_path)
+        warm, warm_wall, _ = _run_probe(manifest_path)
+        _, _, importtime = _run_probe(manifest_path, importtime=True)
+
+    table = Table(title="Startup time (s)", title_justify="left")
+    for column in ("phase", "cold", "warm"):
+        table.add_column(column, justify="left" if column == "phase" else "right")
+    for phase in cold["phases"]:
+        table.add_row(phase, f"{cold['phases'][phase]:.3f}", f"{warm['phases'][phase]:.3f}")
+    table.add_row("to first prompt", f"{cold['to_first_prompt']:.3f}", f"{warm['to_first_prompt']:.3f}", style="bold")
+    table.add_row("process (wall)", f"{cold_wall:.3f}", f"{warm_wall:.3f}")
+    for name in cold["deferred"]:
+        table.add_row(f"deferred: {name}", f"{cold['deferred'][name]:.3f}", f"{warm['deferred'][name]:.3f}",
+                      style="dim")
+    table.add_row("SKILL.md cache hits", f"{cold['manifest_hits']}/{cold['skills']}",
+                  f"{warm['manifest_hits']}/{warm['skills']}")
+    console.print(table)
+
+    imports = Table(title="Import time by package (-X importtime, self time)", title_justify="left")
+    for column in ("package", "ms", "modules"):
+        imports.add_column(column, justify="left" if column == "package" else "right")
+    for package, us, modules in summarize_importtime(importtime):
+        imports.add_row(package, f"{us / 1000:.1f}", str(modules))
+    console.print(imports)
+
 async def main():
+    args = parse_args()
+    if args.render_log:
+        print(f"Transcript written to {render_markdown(Path(args.render_log))}")
+        return
+    if args.startup_probe:
+        print(json.dumps(startup_probe(Path(args.startup_probe))))
+        return
+    if args.profile_startup:
+        profile_startup()
+        return
+
+    from dotenv import load_dotenv
     load_dotenv()
     
     # 1. Setup Agent
     api_key = get_api_key()
-    agent = DeepSeekMCPAgent(api_key=api_key)
+    agent = DeepSeekMCPAgent(api_key=api_key, markdown_log=not args.jsonl_only, render_mode=args.render,
+                             idle_ttl=args.idle_ttl or None,
+                             transport=TransportConfig(max_retries=args.llm_retries, hedge_after=args.hedge_after),
+                             skill_manifest=SkillManifest(SKILL_MANIFEST), tool_top_k=args.tool_top_k or None,
+                             preload_skills=not args.no_preload, tool_timeout=args.tool_timeout or None,
+                             budget=BudgetConfig(soft_tokens=args.soft_budget, hard_tokens=args.hard_budget,
+                                                 soft_cost=args.soft_cost, hard_cost=args.hard_cost,
+                                                 turn_hard_tokens=args.turn_budget))
     
     # 2. Setup Servers
-    current_dir = Path(__file__).parent
-    servers_dir = current_dir / "servers"
+    inprocess = () if args.inprocess is None else set(args.inprocess or INPROCESS_SKILLS)
+    register_servers(agent, ROOT_DIR / "servers", inprocess=inprocess)
     
-    # Scan for servers
-    if servers_dir.exists():
-        for item in servers_dir.iterdir():
-            if item.is_dir():
-                skill_path = item / "SKILL.md"
-                server_path = item / "server.py"
-                
-                if skill_path.exists() and server_path.exists():
-                    print(f"Loading server: {item.name}")
-                    agent.add_server(
-                        name=item.name,
-                        skill_md_path=skill_path,
-                        command=sys.executable,
-                        args=[str(server_path)]
-                    )
-    
-    # 3. Start Chat Loop
+    # 3. Warm up skill servers while the user types
+    if args.prewarm is not None:
+        warmed = agent.prewarm(args.prewarm or None)
+        if warmed:
+            print(f"Pre-warming skills: {', '.join(warmed)}")
+
+    # 4. Start Chat Loop
     try:
         await agent.chat_loop()
     except KeyboardInterrupt:
         pass
+    finally:
+        await agent.cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass # Ctrl-C at the prompt; the session was already cleaned up
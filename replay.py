@@ -0,0 +1,239 @@
+"""
+Replay a recorded session through DeepSeekMCPAgent.
+
+    python replay.py artifacts/logs/session_20250101_120000.jsonl -o replay.json
+    python replay.py <session.jsonl> --live-tools --compare replay.json
+
+The assistant messages in the log are served, step by step, by a local
+FakeOpenAIServer, so every turn runs through the real streaming, dispatch
+and logging code without calling the API. Tool results come from the log
+too, unless --live-tools re-executes the calls against the MCP servers in
+servers/ (tools with side effects still use the recorded result unless
+--allow-side-effects is given). The report compares recorded and replayed
+turn durations and, for live tools, how many results differ.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import agent as agent_module
+from agent import DeepSeekMCPAgent
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run import compare
+from main import register_servers
+
+ROOT_DIR = Path(__file__).parent
+# Answer for requests that are not part of the recording, e.g. history summaries
+UNRECORDED_REPLY = {"content": "Earlier conversation (not available during replay)."}
+
+def _parse_time(timestamp: Optional[str]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromisoformat(timestamp) if timestamp else None
+
+def load_session(path: Path) -> List[Dict[str, Any]]:
+    """Split a session log into turns of recorded assistant steps and tool results.
+
+    Logs written before tool calls carried their id are matched to results
+    by tool name, in order.
+    """
+    turns: List[Dict[str, Any]] = []
+    metrics = None
+    with open(path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    for entry in entries:
+        role = entry.get("role")
+        if role == "user":
+            turns.append({"prompt": entry["content"], "started_at": entry.get("timestamp"),
+                          "ended_at": entry.get("timestamp"), "steps": [], "results": {}, "unanswered": [],
+                          "preloaded": []})
+            continue
+        if not turns:
+            continue
+        turn = turns[-1]
+        if role == "llm_metrics":
+            metrics = entry
+        elif role == "assistant":
+            turn["steps"].append({"reasoning": entry.get("reasoning_content") or "",
+                                  "content": entry.get("content") or "", "tool_calls": [], "metrics": metrics})
+            metrics = None
+        elif role == "tool_call" and turn["steps"]:
+            step = turn["steps"][-1]
+            call_id = entry.get("tool_call_id") or f"replay_{len(turns)}_{len(turn['steps'])}_{len(step['tool_calls'])}"
+            step["tool_calls"].append({"id": call_id, "name": entry["tool_name"],
+                                       "arguments": entry.get("arguments") or "{}"})
+            turn["unanswered"].append(step["tool_calls"][-1])
+        elif role == "skill_preload":
+            turn["preloaded"] = entry.get("skills") or []
+        elif role == "tool_result":
+            call_id = entry.get("tool_call_id")
+            if call_id is None:
+                call = next((c for c in turn["unanswered"] if c["name"] == entry.get("tool_name")), None)
+                call_id = call["id"] if call else None
+            if call_id is not None:
+                turn["results"][call_id] = entry["content"]
+                turn["unanswered"] = [c for c in turn["unanswered"] if c["id"] != call_id]
+        else:
+            continue
+        turn["ended_at"] = entry.get("timestamp") or turn["ended_at"]
+
+    for turn in turns:
+        del turn["unanswered"]
+        start, end = _parse_time(turn["started_at"]), _parse_time(turn["ended_at"])
+        turn["recorded_s"] = round((end - start).total_seconds(), 3) if start and end else None
+    return [turn for turn in turns if turn["steps"]]
+
+class SessionReplay:
+    """Serves the recorded assistant steps of the current turn to the fake server."""
+
+    def __init__(self, turns: List[Dict[str, Any]], simulate_latency: bool = False, chunk_chars: int = 8):
+        self.turns = turns
+        self.simulate_latency = simulate_latency
+        self.chunk_chars = chunk_chars
+        self.current = 0
+        self.missing_steps = 0
+
+    def respond(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+        turn = self.turns[self.current]
+        # Preloaded skill instructions are appended to the prompt
+        if last_user < 0 or not (messages[last_user].get("content") or "").startswith(turn["prompt"]):
+            return UNRECORDED_REPLY
+        step = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+        if step >= len(turn["steps"]):
+            self.missing_steps += 1
+            return {"content": turn["steps"][-1]["content"]}
+
+        recorded = turn["steps"][step]
+        reply = {key: recorded[key] for key in ("reasoning", "content", "tool_calls")}
+        metrics = recorded["metrics"] or {}
+        if self.simulate_latency and metrics.get("ttft_s") is not None:
+            text = reply["reasoning"] + reply["content"] + "".join(tc["arguments"] for tc in reply["tool_calls"])
+            chunks = max(1, math.ceil(len(text) / self.chunk_chars) + 2 * len(reply["tool_calls"]))
+            reply["ttft"] = metrics["ttft_s"]
+            reply["chunk_delay"] = max(0.0, metrics["duration_s"] - metrics["ttft_s"]) / chunks
+        return reply
+
+class ReplayAgent(DeepSeekMCPAgent):
+    """Agent whose tool results come from the recording unless tools run live."""
+
+    def __init__(self, *args, live_tools: bool = False, allow_side_effects: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.live_tools = live_tools
+        self.allow_side_effects = allow_side_effects
+        self.recorded_results: Dict[str, str] = {}
+        self.recorded_preloads: List[str] = [] # Skills the recorded turn loaded in advance
+        self.divergent_results: List[str] = [] # Tool call ids whose live result differs
+
+    def _predict_skills(self, user_input: str) -> List[str]:
+        return self.recorded_preloads
+
+    async def _run_tool_call(self, tc: Dict[str, Any]) -> str:
+        recorded = self.recorded_results.get(tc["id"])
+        name = tc["function"]["name"]
+        if not self.live_tools or (self._has_side_effects(name) and not self.allow_side_effects):
+            return recorded if recorded is not None else f"Error: no recorded result for {name}"
+        result = await super()._run_tool_call(tc)
+        if recorded is not None and result != recorded:
+            self.divergent_results.append(tc["id"])
+        return result
+
+async def replay_session(
+    log_path: Path,
+    live_tools: bool = False,
+    allow_side_effects: bool = False,
+    simulate_latency: bool = False,
+    log_dir: Optional[Path] = None,
+) -> Dict[str, Any]:
+    """Replay every turn of a session log and report recorded vs. replayed timings."""
+    turns = load_session(log_path)
+    if not turns:
+        raise ValueError(f"{log_path}: no turns with recorded assistant messages")
+    replay = SessionReplay(turns, simulate_latency)
+
+    with FakeOpenAIServer(responder=replay.respond, chunk_chars=replay.chunk_chars) as server:
+        agent = ReplayAgent("replay-key", base_url=server.base_url, render_mode="none", markdown_log=False,
+                            live_tools=live_tools, allow_side_effects=allow_side_effects)
+        agent.log_dir = log_dir or ROOT_DIR / "artifacts" / "logs" / "replays"
+        agent.log_dir.mkdir(parents=True, exist_ok=True)
+        agent.trace_dir = agent.log_dir / "traces" # Apart from the traces of live sessions
+        if live_tools:
+            register_servers(agent, ROOT_DIR / "servers", verbose=False)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        agent.start_session(f"replay_{log_path.stem}_{timestamp}")
+
+        results = []
+        try:
+            for index, turn in enumerate(turns):
+                replay.current = index
+                agent.recorded_results = turn["results"]
+                agent.recorded_preloads = turn["preloaded"]
+                start = time.perf_counter()
+                answer = await agent.run_turn(turn["prompt"])
+                results.append({
+                    "prompt": turn["prompt"][:80],
+                    "recorded_s": turn["recorded_s"],
+                    "replay_s": round(time.perf_counter() - start, 3),
+                    "llm_requests": len(turn["steps"]),
+                    "tool_calls": sum(len(step["tool_calls"]) for step in turn["steps"]),
+                    "answer_matches": answer == turn["steps"][-1]["content"],
+                })
+        finally:
+            await agent.cleanup()
+
+    return {
+        "source": str(log_path),
+        "replay_session": agent.session_id,
+        "mode": "live-tools" if live_tools else "recorded-tools",
+        "simulated_latency": simulate_latency,
+        "turns": results,
+        "totals": {
+            "recorded_s": round(sum(t["recorded_s"] or 0 for t in results), 3),
+            "replay_s": round(sum(t["replay_s"] for t in results), 3),
+            "tool_calls": agent.tool_call_count,
+            "divergent_tool_results": len(agent.divergent_results),
+            "missing_steps": replay.missing_steps,
+        },
+        "tool_latency": agent.tracer.summary()["tools"],
+        "llm": agent.prompt_cache_summary(),
+    }
+
+def _comparable(report: Dict[str, Any]) -> Dict[str, Any]:
+    return {"scenarios": {"totals": report["totals"], "tool_latency": report["tool_latency"]}}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a recorded session log through the agent.")
+    parser.add_argument("log", type=Path, help="Session JSONL from artifacts/logs")
+    parser.add_argument("-o", "--output", type=Path, help="Write the replay report as JSON")
+    parser.add_argument("--live-tools", action="store_true", help="Re-execute tool calls against the MCP servers")
+    parser.add_argument("--allow-side-effects", action="store_true",
+                        help="With --live-tools, also re-run tools that change files or remote state")
+    parser.add_argument("--simulate-latency", action="store_true",
+                        help="Serve replies with the recorded TTFT and stream duration")
+    parser.add_argument("--compare", type=Path, help="Earlier replay report to diff against")
+    parser.add_argument("--verbose", action="store_true", help="Show agent console output")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    agent_module.console.quiet = not args.verbose
+    report = asyncio.run(replay_session(args.log, args.live_tools, args.allow_side_effects, args.simulate_latency))
+
+    for i, turn in enumerate(report["turns"], 1):
+        match = "" if turn["answer_matches"] else "  (answer differs)"
+        print(f"turn {i}: recorded {turn['recorded_s']}s, replay {turn['replay_s']}s, "
+              f"{turn['tool_calls']} tool calls{match}")
+    print(json.dumps(report["totals"], indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Report written to {args.output}")
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        print("\n".join(compare(_comparable(baseline), _comparable(report))))
+
+if __name__ == "__main__":
+    main()
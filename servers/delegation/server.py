@@ -165,7 +165,7 @@ async def run_task():
             # This is tricky because we want to reuse the agent logic.
             # Best approach: Use the client directly with history.
             
-            response = agent.client.chat.completions.create(
+            response = await agent.client.chat.completions.create(
                 model="deepseek-reasoner",
                 messages=agent.messages,
                 tools=tools if tools else None,
@@ -0,0 +1,278 @@
+"""
+Multi-session agent service for local use.
+
+    python service.py --port 8765
+
+Hosts many DeepSeekMCPAgent sessions in one process. Skills in
+SHAREABLE_SKILLS run one server process shared by every session; the
+others are spawned per session. Only loopback clients are accepted.
+
+    POST   /sessions                 -> {"session_id": ...}
+    POST   /sessions/{id}/messages   {"content": "..."} -> streamed events
+    GET    /sessions                 -> open sessions
+    GET    /sessions/{id}            -> one session's usage and skills
+    DELETE /sessions/{id}            -> close the session
+    GET    /health                   -> session and shared server counts
+
+Replies stream as NDJSON, one event per line: "stream_start", "reasoning",
+"content" and "tool_call"/"tool_result" while the turn runs, then "done"
+(with the reply) or "error". Requests that accept text/event-stream get
+the same events as server-sent events. A session runs one turn at a time.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import ipaddress
+import json
+import secrets
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+import agent as agent_module
+from agent import DeepSeekMCPAgent, SkillManifest, SkillServerPool, TransportConfig
+from batch import get_api_key
+from main import SKILL_MANIFEST, register_servers
+
+ROOT_DIR = Path(__file__).parent
+
+class ServiceError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+class Session:
+    """One agent conversation hosted by the service."""
+
+    def __init__(self, agent: DeepSeekMCPAgent):
+        self.agent = agent
+        self.created_at = datetime.datetime.now().isoformat()
+        self.last_active = time.monotonic()
+        self.busy = False
+        self.turns = 0
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.agent.session_id,
+            "created_at": self.created_at,
+            "busy": self.busy,
+            "turns": self.turns,
+            "idle_s": round(time.monotonic() - self.last_active, 1),
+            "usage": dict(self.agent.usage),
+            "skills_loaded": [skill.config.name for skill in self.agent.skills if skill.loaded],
+        }
+
+class AgentService:
+    """Creates, runs and expires agent sessions; serves them over HTTP via app()."""
+
+    def __init__(self, make_agent: Callable[[], DeepSeekMCPAgent], pool: Optional[SkillServerPool] = None,
+                 max_sessions: int = 32, session_ttl: Optional[float] = 3600.0):
+        self.make_agent = make_agent
+        self.pool = pool
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl # Close sessions idle this long
+        self.sessions: Dict[str, Session] = {}
+        self._turn_tasks: set = set()
+        self._reaper: Optional[asyncio.Task] = None
+
+    def create_session(self) -> Session:
+        if len(self.sessions) >= self.max_sessions:
+            raise ServiceError(503, f"session limit ({self.max_sessions}) reached")
+        agent = self.make_agent()
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        agent.start_session(f"session_{timestamp}_{secrets.token_hex(3)}")
+        session = Session(agent)
+        self.sessions[agent.session_id] = session
+        return session
+
+    def get_session(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise ServiceError(404, f"no session {session_id}")
+        return session
+
+    async def close_session(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            await session.agent.cleanup()
+
+    async def stream_turn(self, session: Session, content: str) -> AsyncIterator[Dict[str, Any]]:
+        """Run one turn and yield its events.
+
+        The turn runs in its own task, so it completes (and the history stays
+        consistent) even if the client disconnects midway.
+        """
+        if session.busy:
+            raise ServiceError(409, "a turn is already running in this session")
+        session.busy = True
+        events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+        async def turn():
+            agent = session.agent
+            agent.event_handler = events.put_nowait
+            try:
+                reply = await agent.run_turn(content)
+                events.put_nowait({"type": "done", "reply": reply, "usage": dict(agent.usage)})
+            except Exception as e:
+                events.put_nowait({"type": "error", "error": f"{type(e).__name__}: {e}"})
+            finally:
+                agent.event_handler = None
+                session.busy = False
+                session.turns += 1
+                session.last_active = time.monotonic()
+
+        task = asyncio.create_task(turn())
+        self._turn_tasks.add(task)
+        task.add_done_callback(self._turn_tasks.discard)
+        while True:
+            event = await events.get()
+            yield event
+            if event["type"] in ("done", "error"):
+                return
+
+    async def _expire_idle_sessions(self):
+        interval = max(1.0, min(self.session_ttl / 4, 60.0))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if not session.busy and now - session.last_active > self.session_ttl:
+                    await self.close_session(session_id)
+
+    def start(self):
+        if self.session_ttl and self._reaper is None:
+            self._reaper = asyncio.create_task(self._expire_idle_sessions())
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+        await asyncio.gather(*self._turn_tasks, return_exceptions=True)
+        await asyncio.gather(*(self.close_session(session_id) for session_id in list(self.sessions)))
+        if self.pool is not None:
+            await self.pool.close()
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self.sessions),
+            "busy": sum(1 for s in self.sessions.values() if s.busy),
+            "shared_servers": sorted(name for name, w in (self.pool.wrappers if self.pool else {}).items()
+                                     if w.session is not None),
+        }
+
+    # HTTP
+
+    async def _create(self, request: Request):
+        return JSONResponse({"session_id": self.create_session().agent.session_id}, status_code=201)
+
+    async def _list(self, request: Request):
+        return JSONResponse([session.describe() for session in self.sessions.values()])
+
+    async def _show(self, request: Request):
+        return JSONResponse(self.get_session(request.path_params["session_id"]).describe())
+
+    async def _delete(self, request: Request):
+        self.get_session(request.path_params["session_id"])
+        await self.close_session(request.path_params["session_id"])
+        return JSONResponse({"closed": request.path_params["session_id"]})
+
+    async def _health(self, request: Request):
+        return JSONResponse(self.health())
+
+    async def _message(self, request: Request):
+        session = self.get_session(request.path_params["session_id"])
+        try:
+            content = (await request.json())["content"]
+        except (ValueError, KeyError, TypeError):
+            raise ServiceError(400, 'expected a JSON body with "content"')
+        events = self.stream_turn(session, content)
+        first = await events.__anext__() # Raises ServiceError before any response is sent
+
+        sse = "text/event-stream" in request.headers.get("accept", "")
+
+        async def body():
+            event = first
+            while True:
+                line = json.dumps(event, ensure_ascii=False, default=str)
+                yield f"event: {event['type']}\ndata: {line}\n\n" if sse else line + "\n"
+                if event["type"] in ("done", "error"):
+                    return
+                event = await events.__anext__()
+
+        return StreamingResponse(body(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
+    def app(self) -> Starlette:
+        async def local_only(request: Request, call_next):
+            try:
+                loopback = ipaddress.ip_address(request.client.host).is_loopback
+            except (AttributeError, ValueError):
+                loopback = False
+            if not loopback:
+                return JSONResponse({"error": "service accepts local clients only"}, status_code=403)
+            return await call_next(request)
+
+        async def service_error(request: Request, error: ServiceError):
+            return JSONResponse({"error": str(error)}, status_code=error.status_code)
+
+        @contextlib.asynccontextmanager
+        async def lifespan(app):
+            self.start()
+            try:
+                yield
+            finally:
+                await self.close()
+
+        return Starlette(
+            routes=[
+                Route("/health", self._health),
+                Route("/sessions", self._create, methods=["POST"]),
+                Route("/sessions", self._list, methods=["GET"]),
+                Route("/sessions/{session_id}", self._show, methods=["GET"]),
+                Route("/sessions/{session_id}", self._delete, methods=["DELETE"]),
+                Route("/sessions/{session_id}/messages", self._message, methods=["POST"]),
+            ],
+            middleware=[Middleware(BaseHTTPMiddleware, dispatch=local_only)],
+            exception_handlers={ServiceError: service_error},
+            lifespan=lifespan,
+        )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve many agent sessions from one process (local only).")
+    parser.add_argument("--host", default="127.0.0.1", help="Loopback address to bind")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-sessions", type=int, default=32)
+    parser.add_argument("--session-ttl", type=float, default=3600.0, help="Close sessions idle this many seconds")
+    parser.add_argument("--no-shared-servers", action="store_true", help="Spawn every skill server per session")
+    parser.add_argument("--hedge-after", type=float, metavar="SECONDS", help="See main.py --hedge-after")
+    parser.add_argument("--verbose", action="store_true", help="Show agent console output")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not ipaddress.ip_address(args.host).is_loopback:
+        raise SystemExit("service.py only binds loopback addresses")
+    api_key = get_api_key()
+    agent_module.console.quiet = not args.verbose
+    pool = None if args.no_shared_servers else SkillServerPool()
+    manifest = SkillManifest(SKILL_MANIFEST)
+
+    def make_agent() -> DeepSeekMCPAgent:
+        agent = DeepSeekMCPAgent(api_key=api_key, render_mode="none", server_pool=pool,
+                                 transport=TransportConfig(hedge_after=args.hedge_after), skill_manifest=manifest)
+        register_servers(agent, ROOT_DIR / "servers", verbose=False)
+        return agent
+
+    service = AgentService(make_agent, pool, args.max_sessions, args.session_ttl or None)
+    print(f"Serving agent sessions on http://{args.host}:{args.port}")
+    uvicorn.run(service.app(), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Minimal MCP server used by the integration tests.
+"""
+import asyncio
+import os
+import time
+
+from mcp.server.fastmcp import FastMCP
+
+mcp = FastMCP("stub", log_level="ERROR")
+
+@mcp.tool()
+def echo(text: str) -> str:
+    """Return the text unchanged."""
+    return text
+
+@mcp.tool()
+def pid() -> str:
+    """Return the server's process id."""
+    return str(os.getpid())
+
+@mcp.tool()
+def sleep(seconds: float) -> str:
+    """Block for the given number of seconds."""
+    time.sleep(seconds)
+    return f"slept {seconds}"
+
+notes = []
+
+@mcp.tool()
+def note(text: str) -> str:
+    """Remember the text; returns how many notes this server holds."""
+    notes.append(text)
+    return str(len(notes))
+
+cancelled = 0
+
+@mcp.tool()
+async def wait(seconds: float) -> str:
+    """Wait without blocking the server; counts waits cancelled by the client."""
+    global cancelled
+    try:
+        await asyncio.sleep(seconds)
+    except asyncio.CancelledError:
+        cancelled += 1
+        raise
+    return f"waited {seconds}"
+
+@mcp.tool()
+def cancelled_waits() -> str:
+    """Return how many waits were cancelled."""
+    return str(cancelled)
+
+@mcp.tool()
+def crash() -> str:
+    """Exit the server process without replying."""
+    os._exit(1)
+
+if __name__ == "__main__":
+    mcp.run()
@@ -4,8 +4,13 @@ Integration tests for skill loading.
 import pytest
 import tempfile
 import os
+import sys
+import asyncio
+import time
 from pathlib import Path
 
+from agent import DeepSeekMCPAgent, SkillServerPool
+
 # This is a placeholder for future integration tests
 # Will be expanded when we implement actual skill server testing
 
@@ -37,5 +42,332 @@ def test_requirements_file():
     assert "python-dotenv" in content
 
 
+def _add_real_server(agent, name):
+    server_dir = Path(__file__).parent.parent.parent / "servers" / name
+    agent.add_server(name, server_dir / "SKILL.md", sys.executable, [str(server_dir / "server.py")])
+    return agent.skill_index[name]
+
+
+def test_connect_and_disconnect_update_tool_index():
+    """Test that the routing table follows a real server's lifecycle"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        skill = _add_real_server(agent, "os_manipulation")
+
+        await agent.call_tool("skill_os_manipulation", {})
+        assert agent.tool_index["list_directory"][0] is skill
+
+        await agent.disconnect_server(skill)
+        assert skill.session is None
+        assert "list_directory" not in agent.tool_index
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_loaders_clean_up():
+    """Skills loaded from concurrently dispatched tool calls shut down cleanly"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        _add_real_server(agent, "os_manipulation")
+        _add_real_server(agent, "git")
+
+        calls = [
+            {"id": "1", "type": "function", "function": {"name": "skill_os_manipulation", "arguments": ""}},
+            {"id": "2", "type": "function", "function": {"name": "skill_git", "arguments": ""}},
+        ]
+        await agent.execute_tool_calls(calls)
+        assert "list_directory" in agent.tool_index
+        assert "git_status" in agent.tool_index
+
+        await agent.cleanup()
+        assert agent.tool_index == {}
+
+    asyncio.run(scenario())
+
+
+def test_loader_and_tool_in_one_message():
+    """A tool called in the same message as its skill's loader finds the loaded tools"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        _add_stub_server(agent)
+
+        calls = [
+            {"id": "1", "type": "function", "function": {"name": "echo", "arguments": '{"text": "first"}'}},
+            {"id": "2", "type": "function", "function": {"name": "skill_stub", "arguments": ""}},
+            {"id": "3", "type": "function", "function": {"name": "echo", "arguments": '{"text": "hi"}'}},
+        ]
+        results = await agent.execute_tool_calls(calls)
+        assert [tc["id"] for tc, _ in results] == ["1", "2", "3"]
+        assert results[0][1] == "first"
+        assert results[2][1] == "hi"
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_prewarmed_skill_loads_without_spawning():
+    """A pre-warmed skill's loader returns an already connected session"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        skill = _add_real_server(agent, "os_manipulation")
+
+        assert agent.prewarm(["os_manipulation"]) == ["os_manipulation"]
+        await asyncio.gather(*agent.prewarm_tasks)
+        assert skill.session is not None
+        assert not skill.loaded
+        assert agent.connect_metrics["os_manipulation"] > 0
+
+        session = skill.session
+        await agent.call_tool("skill_os_manipulation", {})
+        assert skill.session is session
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_read_only_results_are_cached(tmp_path):
+    """Repeated listings are served from cache until a mutating tool touches the folder"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        _add_real_server(agent, "os_manipulation")
+        await agent.call_tool("skill_os_manipulation", {})
+
+        first = await agent.call_tool("list_directory", {"path": str(tmp_path)})
+        second = await agent.call_tool("list_directory", {"path": str(tmp_path)})
+        assert first == second
+        assert agent.tool_cache.hits == 1
+
+        await agent.call_tool("create_directories", {"paths": [str(tmp_path / "new")]})
+        third = await agent.call_tool("list_directory", {"path": str(tmp_path)})
+        assert "[DIR] new" in third
+        assert agent.tool_cache.hits == 1
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_sessions_share_pooled_servers():
+    """Agents attached to one pool reuse a single server process for shareable skills"""
+    async def scenario():
+        pool = SkillServerPool()
+        agents = [DeepSeekMCPAgent("fake-api-key", server_pool=pool) for _ in range(2)]
+        for agent in agents:
+            server_dir = Path(__file__).parent.parent.parent / "servers" / "os_manipulation"
+            agent.add_server("os_manipulation", server_dir / "SKILL.md", sys.executable,
+                             [str(server_dir / "server.py")], shareable=True)
+
+        await asyncio.gather(*(agent.call_tool("skill_os_manipulation", {}) for agent in agents))
+        sessions = {id(agent.skill_index["os_manipulation"].session) for agent in agents}
+        assert len(sessions) == 1
+        assert len(pool.wrappers) == 1
+
+        result = await agents[1].call_tool("list_directory", {"path": "."})
+        assert "[FILE]" in result
+
+        for agent in agents:
+            await agent.cleanup()
+        assert pool.wrappers["os_manipulation"].session is not None # Still owned by the pool
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def _add_stub_server(agent, name="stub"):
+    stub = Path(__file__).parent / "stub_server.py"
+    agent.add_server(name, stub.parent / "STUB_SKILL.md", sys.executable, [str(stub)])
+    return agent.skill_index[name]
+
+
+def test_crashed_server_is_restarted():
+    """A lost server is restarted on the next call; side-effect calls are not retried"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        skill = _add_stub_server(agent)
+        await agent.call_tool("skill_stub", {})
+        skill.side_effect_tools.add("crash")
+        first_pid = await agent.call_tool("pid", {})
+
+        result = await agent.call_tool("crash", {})
+        assert "may or may not have completed" in result
+        assert skill.calls == 2
+
+        second_pid = await agent.call_tool("pid", {})
+        assert second_pid.isdigit() and second_pid != first_pid
+        assert await agent.call_tool("echo", {"text": "hi"}) == "hi"
+
+        health = agent.skill_health()["stub"]
+        assert health["status"] == "connected"
+        assert health["restarts"] == 1
+        assert health["errors"] == 1
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_read_only_call_is_retried_after_crash():
+    """A read-only call that hits a dead server is retried on a fresh one"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        skill = _add_stub_server(agent)
+        await agent.call_tool("skill_stub", {})
+        os.kill(int(await agent.call_tool("pid", {})), 9)
+        await asyncio.sleep(0.2)
+
+        assert await agent.call_tool("echo", {"text": "again"}) == "again"
+        assert skill.restart_count == 1
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_idle_server_is_evicted_and_reconnected():
+    """Idle servers are stopped and transparently restarted on the next call"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key", idle_ttl=0.3)
+        skill = _add_stub_server(agent)
+        await agent.call_tool("skill_stub", {})
+
+        # A long call is in flight, so the server must not be evicted under it
+        assert await agent.call_tool("sleep", {"seconds": 0.8}) == "slept 0.8"
+        assert skill.evictions == 0
+
+        await asyncio.sleep(1.0)
+        assert skill.session is None
+        assert skill.evictions == 1
+        assert agent.skill_health()["stub"]["status"] == "evicted"
+        assert "echo" in agent.tool_index
+
+        assert await agent.call_tool("echo", {"text": "back"}) == "back"
+        assert skill.session is not None
+        assert skill.restart_count == 0
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_listing_tools_does_not_restart_an_evicted_server():
+    """An evicted skill keeps its tools listed but stays down until one is called"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key", idle_ttl=0.3)
+        skill = _add_stub_server(agent)
+        await agent.call_tool("skill_stub", {})
+
+        await asyncio.sleep(1.0)
+        assert skill.evictions == 1
+        tools = await agent.list_tools()
+        assert "echo" in [t["function"]["name"] for t in tools]
+        assert skill.session is None
+        assert agent.skill_health()["stub"]["status"] == "evicted"
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_inprocess_skill_keeps_the_loop_responsive():
+    """An in-process skill answers from this process and runs sync tools in threads"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key")
+        stub = Path(__file__).parent / "stub_server.py"
+        agent.add_server("stub", stub.parent / "STUB_SKILL.md", sys.executable, [str(stub)], transport="inprocess")
+        await agent.call_tool("skill_stub", {})
+        assert agent.connect_metrics["stub"] < 1.0
+        assert int(await agent.call_tool("pid", {})) == os.getpid()
+
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.05)
+                ticks += 1
+        task = asyncio.create_task(ticker())
+        assert await agent.call_tool("sleep", {"seconds": 0.5}) == "slept 0.5"
+        task.cancel()
+        assert ticks >= 5
+
+        await agent.cleanup()
+        assert agent.skill_index["stub"].session is None
+
+    asyncio.run(scenario())
+
+
+def test_inprocess_skills_keep_state_per_agent():
+    """Each agent imports its own copy of an in-process skill"""
+    async def scenario():
+        stub = Path(__file__).parent / "stub_server.py"
+        agents = [DeepSeekMCPAgent("fake-api-key", idle_ttl=None) for _ in range(2)]
+        for agent in agents:
+            agent.add_server("stub", stub.parent / "STUB_SKILL.md", sys.executable, [str(stub)], transport="inprocess")
+            await agent.call_tool("skill_stub", {})
+
+        assert await agents[0].call_tool("note", {"text": "a"}) == "1"
+        assert await agents[0].call_tool("note", {"text": "b"}) == "2"
+        assert await agents[1].call_tool("note", {"text": "c"}) == "1"
+
+        # A reconnect keeps the agent's own copy
+        skill = agents[0].skill_index["stub"]
+        await skill.close()
+        assert await agents[0].call_tool("note", {"text": "d"}) == "3"
+
+        for agent in agents:
+            await agent.cleanup()
+
+    asyncio.run(scenario())
+
+def test_tool_deadline_cancels_the_server_request():
+    """A call past its deadline returns an error quickly and stops running on the server"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key", tool_timeout=0.5)
+        skill = _add_stub_server(agent)
+        skill.config.tool_timeouts = {"echo": 0.1}
+        assert agent._tool_deadline(skill, "wait") == 0.5
+        assert agent._tool_deadline(skill, "echo") == 0.1
+        assert agent._tool_deadline(skill, "git_clone") == 300.0
+        await agent.call_tool("skill_stub", {})
+
+        start = time.perf_counter()
+        result = await agent.call_tool("wait", {"seconds": 30})
+        assert time.perf_counter() - start < 5
+        assert "did not finish within 0.5s" in result
+        await asyncio.sleep(0.2)
+        assert await agent.call_tool("cancelled_waits", {}) == "1"
+        assert skill.restart_count == 0
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_call_is_cancelled_on_the_server():
+    """Cancelling the caller also cancels the request on the server"""
+    async def scenario():
+        agent = DeepSeekMCPAgent("fake-api-key", tool_timeout=None)
+        _add_stub_server(agent)
+        await agent.call_tool("skill_stub", {})
+
+        # Only the cancelled one of two concurrent calls on the session stops
+        other = asyncio.create_task(agent.call_tool("wait", {"seconds": 1.5}))
+        task = asyncio.create_task(agent.call_tool("wait", {"seconds": 30}))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.2)
+        assert await agent.call_tool("cancelled_waits", {}) == "1"
+        assert await other == "waited 1.5"
+
+        await agent.cleanup()
+
+    asyncio.run(scenario())
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
@@ -4,11 +4,22 @@ Unit tests for agent.py without mocks.
 import pytest
 import sys
 import os
+import json
+import subprocess
+import time
+import asyncio
 from pathlib import Path
 
+import openai
+
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from agent import DeepSeekMCPAgent, MCPSkillWrapper, MCPSkillConfig
+from agent import (
+    DEFAULT_TRACE_DIR, BM25Index, BudgetConfig, BudgetGovernor, DeepSeekMCPAgent, MCPSkillWrapper, MCPSkillConfig, MessageStore, SkillManifest, SkillPredictor, ToolResultCache, SessionLogger,
+    StreamAccumulator, StreamRenderer, Tracer, TransportConfig, estimate_tokens, render_markdown,
+)
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run import SCRIPTS, make_agent
 
 
 class TestMCPSkillWrapper:
@@ -91,6 +102,14 @@ class TestDeepSeekMCPAgent:
         assert agent.messages == []
         assert agent.skills == []
         assert agent.client.api_key == "fake-api-key"
+
+    def test_client_is_async(self):
+        """LLM streaming must not block the event loop"""
+        from openai import AsyncOpenAI
+
+        agent = DeepSeekMCPAgent("fake-api-key")
+
+        assert isinstance(agent.client, AsyncOpenAI)
         
     def test_add_skill(self, tmp_path):
         """Test adding a skill"""
@@ -117,5 +136,1047 @@ class TestDeepSeekMCPAgent:
         assert agent.skills == []
 
 
+class TestStartup:
+    """Test the deferred client and the cached skill manifest"""
+
+    def test_client_created_on_first_use(self):
+        agent = DeepSeekMCPAgent("fake-api-key")
+
+        assert agent.transport._client is None
+        assert agent.client is agent.client
+        assert agent.transport._client is not None
+
+    def test_cleanup_without_client(self):
+        agent = DeepSeekMCPAgent("fake-api-key", render_mode="none")
+
+        asyncio.run(agent.cleanup())
+        assert agent.transport._client is None
+
+    def test_manifest_reused_until_skill_md_changes(self, tmp_path):
+        skill_md = tmp_path / "SKILL.md"
+        skill_md.write_text("---\nname: demo\ndescription: First\n---\n# Demo\nUse it well.\n", encoding="utf-8")
+        config = MCPSkillConfig(name="demo", command="echo", args=[], skill_md_path=skill_md)
+        path = tmp_path / "manifest.json"
+
+        manifest = SkillManifest(path)
+        fresh = MCPSkillWrapper(config, manifest)
+        manifest.save()
+        assert (manifest.hits, manifest.misses) == (0, 1)
+
+        manifest = SkillManifest(path)
+        cached = MCPSkillWrapper(config, manifest)
+        assert manifest.hits == 1
+        assert cached.description == fresh.description == "First"
+        assert cached.get_loader_tool_def() == fresh.get_loader_tool_def()
+
+        skill_md.write_text("---\nname: demo\ndescription: Second version\n---\n", encoding="utf-8")
+        manifest = SkillManifest(path)
+        assert MCPSkillWrapper(config, manifest).description == "Second version"
+        assert manifest.misses == 1
+
+    def test_corrupt_manifest_is_ignored(self, tmp_path):
+        path = tmp_path / "manifest.json"
+        path.write_text("{not json", encoding="utf-8")
+
+        assert SkillManifest(path).entries == {}
+
+    def test_summarize_importtime(self):
+        from main import summarize_importtime
+
+        stderr = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 |     openai._types",
+            "import time:       300 |        400 |   openai",
+            "import time:        50 |         50 | json",
+            "unrelated warning",
+        ])
+
+        assert summarize_importtime(stderr) == [("openai", 400, 2), ("json", 50, 1)]
+        assert summarize_importtime(stderr, top=1) == [("openai", 400, 2)]
+
+
+class TestMessageStore:
+    """Test running context-size accounting"""
+
+    def test_estimate_tokens(self):
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("abcdefgh") == 2
+        assert estimate_tokens("你好") == 2
+
+    def test_running_totals(self):
+        store = MessageStore([{"role": "system", "content": "abcd"}])
+        store.append({"role": "assistant", "content": "ab", "reasoning_content": "cd"})
+        store.append({
+            "role": "assistant", "content": "",
+            "tool_calls": [{"id": "1", "type": "function", "function": {"name": "f", "arguments": "{}"}}]
+        })
+
+        assert store.total_chars == 10
+        assert store.total_tokens == 3
+
+        del store[1:]
+        assert store.total_chars == 4
+        store.pop()
+        assert store.total_chars == 0
+        assert store.total_tokens == 0
+
+    def test_agent_wraps_assigned_history(self):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        agent.messages = [{"role": "user", "content": "x" * 40}]
+
+        assert isinstance(agent.messages, MessageStore)
+        assert agent.messages.total_tokens == 10
+
+
+class SummarizingAgent(DeepSeekMCPAgent):
+    """Agent whose summarizer answers locally and counts requests."""
+
+    def __init__(self, delay=0.0):
+        super().__init__("fake-api-key", max_context_tokens=1000)
+        self.summary_chunk_tokens = 200
+        self.keep_last_messages = 2
+        self.prompts = []
+        self.delay = delay
+
+    async def send_llm_request(self, prompt, system_prompt=None, tools=None, model="deepseek-reasoner"):
+        self.prompts.append(prompt)
+        await asyncio.sleep(self.delay)
+        return f"summary {len(self.prompts)}"
+
+
+def _fill_history(agent, turns):
+    agent.messages = [{"role": "system", "content": "sys"}]
+    for i in range(turns):
+        agent.messages.append({
+            "role": "assistant", "content": f"turn {i} " + "x" * 400,
+            "tool_calls": [{"id": f"c{i}", "type": "function", "function": {"name": "git_status", "arguments": "{}"}}]
+        })
+        agent.messages.append({"role": "tool", "tool_call_id": f"c{i}", "content": "clean"})
+
+
+class TestRollingSummary:
+    """Test background, chunked summarization of old history"""
+
+    def test_summarizes_in_background(self):
+        agent = SummarizingAgent(delay=0.5)
+        _fill_history(agent, 8) # ~800 tokens: past the soft threshold, under the budget
+
+        async def scenario():
+            start = time.perf_counter()
+            await agent._condense_context()
+            assert time.perf_counter() - start < 0.1
+            assert agent._summary_task is not None
+            await agent._summary_task
+            await agent._condense_context()
+
+        asyncio.run(scenario())
+
+        assert agent.messages[1]["content"].startswith("## Previous Conversation Summary")
+        assert agent.messages[2]["role"] == "assistant" # Tool results stay with their call
+        assert agent.messages.total_tokens < 800
+
+    def test_hard_limit_waits_for_bounded_chunks(self):
+        agent = SummarizingAgent()
+        _fill_history(agent, 12)
+
+        asyncio.run(agent._condense_context())
+
+        assert agent.messages.total_tokens <= agent.max_context_tokens
+        assert all(len(p) < 2000 for p in agent.prompts)
+        assert all(m["role"] != "tool" or prev["role"] in ("assistant", "tool")
+                   for prev, m in zip(agent.messages, agent.messages[1:]))
+
+    def test_summary_is_followed_by_an_assistant_message(self):
+        agent = SummarizingAgent()
+        agent.messages = [{"role": "system", "content": "sys"}]
+        for i in range(12):
+            agent.messages.append({"role": "user", "content": f"question {i} " + "x" * 200})
+            agent.messages.append({"role": "assistant", "content": f"answer {i} " + "y" * 200})
+
+        asyncio.run(agent._condense_context())
+
+        assert agent.messages[1]["content"].startswith("## Previous Conversation Summary")
+        roles = [m["role"] for m in agent.messages]
+        assert roles[2] == "assistant"
+        assert all(a != b for a, b in zip(roles[1:], roles[2:]))
+
+    def test_chunk_summaries_are_cached_and_merged(self):
+        agent = SummarizingAgent()
+        agent.summary_fanout = 2
+        chunk = [{"role": "user", "content": "hello"}]
+
+        async def scenario():
+            first = await agent._summarize_chunk(chunk, [])
+            again = await agent._summarize_chunk(chunk, [])
+            merged = await agent._summarize_chunk(chunk, first)
+            return first, again, merged
+
+        first, again, merged = asyncio.run(scenario())
+
+        assert first == again == [(0, "summary 1")]
+        assert merged == [(1, "summary 2")]
+        assert len(agent.prompts) == 2
+
+
+class TestToolResultCache:
+    """Test caching of read-only tool results"""
+
+    def test_hit_until_file_changes(self, tmp_path):
+        target = tmp_path / "a.py"
+        target.write_text("one")
+        cache = ToolResultCache()
+        args = {"file_path": str(target), "start_line": 1}
+
+        assert cache.get("read_code_file", args) is None
+        cache.put("read_code_file", args, "one")
+        assert cache.get("read_code_file", {"start_line": 1, "file_path": str(target)}) == "one"
+
+        os.utime(target, (time.time() + 10, time.time() + 10))
+        assert cache.get("read_code_file", args) is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 2
+
+    def test_mutation_invalidates_overlapping_paths(self, tmp_path):
+        cache = ToolResultCache()
+        (tmp_path / "src").mkdir()
+        cache.put("list_directory", {"path": str(tmp_path)}, "listing")
+        cache.put("read_code_file", {"file_path": str(tmp_path / "src" / "a.py")}, "a")
+        cache.put("read_code_file", {"file_path": str(tmp_path / "b.py")}, "b")
+
+        cache.invalidate([tmp_path / "src" / "a.py"])
+
+        assert cache.get("list_directory", {"path": str(tmp_path)}) is None
+        assert cache.get("read_code_file", {"file_path": str(tmp_path / "src" / "a.py")}) is None
+        assert cache.get("read_code_file", {"file_path": str(tmp_path / "b.py")}) == "b"
+
+        cache.invalidate()
+        assert cache.stats()["entries"] == 0
+
+    def test_nested_edit_invalidates_tree_tools(self, tmp_path):
+        nested = tmp_path / "src" / "pkg" / "a.py"
+        nested.parent.mkdir(parents=True)
+        nested.write_text("one")
+        cache = ToolResultCache()
+        args = {"folder_path": str(tmp_path), "pattern": "one"}
+        cache.put("search_in_files", args, "a.py:1: one")
+        assert cache.get("search_in_files", args) == "a.py:1: one"
+
+        directory_mtime = tmp_path.stat().st_mtime
+        nested.write_text("two")
+        os.utime(nested, (time.time() + 10, time.time() + 10))
+        assert tmp_path.stat().st_mtime == directory_mtime
+
+        assert cache.get("search_in_files", args) is None
+
+    def test_large_trees_are_not_cached(self, tmp_path):
+        for i in range(5):
+            (tmp_path / f"{i}.py").write_text("x")
+        cache = ToolResultCache(tree_limit=3)
+
+        cache.put("git_status", {"repo_path": str(tmp_path)}, "clean")
+
+        assert cache.stats()["entries"] == 0
+
+    def test_omitted_repo_path_watches_the_cwd(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "a.py").write_text("one")
+        cache = ToolResultCache()
+
+        cache.put("git_status", {}, "clean")
+        cache.put("read_code_file", {}, "no path")
+        assert cache.get("git_status", {}) == "clean"
+        assert cache.stats()["entries"] == 1
+
+        (tmp_path / "a.py").write_text("changed")
+        os.utime(tmp_path / "a.py", (time.time() + 10, time.time() + 10))
+        assert cache.get("git_status", {}) is None
+
+    def test_commit_invalidates_git_log(self, tmp_path):
+        def git(*args):
+            subprocess.run(["git", "-C", str(tmp_path), "-c", "user.name=t", "-c", "user.email=t@t",
+                            *args], check=True, capture_output=True)
+        git("init", "-q")
+        (tmp_path / "a.py").write_text("one")
+        git("add", "a.py")
+        git("commit", "-qm", "first")
+        cache = ToolResultCache()
+        args = {"repo_path": str(tmp_path)}
+        cache.put("git_log", args, "first")
+        head_mtime = (tmp_path / ".git" / "HEAD").stat().st_mtime
+
+        time.sleep(0.01)
+        git("commit", "-q", "--allow-empty", "-m", "second")
+        assert (tmp_path / ".git" / "HEAD").stat().st_mtime == head_mtime
+
+        assert cache.get("git_log", args) is None
+
+    def test_lru_bound(self):
+        cache = ToolResultCache(max_entries=2)
+        for name in ["a", "b", "c"]:
+            cache.put("list_supported_formats", {"name": name}, name)
+
+        assert cache.get("list_supported_formats", {"name": "a"}) is None
+        assert cache.get("list_supported_formats", {"name": "c"}) == "c"
+
+
+class TestSessionLogger:
+    """Test the background session log writer"""
+
+    def test_writes_jsonl_and_markdown(self, tmp_path):
+        logger = SessionLogger(tmp_path / "s.jsonl", tmp_path / "s.md")
+        for i in range(100):
+            logger.log({"role": "user", "content": f"message {i}"})
+        logger.log({"role": "tool_call", "tool_name": "git_status", "arguments": "{}"})
+        logger.close()
+
+        lines = (tmp_path / "s.jsonl").read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 101
+        assert json.loads(lines[99])["content"] == "message 99"
+        transcript = (tmp_path / "s.md").read_text(encoding="utf-8")
+        assert "## User\n\nmessage 0" in transcript
+        assert "### Tool Call: `git_status`" in transcript
+
+    def test_jsonl_only_renders_on_demand(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key", markdown_log=False)
+        agent.log_dir = tmp_path
+        agent._log("user", "dropped before logging starts")
+        agent._start_logging()
+        agent._log("user", "hello")
+        agent._log("assistant", "hi", reasoning_content="think")
+        asyncio.run(agent.cleanup())
+
+        assert agent.md_file is None
+        assert list(tmp_path.glob("*.md")) == []
+        transcript = render_markdown(agent.jsonl_file).read_text(encoding="utf-8")
+        assert "## User\n\nhello" in transcript
+        assert "### Reasoning\n> think" in transcript
+        assert "dropped" not in transcript
+
+
+class TestStreamRendering:
+    """Test accumulation and rendering of streamed replies"""
+
+    def _console(self):
+        from io import StringIO
+        from rich.console import Console
+        return Console(file=StringIO(), width=80, force_terminal=False)
+
+    def test_accumulator_joins_lazily(self):
+        acc = StreamAccumulator()
+        assert not acc
+        for piece in ["Hel", "lo", " world"]:
+            acc.append(piece)
+        assert acc.text == "Hello world"
+        acc.append("!")
+        assert acc.text == "Hello world!"
+
+    def test_plain_mode_writes_raw_text(self):
+        out = self._console()
+        renderer = StreamRenderer("plain", out=out)
+        renderer.add_reasoning("think")
+        for piece in ["# Title", "\n", "body"]:
+            renderer.add_content(piece)
+        renderer.finish()
+
+        text = out.file.getvalue()
+        assert "think" in text
+        assert "# Title\nbody" in text
+        assert renderer.content.text == "# Title\nbody"
+
+    def test_none_mode_is_silent(self):
+        out = self._console()
+        renderer = StreamRenderer("none", out=out)
+        renderer.start()
+        renderer.add_reasoning("think")
+        renderer.add_content("answer")
+        renderer.finish()
+
+        assert out.file.getvalue() == ""
+        assert renderer.reasoning.text == "think"
+
+    def test_live_mode_commits_finished_blocks(self):
+        out = self._console()
+        renderer = StreamRenderer("live", fps=1000, out=out)
+        renderer.add_content("First paragraph.\n\n```\ncode\n\nmore\n")
+        assert renderer._committed == len("First paragraph.\n\n")
+        renderer.add_content("```\n\nTail")
+        renderer.finish()
+
+        assert "First paragraph." in out.file.getvalue()
+        assert "Tail" in out.file.getvalue()
+        assert renderer._committed == len(renderer.content.text)
+
+
+class TestPrewarm:
+    """Test selection of skills to warm up at startup"""
+
+    def test_frequent_skills_from_logs(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        agent.log_dir = tmp_path
+        for name in ["coder", "git", "planner"]:
+            agent.add_server(name, tmp_path / "missing.md", "echo", [])
+
+        entries = [
+            {"role": "tool_call", "tool_name": "skill_git"},
+            {"role": "tool_call", "tool_name": "skill_coder"},
+            {"role": "tool_call", "tool_name": "skill_git"},
+            {"role": "tool_call", "tool_name": "skill_removed"},
+            {"role": "tool_call", "tool_name": "git_status"},
+        ]
+        log = tmp_path / "session_20250101_000000.jsonl"
+        log.write_text("\n".join(json.dumps(e) for e in entries) + "\n", encoding="utf-8")
+
+        assert agent.frequent_skills() == ["git", "coder"]
+        assert agent.frequent_skills(limit=1) == ["git"]
+
+    def test_prewarm_ignores_unknown_skills(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key")
+
+        async def scenario():
+            return agent.prewarm(["does_not_exist"])
+
+        assert asyncio.run(scenario()) == []
+        assert agent.prewarm_tasks == []
+
+
+def _tool_def(name):
+    return {"type": "function", "function": {"name": name, "description": "", "parameters": {}}}
+
+
+class TestToolRouting:
+    """Test the tool name -> skill routing table"""
+
+    def _agent_with_skills(self, tmp_path, tools_by_skill):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        for name, tool_names in tools_by_skill.items():
+            agent.add_server(name, tmp_path / "missing.md", "echo", [])
+            skill = agent.skill_index[name]
+            skill.tools_cache = [_tool_def(t) for t in tool_names]
+            skill.session = object() # Pretend the server is connected
+            skill.loaded = True
+            agent._register_tools(skill)
+        return agent
+
+    def test_index_maps_tools_to_skills(self, tmp_path):
+        agent = self._agent_with_skills(tmp_path, {"coder": ["read_code_file"], "git": ["git_status"]})
+
+        assert agent.tool_index["read_code_file"][0] is agent.skill_index["coder"]
+        assert agent.tool_index["git_status"][0] is agent.skill_index["git"]
+        assert agent.tool_conflicts == {}
+
+    def test_duplicate_names_are_reported(self, tmp_path):
+        agent = self._agent_with_skills(tmp_path, {"coder": ["search"], "web_fetch": ["search"]})
+
+        assert agent.tool_conflicts == {"search": ["coder", "web_fetch"]}
+        assert agent.tool_index["search"][0] is agent.skill_index["coder"]
+        tools = asyncio.run(agent.list_tools())
+        assert [t["function"]["name"] for t in tools][-1:] == ["search"]
+        assert sum(t["function"]["name"] == "search" for t in tools) == 1
+
+    def test_unregister_hands_over_duplicates(self, tmp_path):
+        agent = self._agent_with_skills(tmp_path, {"coder": ["search", "read_code_file"], "web_fetch": ["search"]})
+        coder = agent.skill_index["coder"]
+        coder.session = None
+
+        agent._unregister_tools(coder)
+
+        assert "read_code_file" not in agent.tool_index
+        assert agent.tool_index["search"][0] is agent.skill_index["web_fetch"]
+
+
+TOOL_DESCRIPTIONS = {
+    "git": {"git_status": "Show the working tree status", "git_diff": "Show changes between commits",
+            "git_log": "Show commit logs"},
+    "coder": {"read_code_file": "Read a source code file", "search_in_files": "Search for a pattern in files",
+              "run_terminal_command": "Run a shell command in a terminal"},
+}
+
+
+def _selection_agent(tmp_path, top_k=2):
+    agent = DeepSeekMCPAgent("fake-api-key", tool_top_k=top_k)
+    for skill_name, tools in TOOL_DESCRIPTIONS.items():
+        agent.add_server(skill_name, tmp_path / "missing.md", "echo", [])
+        skill = agent.skill_index[skill_name]
+        skill.tools_cache = [
+            {"type": "function", "function": {"name": name, "description": description, "parameters": {}}}
+            for name, description in tools.items()
+        ]
+        skill.session = object()
+        agent._register_tools(skill)
+        agent._mark_loaded(skill)
+    return agent
+
+
+def _exposed(agent):
+    return {t["function"]["name"] for t in asyncio.run(agent.list_tools())
+            if not t["function"]["name"].startswith("skill_") and t["function"]["name"] != "read_tool_result"}
+
+
+class TestToolSelection:
+    """Test relevance-ranked exposure of loaded tools"""
+
+    def test_bm25_prefers_matching_documents(self):
+        index = BM25Index({"a": "git status of the working tree", "b": "read a file", "c": "status report"})
+
+        scores = index.scores("what is the git status")
+        assert scores["a"] > scores["c"] > scores["b"] == 0.0
+
+    def test_top_k_tools_by_relevance(self, tmp_path):
+        agent = _selection_agent(tmp_path)
+        agent.messages.append({"role": "user", "content": "search the files for a pattern and read the code file"})
+        agent._select_tools(agent.messages[-1]["content"])
+
+        assert _exposed(agent) == {"search_in_files", "read_code_file"}
+        assert "git_status" in agent.hidden_tools
+
+    def test_previous_turn_and_named_tools_stay_exposed(self, tmp_path):
+        agent = _selection_agent(tmp_path)
+        agent.messages.append({"role": "user", "content": "first"})
+        agent.messages.append({"role": "assistant", "content": "", "tool_calls": [
+            {"id": "1", "type": "function", "function": {"name": "git_log", "arguments": "{}"}}]})
+        agent.messages.append({"role": "user", "content": "now run git_diff and read the code file"})
+        agent._select_tools(agent.messages[-1]["content"])
+
+        assert {"git_log", "git_diff", "read_code_file"} <= _exposed(agent)
+
+    def test_unknown_tool_restores_full_set(self, tmp_path):
+        agent = _selection_agent(tmp_path)
+        agent.messages.append({"role": "user", "content": "read the code file"})
+        agent._select_tools("read the code file")
+        assert agent.hidden_tools
+
+        result = asyncio.run(agent._call_tool("git_stat", {}))
+
+        assert "now available" in result
+        assert agent.hidden_tools == set()
+        assert len(_exposed(agent)) == 6
+        assert agent.tool_fallbacks == 1
+
+    def test_reloading_skill_restores_its_tools(self, tmp_path):
+        agent = _selection_agent(tmp_path)
+        agent.messages.append({"role": "user", "content": "read the code file"})
+        agent._select_tools("read the code file")
+
+        asyncio.run(agent._call_tool("skill_git", {}))
+
+        assert {"git_status", "git_diff", "git_log"} <= _exposed(agent)
+
+    def test_selection_kept_while_it_covers_the_ranking(self, tmp_path):
+        agent = _selection_agent(tmp_path)
+        agent.messages.append({"role": "user", "content": "search the files and read the code file"})
+        agent._select_tools(agent.messages[-1]["content"])
+        tools = asyncio.run(agent.list_tools())
+
+        agent.messages.append({"role": "user", "content": "read that code file again"})
+        agent._select_tools(agent.messages[-1]["content"])
+
+        assert asyncio.run(agent.list_tools()) is tools
+
+    def test_small_tool_sets_are_not_filtered(self, tmp_path):
+        agent = _selection_agent(tmp_path, top_k=None)
+        agent.messages.append({"role": "user", "content": "read the code file"})
+        agent._select_tools("read the code file")
+
+        assert agent.hidden_tools == set()
+        assert len(_exposed(agent)) == 6
+
+
+SKILL_DOCS = {
+    "git": "---\nname: git\nallowed-tools:\n  - git_commit\n  - git_push\n---\nCommit changes, push branches, inspect the repository history.",
+    "coder": "---\nname: coder\n---\nRead, search and edit source code files; run terminal commands.",
+    "web_fetch": "---\nname: web_fetch\n---\nFetch a web page by URL and return it as text.",
+}
+
+
+class TestSkillPreload:
+    """Test predicting and preloading skills from the user prompt"""
+
+    def test_predicts_from_skill_docs(self):
+        predictor = SkillPredictor(SKILL_DOCS, [])
+
+        assert predictor.predict("commit and push the repository changes") == ["git"]
+        assert predictor.predict("hello there") == []
+
+    def test_history_votes_for_skills_used_after_similar_prompts(self):
+        history = [("整理今天的新闻", ["web_fetch"]), ("总结昨天的新闻", ["web_fetch"]), ("修复代码里的错误", ["coder"])]
+        predictor = SkillPredictor(SKILL_DOCS, history)
+
+        assert predictor.predict("今天的新闻") == ["web_fetch"]
+        assert predictor.predict("修复错误") == ["coder"]
+        assert predictor.predict("你好") == []
+
+    def test_history_from_logs(self, tmp_path):
+        log = tmp_path / "session_20250101_000000.jsonl"
+        entries = [
+            {"role": "user", "content": "push it"},
+            {"role": "tool_call", "tool_name": "git_push"},
+            {"role": "user", "content": "fix the bug"},
+            {"role": "tool_call", "tool_name": "skill_coder"},
+            {"role": "tool_call", "tool_name": "read_code_file"},
+            {"role": "user", "content": "hi"},
+        ]
+        log.write_text("\n".join(json.dumps(e) for e in entries) + "\n", encoding="utf-8")
+
+        history = SkillPredictor.history_from_logs([log], {"git_push": "git", "read_code_file": "coder"})
+
+        assert history == [("push it", ["git"]), ("fix the bug", ["coder"])]
+
+    def test_preloaded_skill_saves_the_loader_round_trip(self, tmp_path):
+        replies = [
+            {"tool_calls": [{"name": "echo", "arguments": {"text": "hi"}}]},
+            {"content": "Echoed."},
+        ]
+
+        async def scenario():
+            with FakeOpenAIServer(responder=lambda messages: replies.pop(0)) as server:
+                agent = make_agent(server, tmp_path)
+                agent.preload_min_score = 0.5 # Only one skill to rank against
+                try:
+                    reply = await agent.run_turn("echo this text back using the stub echo tool")
+                finally:
+                    await agent.cleanup()
+                return agent, reply, server.requests
+
+        agent, reply, requests = asyncio.run(scenario())
+
+        assert reply == "Echoed."
+        assert requests == 2
+        assert agent.skill_index["stub"].loaded
+        assert "## Skill: stub" in agent.messages[1]["content"]
+        assert agent.messages[2]["tool_calls"][0]["function"]["name"] == "echo"
+        assert agent.messages[3]["content"] == "hi"
+
+    def test_preload_can_be_disabled(self, tmp_path):
+        async def scenario():
+            with FakeOpenAIServer() as server:
+                agent = make_agent(server, tmp_path, preload_skills=False)
+                agent.preload_min_score = 0.5
+                try:
+                    await agent.run_turn("echo this text back using the stub echo tool")
+                finally:
+                    await agent.cleanup()
+                return agent
+
+        agent = asyncio.run(scenario())
+
+        assert not agent.skill_index["stub"].loaded
+        assert agent.messages[1]["content"] == "echo this text back using the stub echo tool"
+
+
+class TestBudget:
+    """Test usage accounting and the soft and hard budgets"""
+
+    def test_cost_uses_cache_breakdown(self):
+        governor = BudgetGovernor(prices={"m": {"cache_hit": 1.0, "cache_miss": 10.0, "output": 100.0}})
+
+        cost = governor.record("m", {"prompt_tokens": 300, "completion_tokens": 10, "total_tokens": 310,
+                                     "prompt_cache_hit_tokens": 100, "prompt_cache_miss_tokens": 200})
+
+        assert cost == pytest.approx((100 * 1 + 200 * 10 + 10 * 100) / 1e6)
+        assert governor.session["total_tokens"] == governor.turn["total_tokens"] == 310
+        assert governor.report()["by_model"]["m"]["requests"] == 1
+
+    def test_limits(self):
+        governor = BudgetGovernor(BudgetConfig(soft_tokens=100, hard_cost=0.5, turn_hard_tokens=150))
+        assert governor.model_for("deepseek-reasoner") == "deepseek-reasoner"
+
+        governor.record("deepseek-reasoner", {"prompt_tokens": 120, "total_tokens": 120})
+        assert governor.model_for("deepseek-reasoner") == "deepseek-chat"
+        assert governor.hard_limit() is None
+
+        governor.record("deepseek-chat", {"prompt_tokens": 40, "total_tokens": 40})
+        assert governor.hard_limit().startswith("turn budget exhausted")
+        governor.start_turn()
+        assert governor.hard_limit() is None
+
+    def _run(self, tmp_path, budget, prompts):
+        async def scenario():
+            with FakeOpenAIServer(SCRIPTS) as server:
+                agent = make_agent(server, tmp_path, budget=budget)
+                try:
+                    replies = [await agent.run_turn(prompt) for prompt in prompts]
+                finally:
+                    await agent.cleanup()
+                return agent, replies, server.requests
+        return asyncio.run(scenario())
+
+    def test_soft_budget_switches_model(self, tmp_path):
+        agent, replies, _ = self._run(tmp_path, BudgetConfig(soft_tokens=1), ["tools"])
+
+        assert replies == ["All echoes returned."]
+        assert [m["model"] for m in agent.llm_metrics] == ["deepseek-reasoner", "deepseek-chat", "deepseek-chat"]
+        assert agent.budget.downgraded_requests == 2
+
+    def test_hard_turn_budget_stops_the_turn(self, tmp_path):
+        agent, replies, requests = self._run(tmp_path, BudgetConfig(turn_hard_tokens=1), ["tools", "plain"])
+
+        assert replies == ["", agent.messages[-1]["content"]]
+        assert requests == 2 # One per turn
+        entries = [json.loads(line) for line in open(agent.jsonl_file, encoding="utf-8")]
+        assert [e["reason"] for e in entries if e["role"] == "budget_stop"][0].startswith("turn budget")
+        assert [e["requests"] for e in entries if e["role"] == "turn_usage"] == [1, 1]
+        report = [e for e in entries if e["role"] == "budget_report"][0]
+        assert report["session"]["requests"] == 2
+        assert report["session"]["cost_usd"] > 0
+
+    def test_hard_session_budget_leaves_history_alone(self, tmp_path):
+        agent, replies, requests = self._run(tmp_path, BudgetConfig(hard_tokens=1), ["plain", "plain"])
+
+        assert replies[1] == ""
+        assert requests == 1
+        assert [m["role"] for m in agent.messages] == ["system", "user", "assistant"]
+
+
+class TestPromptPrefixStability:
+    """Test that requests keep a byte-stable prefix for server-side caching"""
+
+    def test_tool_list_only_grows(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        for name, tools in [("git", ["git_status", "git_diff"]), ("coder", ["read_code_file"])]:
+            agent.add_server(name, tmp_path / "missing.md", "echo", [])
+            skill = agent.skill_index[name]
+            skill.tools_cache = [_tool_def(t) for t in tools]
+            skill.session = object()
+            agent._register_tools(skill)
+
+        def names():
+            return [t["function"]["name"] for t in asyncio.run(agent.list_tools())]
+
+        before = names()
+        assert before == ["read_tool_result", "skill_coder", "skill_git"]
+        agent._mark_loaded(agent.skill_index["git"])
+        after_git = names()
+        agent._mark_loaded(agent.skill_index["coder"])
+        after_coder = names()
+
+        assert after_git == before + ["git_diff", "git_status"]
+        assert after_coder == after_git + ["read_code_file"]
+        assert json.dumps(asyncio.run(agent.list_tools())) == json.dumps(asyncio.run(agent.list_tools()))
+
+    def test_tool_list_rebuilt_only_on_state_change(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        agent.add_server("git", tmp_path / "missing.md", "echo", [])
+        skill = agent.skill_index["git"]
+        skill.tools_cache = [_tool_def("git_status")]
+        skill.session = object()
+
+        first = asyncio.run(agent.list_tools())
+        assert asyncio.run(agent.list_tools()) is first
+        assert skill.get_loader_tool_def() is skill.get_loader_tool_def()
+
+        agent._register_tools(skill)
+        agent._mark_loaded(skill)
+        loaded = asyncio.run(agent.list_tools())
+        assert loaded is not first
+        assert loaded[-1]["function"]["name"] == "git_status"
+        assert asyncio.run(agent.list_tools()) is loaded
+
+    def test_volatile_details_at_end_of_system_prompt(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        agent.add_server("b_skill", tmp_path / "missing.md", "echo", [])
+        agent.add_server("a_skill", tmp_path / "missing.md", "echo", [])
+
+        prompt = agent.build_system_prompt()
+
+        assert prompt.index("- a_skill") < prompt.index("- b_skill")
+        assert prompt.index("## Available Skills") < prompt.index("Current date and time")
+        assert prompt.rstrip().splitlines()[-1].startswith("- Current date and time")
+
+    def test_prompt_cache_metrics(self):
+        from openai.types import CompletionUsage
+
+        agent = DeepSeekMCPAgent("fake-api-key")
+        usage = CompletionUsage.model_validate({
+            "prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110,
+            "prompt_cache_hit_tokens": 80, "prompt_cache_miss_tokens": 20,
+        })
+        agent._record_llm_metrics("deepseek-reasoner", usage, 0.5, 2.0)
+        agent._record_llm_metrics("deepseek-reasoner", None, None, 1.0)
+
+        summary = agent.prompt_cache_summary()
+        assert summary["requests"] == 2
+        assert summary["prompt_cache_hit_rate"] == 0.8
+        assert summary["ttft_p50_s"] == 0.5
+
+
+class TestLargeResults:
+    """Test out-of-line storage of large tool results"""
+
+    def test_store_is_content_addressed(self, tmp_path):
+        from agent import ArtifactStore
+
+        store = ArtifactStore(tmp_path)
+        handle = store.put("payload")
+
+        assert store.put("payload") == handle
+        assert len(list(tmp_path.iterdir())) == 1
+        assert store.read(handle) == "payload"
+        assert store.read("../../etc") is None
+
+    def test_large_result_is_previewed_and_pageable(self, tmp_path):
+        from agent import ArtifactStore
+
+        agent = DeepSeekMCPAgent("fake-api-key")
+        agent.artifact_store = ArtifactStore(tmp_path)
+        result = "".join(f"line {i}\n" for i in range(3000))
+
+        content, handle = agent._spill_large_result("git_diff", result)
+
+        assert handle is not None
+        assert len(content) < 4000
+        assert content.count("line 0\n") == 1 and "line 2999" in content
+        page = asyncio.run(agent.call_tool("read_tool_result", {"handle": handle, "offset": 2000, "length": 100}))
+        assert page.startswith(result[2000:2100])
+        assert "next offset=2100" in page
+        assert agent._spill_large_result("git_diff", "short") == ("short", None)
+
+
+class SleepyAgent(DeepSeekMCPAgent):
+    """Agent whose tools just sleep, to observe dispatch ordering."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("fake-api-key", *args, **kwargs)
+        self.started = []
+
+    async def call_tool(self, tool_name, arguments):
+        self.started.append(tool_name)
+        await asyncio.sleep(arguments.get("delay", 0.2))
+        return f"{tool_name} done"
+
+
+def _tool_call(call_id, name, **args):
+    return {"id": call_id, "type": "function", "function": {"name": name, "arguments": json.dumps(args)}}
+
+
+class TestToolDispatch:
+    """Test concurrent execution of tool calls from one assistant turn"""
+
+    def test_independent_calls_overlap(self):
+        agent = SleepyAgent()
+        calls = [_tool_call(f"call_{i}", "read_code_file") for i in range(3)]
+
+        start = time.perf_counter()
+        results = asyncio.run(agent.execute_tool_calls(calls))
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 0.5
+        assert [tc["id"] for tc, _ in results] == ["call_0", "call_1", "call_2"]
+
+    def test_results_keep_call_order(self):
+        agent = SleepyAgent()
+        calls = [
+            _tool_call("slow", "git_status", delay=0.3),
+            _tool_call("fast", "git_log", delay=0.01),
+        ]
+
+        results = asyncio.run(agent.execute_tool_calls(calls))
+
+        assert [tc["id"] for tc, _ in results] == ["slow", "fast"]
+        assert results[0][1] == "git_status done"
+
+    def test_side_effect_tools_run_alone(self):
+        agent = SleepyAgent()
+        calls = [
+            _tool_call("a", "read_code_file", delay=0.1),
+            _tool_call("b", "edit_code_file", delay=0.1),
+            _tool_call("c", "read_code_file", delay=0.1),
+        ]
+
+        start = time.perf_counter()
+        asyncio.run(agent.execute_tool_calls(calls))
+
+        assert time.perf_counter() - start >= 0.3
+        assert agent.started == ["read_code_file", "edit_code_file", "read_code_file"]
+
+    def test_parallel_opt_out(self):
+        agent = SleepyAgent(parallel_tool_calls=False)
+        calls = [_tool_call(f"call_{i}", "read_code_file", delay=0.1) for i in range(3)]
+
+        start = time.perf_counter()
+        asyncio.run(agent.execute_tool_calls(calls))
+
+        assert time.perf_counter() - start >= 0.3
+
+
+class TestInterruption:
+    """Test cancelling a turn while its tools run"""
+
+    def test_cancelled_turn_leaves_a_valid_history(self, tmp_path):
+        replies = [
+            {"tool_calls": [{"name": "skill_stub", "arguments": {}}]},
+            {"tool_calls": [{"name": "sleep_ms", "arguments": {"ms": 30000}},
+                            {"name": "echo", "arguments": {"text": "hi"}}]},
+            {"content": "Back again."},
+        ]
+
+        async def scenario():
+            with FakeOpenAIServer(responder=lambda messages: replies.pop(0)) as server:
+                agent = make_agent(server, tmp_path, preload_skills=False)
+                try:
+                    turn = asyncio.create_task(agent.run_turn("wait a while"))
+                    while len(replies) > 1: # Until the sleep is requested
+                        await asyncio.sleep(0.05)
+                    await asyncio.sleep(0.3)
+                    turn.cancel()
+                    with pytest.raises(asyncio.CancelledError):
+                        await turn
+                    reply = await agent.run_turn("never mind")
+                finally:
+                    await agent.cleanup()
+                return agent, reply
+
+        agent, reply = asyncio.run(scenario())
+
+        assert reply == "Back again."
+        roles = [m["role"] for m in agent.messages]
+        assert roles == ["system", "user", "assistant", "tool", "assistant", "tool", "tool", "user", "assistant"]
+        assert all(m["content"].startswith("Interrupted by the user") for m in agent.messages[5:7])
+        entries = [json.loads(line) for line in open(agent.jsonl_file, encoding="utf-8")]
+        assert [e["tool_calls"] for e in entries if e["role"] == "turn_cancelled"] == [
+            [tc["id"] for tc in agent.messages[4]["tool_calls"]]]
+
+
+    def test_cancelled_stream_gets_a_placeholder_reply(self, tmp_path):
+        async def scenario():
+            with FakeOpenAIServer(SCRIPTS, ttft=5.0) as server:
+                agent = make_agent(server, tmp_path, preload_skills=False)
+                try:
+                    turn = asyncio.create_task(agent.run_turn("plain"))
+                    await asyncio.sleep(0.5)
+                    turn.cancel()
+                    with pytest.raises(asyncio.CancelledError):
+                        await turn
+                finally:
+                    await agent.cleanup()
+                return agent
+
+        agent = asyncio.run(scenario())
+
+        assert [m["role"] for m in agent.messages] == ["system", "user", "assistant"]
+        assert agent.messages[-1]["content"].startswith("(Interrupted by the user")
+
+
+class TestTracing:
+    """Test span nesting, the trace JSONL and latency summaries"""
+
+    def test_spans_nest_across_gathered_tasks(self, tmp_path):
+        tracer = Tracer(SessionLogger(tmp_path / "trace.jsonl"))
+
+        async def child(name):
+            with tracer.span("tool.call", tool=name):
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            with tracer.span("turn") as turn:
+                await asyncio.gather(child("a"), child("b"))
+            return turn
+
+        turn = asyncio.run(scenario())
+        tracer.close()
+
+        spans = [json.loads(line) for line in (tmp_path / "trace.jsonl").read_text(encoding="utf-8").splitlines()]
+        assert [s["name"] for s in spans] == ["tool.call", "tool.call", "turn"]
+        assert {s["parent_id"] for s in spans[:2]} == {turn.span_id}
+        assert {s["trace_id"] for s in spans} == {turn.trace_id}
+        assert spans[2]["parent_id"] is None
+        assert spans[0]["duration_ms"] >= 10
+
+    def test_traces_follow_a_redirected_log_dir(self, tmp_path):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        assert agent.trace_dir == DEFAULT_TRACE_DIR
+
+        agent.log_dir = tmp_path
+        agent.start_session()
+        asyncio.run(agent.cleanup())
+
+        assert agent.trace_file == tmp_path / "traces" / f"{agent.session_id}.jsonl"
+        assert agent.trace_file.exists()
+
+    def test_errors_mark_the_span(self):
+        tracer = Tracer()
+        with pytest.raises(ValueError):
+            with tracer.span("skill.connect") as span:
+                raise ValueError("boom")
+        assert span.status == "error"
+        assert span.attributes["error"] == "ValueError: boom"
+
+    def test_summary_percentiles_per_tool(self):
+        tracer = Tracer()
+        tracer.tool_durations["read_code_file"] = [i / 1000 for i in range(1, 101)]
+
+        stats = tracer.summary()["tools"]["read_code_file"]
+        assert stats["count"] == 100
+        assert stats["p50_ms"] == 50.0
+        assert stats["p95_ms"] == 95.0
+        assert stats["max_ms"] == 100.0
+
+    def test_tool_calls_are_traced(self):
+        agent = DeepSeekMCPAgent("fake-api-key")
+        result = asyncio.run(agent.call_tool("no_such_tool", {}))
+
+        assert result.startswith("Error")
+        assert agent.tracer.summary()["tools"]["no_such_tool"]["count"] == 1
+
+
+class TestLLMTransport:
+    """Test retries, stream timeouts and hedging against the local fake server"""
+
+    def _run(self, replies, **config):
+        """One turn against a server answering with `replies` in order, then "OK."."""
+        async def scenario():
+            with FakeOpenAIServer(responder=lambda messages: replies.pop(0) if replies else {"content": "OK."}) as server:
+                agent = DeepSeekMCPAgent("fake-api-key", base_url=server.base_url, render_mode="none",
+                                         transport=TransportConfig(backoff_base=0.01, **config))
+                try:
+                    return agent, await agent.run_turn("hi")
+                finally:
+                    await agent.cleanup()
+        return asyncio.run(scenario())
+
+    def test_server_errors_are_retried(self):
+        agent, reply = self._run([{"status": 503}, {"status": 429, "headers": {"retry-after": "0.05"}}])
+        assert reply == "OK."
+        assert agent.transport.stats() == {"attempts": 3, "retries": 2, "hedges": 0}
+
+    def test_client_errors_are_not_retried(self):
+        with pytest.raises(openai.BadRequestError):
+            self._run([{"status": 400}])
+
+    def test_stalled_stream_is_restarted(self):
+        agent, reply = self._run([{"content": "partial answer", "stall_after": 2}], idle_timeout=0.3)
+        assert reply == "OK."
+        assert agent.transport.retries == 1
+
+    def test_restarted_stream_marks_the_discarded_output(self):
+        import agent as agent_module
+        replies = [{"content": "partial answer", "stall_after": 2}]
+
+        async def scenario():
+            with FakeOpenAIServer(responder=lambda messages: replies.pop(0) if replies else {"content": "OK."}) as server:
+                agent = DeepSeekMCPAgent("fake-api-key", base_url=server.base_url, render_mode="plain",
+                                         transport=TransportConfig(backoff_base=0.01, idle_timeout=0.3))
+                try:
+                    return await agent.run_turn("hi")
+                finally:
+                    await agent.cleanup()
+
+        with agent_module.console.capture() as capture:
+            assert asyncio.run(scenario()) == "OK."
+        output = capture.get()
+        assert output.index("partial") < output.index("Retrying") < output.rindex("OK.")
+
+    def test_slow_first_token_times_out(self):
+        agent, reply = self._run([{"content": "slow", "ttft": 2.0}], ttft_timeout=0.3)
+        assert reply == "OK."
+        assert agent.transport.retries == 1
+
+    def test_hedged_request_wins_over_slow_one(self):
+        start = time.perf_counter()
+        agent, reply = self._run([{"content": "slow", "ttft": 2.0}], hedge_after=0.2)
+        assert reply == "OK."
+        assert agent.transport.stats() == {"attempts": 1, "retries": 0, "hedges": 1}
+        assert time.perf_counter() - start < 2.0
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,72 @@
+"""
+Unit tests for the headless batch runner.
+"""
+import pytest
+import json
+import time
+import asyncio
+
+from agent import DeepSeekMCPAgent
+from batch import load_requests, run_batch
+
+
+class EchoAgent(DeepSeekMCPAgent):
+    """Agent that answers after a short pause without calling the LLM."""
+
+    running = 0
+    peak = 0
+
+    def __init__(self, log_dir):
+        super().__init__("fake-api-key", render_mode="none")
+        self.log_dir = log_dir
+
+    async def run_turn(self, user_input):
+        EchoAgent.running += 1
+        EchoAgent.peak = max(EchoAgent.peak, EchoAgent.running)
+        await asyncio.sleep(0.1)
+        EchoAgent.running -= 1
+        if user_input == "fail":
+            raise RuntimeError("boom")
+        self.usage["total_tokens"] += len(user_input)
+        return user_input.upper()
+
+
+def test_load_requests(tmp_path):
+    path = tmp_path / "requests.jsonl"
+    path.write_text(
+        json.dumps({"request_id": "a", "title": "Title", "body": "Body"}) + "\n"
+        + "\n"
+        + json.dumps({"prompt": "Just a prompt"}) + "\n",
+        encoding="utf-8"
+    )
+
+    assert load_requests(path) == [
+        {"request_id": "a", "prompt": "Title\n\nBody"},
+        {"request_id": "line-3", "prompt": "Just a prompt"},
+    ]
+
+
+def test_run_batch_bounds_concurrency(tmp_path):
+    requests = [{"request_id": f"r{i}", "prompt": f"task {i}"} for i in range(6)]
+    requests.append({"request_id": "bad", "prompt": "fail"})
+    output = tmp_path / "results.jsonl"
+    EchoAgent.peak = 0
+
+    start = time.perf_counter()
+    asyncio.run(run_batch(requests, output, lambda: EchoAgent(tmp_path), concurrency=3))
+    elapsed = time.perf_counter() - start
+
+    assert EchoAgent.peak == 3
+    assert elapsed < 0.6
+    results = {r["request_id"]: r for r in map(json.loads, output.read_text(encoding="utf-8").splitlines())}
+    assert len(results) == 7
+    assert results["r0"]["status"] == "ok"
+    assert results["r0"]["response"] == "TASK 0"
+    assert results["r0"]["usage"] == {"total_tokens": 6}
+    assert results["bad"]["status"] == "error"
+    assert "boom" in results["bad"]["error"]
+    assert (tmp_path / f"{results['r0']['session_id']}.jsonl").exists()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
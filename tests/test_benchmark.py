@@ -0,0 +1,59 @@
+"""
+End-to-end tests of the agent loop against the offline benchmark fixtures.
+"""
+import pytest
+import asyncio
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run import ANSWER, REASONING, SCRIPTS, compare, make_agent
+
+
+@pytest.fixture(scope="module")
+def server():
+    with FakeOpenAIServer(SCRIPTS) as server:
+        yield server
+
+
+def test_streamed_reply_with_reasoning(server, tmp_path):
+    """A streamed reply keeps its reasoning and reports usage and prompt cache hits"""
+    async def scenario():
+        agent = make_agent(server, tmp_path)
+        first = await agent.run_turn("plain")
+        second = await agent.run_turn("plain")
+        await agent.cleanup()
+        return agent, first, second
+
+    agent, first, second = asyncio.run(scenario())
+    assert first == second == ANSWER
+    assert agent.messages[2]["reasoning_content"] == REASONING
+    assert agent.usage["completion_tokens"] > 0
+    assert agent.llm_metrics[1]["prompt_cache_hit_tokens"] > 0
+
+
+def test_tool_calling_turn(server, tmp_path):
+    """Loader call, a batch of parallel tool calls, then the final answer"""
+    async def scenario():
+        agent = make_agent(server, tmp_path)
+        reply = await agent.run_turn("tools")
+        await agent.cleanup()
+        return agent, reply
+
+    agent, reply = asyncio.run(scenario())
+    assert reply == "All echoes returned."
+    assert agent.tool_call_count == 9
+    results = [m["content"] for m in agent.messages if m["role"] == "tool"]
+    assert results[1:] == [f"message {i}" for i in range(8)]
+
+
+def test_compare_reports():
+    old = {"scenarios": {"plain_turn": {"turn": {"n": 5, "p50_ms": 100.0}}}}
+    new = {"scenarios": {"plain_turn": {"turn": {"n": 5, "p50_ms": 80.0}}}}
+
+    lines = compare(old, new)
+    assert len(lines) == 1
+    assert lines[0].startswith("plain_turn.turn.p50_ms")
+    assert lines[0].endswith("-20.0%")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
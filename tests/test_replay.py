@@ -0,0 +1,84 @@
+"""
+Tests for replaying recorded session logs.
+"""
+import pytest
+import json
+import asyncio
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run import SCRIPTS, make_agent
+from replay import load_session, replay_session
+
+
+def _record_session(tmp_path):
+    """Run a real tool-calling session against the fake server and return its log."""
+    async def scenario():
+        with FakeOpenAIServer(SCRIPTS) as server:
+            agent = make_agent(server, tmp_path / "recorded")
+            await agent.run_turn("plain")
+            await agent.run_turn("tools")
+            await agent.cleanup()
+        return agent.jsonl_file
+
+    return asyncio.run(scenario())
+
+
+def test_load_session_pairs_calls_with_results(tmp_path):
+    turns = load_session(_record_session(tmp_path))
+
+    assert [t["prompt"] for t in turns] == ["plain", "tools"]
+    assert len(turns[1]["steps"]) == 3
+    calls = turns[1]["steps"][1]["tool_calls"]
+    assert [c["name"] for c in calls] == ["echo"] * 8
+    assert turns[1]["results"][calls[3]["id"]] == "message 3"
+    assert turns[0]["steps"][0]["metrics"]["ttft_s"] is not None
+
+
+def test_results_without_ids_match_by_name(tmp_path):
+    log = tmp_path / "old.jsonl"
+    entries = [
+        {"role": "user", "content": "hi", "timestamp": "2025-01-01T10:00:00"},
+        {"role": "assistant", "content": "", "timestamp": "2025-01-01T10:00:01"},
+        {"role": "tool_call", "tool_name": "git_status", "arguments": "{}"},
+        {"role": "tool_call", "tool_name": "git_log", "arguments": "{}"},
+        {"role": "tool_result", "tool_name": "git_log", "content": "log"},
+        {"role": "tool_result", "tool_name": "git_status", "content": "status", "timestamp": "2025-01-01T10:00:02"},
+        {"role": "assistant", "content": "done", "timestamp": "2025-01-01T10:00:05"},
+    ]
+    log.write_text("".join(json.dumps(e) + "\n" for e in entries), encoding="utf-8")
+
+    turn = load_session(log)[0]
+    status, git_log = turn["steps"][0]["tool_calls"]
+    assert turn["results"] == {status["id"]: "status", git_log["id"]: "log"}
+    assert turn["recorded_s"] == 5.0
+
+
+def test_preloaded_skills_are_recorded_per_turn(tmp_path):
+    log = tmp_path / "preload.jsonl"
+    entries = [
+        {"role": "user", "content": "push it"},
+        {"role": "skill_preload", "content": "", "skills": ["git"]},
+        {"role": "assistant", "content": "pushed"},
+        {"role": "user", "content": "thanks"},
+        {"role": "assistant", "content": "welcome"},
+    ]
+    log.write_text("".join(json.dumps(e) + "\n" for e in entries), encoding="utf-8")
+
+    assert [turn["preloaded"] for turn in load_session(log)] == [["git"], []]
+
+
+def test_replay_reproduces_answers_from_recorded_results(tmp_path):
+    log = _record_session(tmp_path)
+
+    report = asyncio.run(replay_session(log, log_dir=tmp_path / "replays"))
+
+    assert [t["answer_matches"] for t in report["turns"]] == [True, True]
+    assert report["totals"]["tool_calls"] == 9
+    assert report["totals"]["missing_steps"] == 0
+    replayed = [json.loads(line) for line in open(tmp_path / "replays" / f"{report['replay_session']}.jsonl")]
+    assert [e["content"] for e in replayed if e["role"] == "tool_result"][1:] == [f"message {i}" for i in range(8)]
+    assert (tmp_path / "replays" / "traces" / f"{report['replay_session']}.jsonl").exists()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,96 @@
+"""
+Tests for the multi-session service, driven over HTTP against the fake LLM server.
+"""
+import pytest
+import sys
+import json
+import asyncio
+
+import httpx
+
+from agent import DeepSeekMCPAgent, SkillServerPool
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run import ANSWER, SCRIPTS, STUB_SKILL
+from service import AgentService
+
+
+@pytest.fixture(scope="module")
+def llm():
+    with FakeOpenAIServer(SCRIPTS) as server:
+        yield server
+
+
+def _service(llm, tmp_path, pool=None, **kwargs):
+    def make_agent():
+        agent = DeepSeekMCPAgent("fake-api-key", base_url=llm.base_url, render_mode="none", server_pool=pool)
+        agent.log_dir = tmp_path
+        agent.add_server("stub", STUB_SKILL / "SKILL.md", sys.executable, [str(STUB_SKILL / "server.py")],
+                         shareable=True)
+        return agent
+    return AgentService(make_agent, pool, **kwargs)
+
+
+def _client(service, host="127.0.0.1"):
+    transport = httpx.ASGITransport(app=service.app(), client=(host, 50000))
+    return httpx.AsyncClient(transport=transport, base_url="http://service")
+
+
+async def _send(client, session_id, content):
+    response = await client.post(f"/sessions/{session_id}/messages", json={"content": content})
+    return response, [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_streams_reply_events(llm, tmp_path):
+    async def scenario():
+        service = _service(llm, tmp_path)
+        async with _client(service) as client:
+            session_id = (await client.post("/sessions")).json()["session_id"]
+            response, events = await _send(client, session_id, "plain")
+            listed = (await client.get("/sessions")).json()
+        await service.close()
+        return response, events, listed
+
+    response, events, listed = asyncio.run(scenario())
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert events[0]["type"] == "stream_start"
+    assert "".join(e["text"] for e in events if e["type"] == "content") == ANSWER
+    assert events[-1]["type"] == "done" and events[-1]["reply"] == ANSWER
+    assert listed[0]["turns"] == 1 and not listed[0]["busy"]
+
+
+def test_sessions_share_pooled_servers(llm, tmp_path):
+    async def scenario():
+        service = _service(llm, tmp_path, pool=SkillServerPool())
+        async with _client(service) as client:
+            ids = [(await client.post("/sessions")).json()["session_id"] for _ in range(3)]
+            results = await asyncio.gather(*(_send(client, session_id, "tools") for session_id in ids))
+            health = (await client.get("/health")).json()
+        await service.close()
+        return results, health
+
+    results, health = asyncio.run(scenario())
+    for _, events in results:
+        assert events[-1] == {"type": "done", "reply": "All echoes returned.", "usage": events[-1]["usage"]}
+        assert sum(1 for e in events if e["type"] == "tool_result") == 9
+    assert health == {"sessions": 3, "busy": 0, "shared_servers": ["stub"]}
+
+
+def test_rejects_busy_unknown_and_remote(llm, tmp_path):
+    async def scenario():
+        service = _service(llm, tmp_path)
+        async with _client(service) as client:
+            session_id = (await client.post("/sessions")).json()["session_id"]
+            service.sessions[session_id].busy = True
+            busy, _ = await _send(client, session_id, "plain")
+            missing, _ = await _send(client, "nope", "plain")
+        async with _client(service, host="192.168.1.20") as remote:
+            forbidden = await remote.get("/health")
+        service.sessions[session_id].busy = False
+        await service.close()
+        return busy.status_code, missing.status_code, forbidden.status_code
+
+    assert asyncio.run(scenario()) == (409, 404, 403)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])